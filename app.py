@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+from datetime import timedelta
+from typing import TYPE_CHECKING
+from dotenv import load_dotenv
+
+from database import Database
+from metrics import Metrics
+
+if TYPE_CHECKING:
+    # The components are imported when they are built, every entry script only pays for the ones it runs
+    from async_delivery import AsyncDeliveryWorker
+    from delivery import DeliveryWorker
+    from http_client import UrlChecker
+    from scheduler import UpdateScheduler
+    from telegram import CommandProcessor
+    from update_manager import UpdateManager
+    from webhook import WebhookServer
+
+
+class Config:
+    """Settings of the entry scripts read from the environment and the .env file."""
+
+    def __init__(self) -> None:
+        load_dotenv()
+        self.token: str | None = os.getenv('RSSBOT_TG_TOKEN')
+        self.dsn: str | None = os.getenv('RSSBOT_DSN')
+        self.log_level: str = os.getenv('LOG_LEVEL', 'INFO').upper()
+        self.db_pool_min: int = int(os.getenv('RSSBOT_DB_POOL_MIN', '1'))
+        self.db_pool_max: int = int(os.getenv('RSSBOT_DB_POOL_MAX', '10'))
+        self.migrations: str = os.getenv('RSSBOT_MIGRATIONS', Database.MIGRATIONS_APPLY)
+        self.user_cache_size: int = int(os.getenv('RSSBOT_USER_CACHE_SIZE', '10000'))
+        self.webhook_port: int = int(os.getenv('RSSBOT_WEBHOOK_PORT', '0'))
+        self.webhook_url: str | None = os.getenv('RSSBOT_WEBHOOK_URL')
+        self.webhook_secret: str | None = os.getenv('RSSBOT_WEBHOOK_SECRET')
+        self.webhook_workers: int = int(os.getenv('RSSBOT_WEBHOOK_WORKERS', '8'))
+        self.webhook_queue_size: int = int(os.getenv('RSSBOT_WEBHOOK_QUEUE_SIZE', '1000'))
+        self.workers: int = int(os.getenv('RSSBOT_UPDATE_WORKERS', '8'))
+        self.per_host_limit: int = int(os.getenv('RSSBOT_UPDATE_HOST_LIMIT', '2'))
+        self.fetch_timeout: float = float(os.getenv('RSSBOT_FETCH_TIMEOUT', '30'))
+        self.fetch_connect_timeout: float = float(os.getenv('RSSBOT_FETCH_CONNECT_TIMEOUT', '10'))
+        self.http_pool_hosts: int = int(os.getenv('RSSBOT_HTTP_POOL_HOSTS', '100'))
+        self.dns_cache_ttl: float = float(os.getenv('RSSBOT_DNS_CACHE_TTL', '300'))
+        self.fetch_max_size: int = int(os.getenv('RSSBOT_FETCH_MAX_SIZE', str(10 * 1024 * 1024)))
+        self.feed_max_items: int = int(os.getenv('RSSBOT_FEED_MAX_ITEMS', '200'))
+        feed_max_age_days = float(os.getenv('RSSBOT_FEED_MAX_AGE_DAYS', '0'))
+        self.feed_max_age: timedelta | None = timedelta(days=feed_max_age_days) if feed_max_age_days else None
+        self.notify_edited: bool = os.getenv('RSSBOT_NOTIFY_EDITED', '0') == '1'
+        self.items_retention: timedelta = timedelta(days=float(os.getenv('RSSBOT_ITEMS_RETENTION_DAYS', '30')))
+        self.batch_size: int = int(os.getenv('RSSBOT_UPDATE_BATCH_SIZE', '500'))
+        self.min_interval: float = float(os.getenv('RSSBOT_DAEMON_MIN_INTERVAL', '300'))
+        self.max_interval: float = float(os.getenv('RSSBOT_DAEMON_MAX_INTERVAL', '86400'))
+        self.shard_lease_time: timedelta = timedelta(seconds=float(os.getenv('RSSBOT_SHARD_LEASE_TIME', '600')))
+        self.shard_min_interval: timedelta = timedelta(seconds=float(os.getenv('RSSBOT_SHARD_MIN_INTERVAL', '60')))
+        self.sender_workers: int = int(os.getenv('RSSBOT_SENDER_WORKERS', '1'))
+        self.sender_batch_size: int = int(os.getenv('RSSBOT_SENDER_BATCH_SIZE', '500'))
+        self.sender_concurrency: int = int(os.getenv('RSSBOT_SENDER_CONCURRENCY', '30'))
+        self.metrics_port: int = int(os.getenv('RSSBOT_METRICS_PORT', '0'))
+        self.metrics_file: str | None = os.getenv('RSSBOT_METRICS_FILE')
+        self.report_file: str | None = os.getenv('RSSBOT_REPORT_FILE')
+
+
+def setup_logging(config: Config, component: str) -> None:
+    print('Starting', component, 'with logging level', config.log_level)
+    logging.basicConfig(
+        level=config.log_level,
+        format='%(asctime)s: <%(name)s> [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+
+def create_metrics(config: Config) -> Metrics:
+    """Return the metrics of the process, served over HTTP when the port is set."""
+    metrics = Metrics()
+    if config.metrics_port:
+        metrics.serve(config.metrics_port)
+    return metrics
+
+
+def create_database(config: Config, metrics: Metrics) -> Database:
+    return Database(
+        config.dsn, logging.getLogger('Database'), config.db_pool_min, config.db_pool_max, metrics,
+        config.user_cache_size, config.migrations
+    )
+
+
+def create_update_manager(config: Config, database: Database, metrics: Metrics) -> UpdateManager:
+    """Return the update manager fetching the feeds over a shared session with the DNS cache."""
+    # pylint: disable=import-outside-toplevel
+    from feedparser import USER_AGENT
+    from http_client import DnsCache, create_session
+    from rss import RssReader
+    from update_manager import UpdateManager
+
+    http_session = create_session(USER_AGENT, config.http_pool_hosts, config.per_host_limit, DnsCache(config.dns_cache_ttl))
+    rss_reader = RssReader(
+        logging.getLogger('RssReader'), config.fetch_timeout, config.fetch_max_size, config.feed_max_items,
+        config.feed_max_age, http_session, config.fetch_connect_timeout, metrics
+    )
+    return UpdateManager(
+        database, rss_reader, logging.getLogger('UpdateManager'), config.workers, config.per_host_limit,
+        config.notify_edited, config.items_retention, config.batch_size, metrics
+    )
+
+
+def create_scheduler(config: Config, updater: UpdateManager) -> UpdateScheduler:
+    from scheduler import UpdateScheduler  # pylint: disable=import-outside-toplevel
+
+    return UpdateScheduler(
+        updater.database, updater, logging.getLogger('UpdateScheduler'), config.min_interval, config.max_interval
+    )
+
+
+def create_delivery_workers(config: Config, database: Database, metrics: Metrics, amount: int) -> list[DeliveryWorker]:
+    """Return the senders sharing the rate limits of the bot."""
+    # The Telegram client is only imported when it is used, which shortens the start of the --no-send runs
+    # pylint: disable=import-outside-toplevel
+    from delivery import DeliveryWorker
+    from rate_limiter import RateLimiter
+    from telegram import Notifier
+
+    rate_limiter = RateLimiter()
+    return [
+        DeliveryWorker(
+            database, Notifier(config.token, logging.getLogger('Notifier'), rate_limiter, metrics),
+            logging.getLogger('DeliveryWorker'), config.sender_batch_size
+        )
+        for _ in range(amount)
+    ]
+
+
+def create_async_delivery_worker(config: Config, database: Database, metrics: Metrics) -> AsyncDeliveryWorker:
+    # pylint: disable=import-outside-toplevel
+    from async_delivery import AsyncDeliveryWorker, AsyncNotifier
+    from rate_limiter import RateLimiter
+
+    notifier = AsyncNotifier(
+        config.token, logging.getLogger('Notifier'), RateLimiter(), metrics, config.sender_concurrency
+    )
+    return AsyncDeliveryWorker(database, notifier, logging.getLogger('DeliveryWorker'), config.sender_batch_size)
+
+
+def create_bot(
+        config: Config, database: Database, metrics: Metrics, url_checker: UrlChecker | None = None
+) -> tuple[CommandProcessor, WebhookServer | None]:
+    """Return the bot and the webhook server receiving its updates, which is None when the bot polls for them."""
+    # pylint: disable=import-outside-toplevel
+    from telegram import CommandProcessor
+    from webhook import WebhookServer
+
+    if not config.webhook_port:
+        return CommandProcessor(config.token, database, logging.getLogger('CommandProcessor'), url_checker=url_checker), None
+
+    # Updates are handled by the threads of the webhook server
+    bot = CommandProcessor(
+        config.token, database, logging.getLogger('CommandProcessor'), threaded=False, url_checker=url_checker
+    )
+    # Only Telegram should know the path, the secret is derived from the token unless set explicitly
+    webhook_path = '/' + (config.webhook_secret or hashlib.sha256(config.token.encode()).hexdigest()[:32])
+    webhook = WebhookServer(
+        bot, logging.getLogger('WebhookServer'), webhook_path, port=config.webhook_port, workers=config.webhook_workers,
+        queue_size=config.webhook_queue_size, metrics=metrics
+    )
+    if config.webhook_url:
+        bot.set_webhook(config.webhook_url.rstrip('/') + webhook_path, config.webhook_workers)
+    return bot, webhook
@@ -0,0 +1,281 @@
+import asyncio
+import heapq
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from logging import Logger
+from typing import Any
+import aiohttp
+from telebot import apihelper
+from telebot.apihelper import ApiException, ApiTelegramException
+
+from database import Database
+from delivery import DeliveryWorker, queue_deliveries
+from metrics import Metrics
+from rate_limiter import RateLimiter
+from rss import FeedItem
+from telegram import Notifier
+
+
+class AsyncNotifier(Notifier):
+    """Notifier which keeps many messages in flight at once instead of waiting for every request to finish.
+
+    Messages are queued and rendered the same way as by Notifier, but the sending methods are coroutines.
+    The messages of a chat are still sent one after another, so they arrive in order.
+    """
+
+    # Amount of messages being sent at the same time
+    CONCURRENCY: int = 30
+
+    def __init__(
+            self, token: str, logger: Logger, rate_limiter: RateLimiter | None = None, metrics: Metrics | None = None,
+            concurrency: int = CONCURRENCY, request_timeout: float = 30
+    ):
+        super().__init__(token, logger, rate_limiter, metrics)
+        self.log.debug('AsyncNotifier.__init__(concurrency=%d, request_timeout=%s)', concurrency, request_timeout)
+        self.token: str = token
+        self.concurrency: int = concurrency
+        self.request_timeout: float = request_timeout
+        self.__session: aiohttp.ClientSession | None = None
+
+    async def send_updates(self, chat_ids: list[int], updates: list[FeedItem], feed_title: str):
+        # pylint: disable=invalid-overridden-method
+        """Send notification about new items to the user"""
+        self.queue_updates(dict.fromkeys(chat_ids, self.DIGEST_OFF), updates, feed_title)
+        await self.send_queued()
+
+    async def send_queued(self, on_sent: Callable[[int], None] | None = None):
+        # pylint: disable=invalid-overridden-method
+        """Send the queued per-item and per-feed notifications.
+
+        on_sent is called with the chat ID once all messages of the chat are sent or rejected by Telegram.
+        """
+        self.log.debug('send_queued(on_sent=%s)', on_sent)
+        queues = self.take_queued()
+        if queues:
+            await self.__send_concurrently(queues, on_sent)
+
+    async def send_digests(self, on_sent: Callable[[int], None] | None = None):
+        # pylint: disable=invalid-overridden-method
+        """Send the queued notifications together with the digests of all feeds collected during the run."""
+        self.log.debug('send_digests(on_sent=%s)', on_sent)
+        self.queue_digests()
+        await self.send_queued(on_sent)
+
+    async def close(self):
+        """Close the connections to the Bot API."""
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def send_message(self, chat_id: int, text: str, parse_mode: str | None = None) -> dict:
+        """Send the message right away not taking the rate limits into account."""
+        return await self.__call('sendMessage', {'chat_id': chat_id, 'text': text, 'parse_mode': parse_mode})
+
+    async def __send_concurrently(
+            self, queues: dict[int, deque[tuple[str, str | None]]], on_sent: Callable[[int], None] | None
+    ):
+        """Send queued (text, parse mode) messages to the chats.
+
+        A chat is scheduled again when its previous message is sent, and at most `concurrency` chats
+        are sent to at the same time.
+        """
+        self.log.debug('__send_concurrently(queues=dict(%d), on_sent=%s)', len(queues), on_sent)
+        clock = self.rate_limiter.clock
+        ready_chats = [(clock(), index, chat_id) for index, chat_id in enumerate(queues)]
+        retries = dict.fromkeys(queues, 0)
+        sending: dict[asyncio.Task, tuple[int, int]] = {}
+
+        try:
+            while ready_chats or sending:
+                timeout = None
+                if ready_chats and len(sending) < self.concurrency:
+                    ready_at, index, chat_id = ready_chats[0]
+                    timeout = ready_at - clock()
+                    if timeout <= 0:
+                        heapq.heappop(ready_chats)
+                        self.metrics.inc('rate_limit_wait_seconds_total', await self.rate_limiter.acquire_async(chat_id))
+                        task = asyncio.create_task(self.__send_message(chat_id, queues[chat_id], retries))
+                        sending[task] = (index, chat_id)
+                        continue
+
+                if not sending:
+                    await asyncio.sleep(timeout)
+                    continue
+
+                done, _ = await asyncio.wait(sending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, chat_id = sending.pop(task)
+                    if not task.result():
+                        continue
+                    if queues[chat_id]:
+                        heapq.heappush(ready_chats, (clock() + self.rate_limiter.get_chat_delay(chat_id), index, chat_id))
+                    elif on_sent is not None:
+                        on_sent(chat_id)
+        finally:
+            for task in sending:
+                task.cancel()
+
+        self.log.debug('Total time spent waiting for rate limits: %.2f seconds', self.rate_limiter.slept)
+
+    async def __send_message(self, chat_id: int, queue: deque[tuple[str, str | None]], retries: dict[int, int]) -> bool:
+        """Send the first message of the queue and remove it from the queue unless it should be retried.
+
+        Return False if the chat is given up on, see Notifier.handle_send_error().
+        """
+        text, parse_mode = queue[0]
+        started = time.perf_counter()
+        try:
+            self.log.debug('Sending a message to chat_id=%s', chat_id)
+            await self.send_message(chat_id, text, parse_mode)
+            queue.popleft()
+            retries[chat_id] = 0
+            self.metrics.inc('messages_total', result='sent')
+        except (ApiException, aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            return self.handle_send_error(chat_id, queue, retries, exception)
+        finally:
+            self.metrics.observe('telegram_request_duration_seconds', time.perf_counter() - started)
+        return True
+
+    async def __call(self, method: str, params: dict) -> Any:
+        """Call the Bot API method at the URL configured for TeleBot and return its result."""
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        params = {name: value for name, value in params.items() if value is not None}
+        async with self.__session.post(apihelper.API_URL.format(self.token, method), json=params) as response:
+            try:
+                result_json = await response.json(content_type=None)
+            except ValueError:
+                result_json = None
+            if not isinstance(result_json, dict) or 'ok' not in result_json:
+                # Proxies answer with error pages, the message is retried like after a network error
+                raise ApiException(f'The server returned HTTP {response.status} {response.reason}', method, response)
+            if not result_json['ok']:
+                raise ApiTelegramException(method, response, result_json)
+            return result_json['result']
+
+
+class AsyncDeliveryWorker:
+    """Sends the updates queued in the database outbox from an event loop.
+
+    Works like DeliveryWorker, but the messages of a batch are sent concurrently by AsyncNotifier. The database
+    is used from a separate thread, so the event loop is never blocked by the queries.
+    """
+
+    def __init__(
+            self, database: Database, notifier: AsyncNotifier, logger: Logger, batch_size: int = 500,
+            poll_interval: float = 5, lease_time: timedelta = DeliveryWorker.LEASE_TIME,
+            retry_delay: timedelta = DeliveryWorker.RETRY_DELAY
+    ) -> None:
+        self.log: Logger = logger
+        self.log.debug(
+            'AsyncDeliveryWorker.__init__(database=%s, notifier=%s, logger=%s, batch_size=%d, poll_interval=%s, '
+            'lease_time=%s, retry_delay=%s)',
+            database, notifier, logger, batch_size, poll_interval, lease_time, retry_delay
+        )
+        self.database: Database = database
+        self.notifier: AsyncNotifier = notifier
+        self.batch_size: int = batch_size
+        self.poll_interval: float = poll_interval
+        self.lease_time: timedelta = lease_time
+        self.retry_delay: timedelta = retry_delay
+        self.__executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='DeliveryDatabase')
+        self.__stopped: bool = False
+        self.__finishing: bool = False
+        self.__wake_event: asyncio.Event | None = None
+
+    async def run(self) -> None:
+        """Keep sending the deliveries until stop() is called or finish() is called and the outbox is empty."""
+        self.log.info('Starting the async delivery worker')
+        self.__wake_event = asyncio.Event()
+        try:
+            while not self.__stopped:
+                try:
+                    if await self.send_batch():
+                        continue
+                except Exception:  # pylint: disable=broad-except
+                    # The deliveries left are sent again after their lease expires
+                    self.log.exception('Unable to send a batch of deliveries')
+                if self.__finishing:
+                    break
+                self.__wake_event.clear()
+                try:
+                    await asyncio.wait_for(self.__wake_event.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.notifier.close()
+
+        self.log.info(
+            'Delivery worker stopped. Rendered messages: %d, render cache hits: %d, sanitizer calls: %d, '
+            'sanitizer time: %.3f s, rate limit waits: %.3f s',
+            self.notifier.render_cache_misses, self.notifier.render_cache_hits,
+            self.notifier.sanitizer_calls, self.notifier.sanitizer_time, self.notifier.rate_limiter.slept
+        )
+
+    def stop(self) -> None:
+        """Request the worker to stop after the current batch."""
+        self.__stopped = True
+        self.wake()
+
+    def finish(self) -> None:
+        """Request the worker to stop as soon as there is nothing to send."""
+        self.__finishing = True
+        self.wake()
+
+    def wake(self) -> None:
+        """Check the outbox without waiting for the poll interval, e.g. when new updates are queued."""
+        if self.__wake_event is not None:
+            self.__wake_event.set()
+
+    async def send_pending(self) -> int:
+        """Send all pending deliveries and return their amount."""
+        sent = 0
+        try:
+            while batch_size := await self.send_batch():
+                sent += batch_size
+        finally:
+            await self.notifier.close()
+        return sent
+
+    async def send_batch(self) -> int:
+        """Send a batch of deliveries and return its size."""
+        deliveries = await self.__run_in_database_thread(self.database.claim_deliveries, self.batch_size, self.lease_time)
+        if not deliveries:
+            return 0
+        started = time.perf_counter()
+        self.log.debug('Claimed %d deliveries', len(deliveries))
+
+        pending = queue_deliveries(self.notifier, deliveries)
+        leased_at = time.monotonic()
+        # The queries are queued to the database thread, so the sending goes on while they run
+        queries: list[Future] = []
+
+        def on_sent(chat_id: int) -> None:
+            nonlocal leased_at
+            queries.append(self.__executor.submit(self.database.delete_deliveries, pending.pop(chat_id)))
+            if pending and time.monotonic() - leased_at > self.lease_time.total_seconds() / 2:
+                keys = [key for chat_keys in pending.values() for key in chat_keys]
+                queries.append(self.__executor.submit(self.database.lock_deliveries, keys, self.lease_time))
+                leased_at = time.monotonic()
+
+        try:
+            await self.notifier.send_digests(on_sent)
+            if pending:
+                self.log.warning('Postponing the deliveries to %d chats for %s', len(pending), self.retry_delay)
+                keys = [key for chat_keys in pending.values() for key in chat_keys]
+                queries.append(self.__executor.submit(self.database.lock_deliveries, keys, self.retry_delay))
+        finally:
+            await asyncio.gather(*(asyncio.wrap_future(query) for query in queries))
+
+        self.notifier.metrics.observe('delivery_batch_duration_seconds', time.perf_counter() - started)
+        self.notifier.metrics.inc('deliveries_total', len(deliveries) - sum(len(keys) for keys in pending.values()))
+        return len(deliveries)
+
+    async def __run_in_database_thread(self, function: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, function, *args)
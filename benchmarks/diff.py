@@ -0,0 +1,74 @@
+"""Compare the feed diff implementations on synthetic feeds.
+
+Usage: python -m benchmarks.diff
+"""
+import timeit
+
+from feedparser import FeedParserDict
+
+from feed_diff import calculate_difference
+from rss import FeedItem
+
+
+SIZES = [10, 100, 1000, 10000]
+# Share of items which are new in the current version of the feed
+CHURN = 0.1
+
+
+def legacy_calculate_difference(new_items: list[FeedItem], old_items: list[dict]) -> list[FeedItem]:
+    """List-based implementation which was used by UpdateManager before."""
+    if not old_items:
+        return new_items
+
+    diff = []
+    guids = [item['guid'] for item in old_items if item['guid']]
+    urls = [item['url'] for item in old_items]
+
+    for item in new_items:
+        if not guids and item.url not in urls:
+            diff.append(item)
+            continue
+        if item.guid not in guids:
+            diff.append(item)
+
+    return diff
+
+
+def make_items(start: int, amount: int) -> list[FeedItem]:
+    return [
+        FeedItem(FeedParserDict(
+            link=f'https://example.com/posts/{i}',
+            title=f'Post #{i}',
+            summary=f'<p>Content of the post #{i}</p>',
+            id=f'urn:uuid:{i:08d}',
+        ))
+        for i in range(start, start + amount)
+    ]
+
+
+def make_old_items(items: list[FeedItem]) -> list[dict]:
+    return [{'feed_id': 1, 'url': item.url, 'guid': item.guid, 'hash': item.hash} for item in items]
+
+
+def measure(function, new_items: list[FeedItem], old_items: list[dict]) -> float:
+    timer = timeit.Timer(lambda: function(new_items, old_items))
+    loops, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=loops)) / loops
+
+
+def main() -> None:
+    print(f'{"items":>8} {"legacy, ms":>12} {"current, ms":>12} {"speedup":>8}')
+    for size in SIZES:
+        shift = max(1, int(size * CHURN))
+        old_items = make_old_items(make_items(0, size))
+        new_items = make_items(shift, size)
+
+        assert len(legacy_calculate_difference(new_items, old_items)) == len(calculate_difference(new_items, old_items).new)
+
+        legacy = measure(legacy_calculate_difference, new_items, old_items)
+        current = measure(calculate_difference, new_items, old_items)
+        print(f'{size:>8} {legacy * 1000:>12.3f} {current * 1000:>12.3f} {legacy / current:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Compare memory footprint and creation time of the feed item implementations.
+
+The footprint is the memory allocated by the items and retained after the parsed entries are released,
+which is what the update keeps while the feeds of a batch are processed. Strings of the entries are shared
+by both implementations, so they are not counted.
+
+Usage: python -m benchmarks.feed_items
+"""
+import gc
+import hashlib
+import timeit
+import tracemalloc
+from datetime import datetime
+from time import mktime
+
+from feedparser import FeedParserDict, parse
+
+from rss import FeedItem
+
+
+SIZES = [1000, 10000]
+
+
+class LegacyFeedItem:
+    """Implementation which was used before: a plain object with the date converted eagerly."""
+
+    def __init__(self, item: FeedParserDict) -> None:
+        self.url = item.get('link', '')
+        self.title = item.get('title', '')
+        self.description = item.get('summary', '')
+        self.guid = item.get('id', '')
+        if 'updated' in item:
+            self.date = datetime.fromtimestamp(mktime(item.updated_parsed))
+        elif 'published' in item:
+            self.date = datetime.fromtimestamp(mktime(item.published_parsed))
+        else:
+            self.date = None
+        self.hash = hashlib.sha1('\0'.join((self.url, self.title, self.description)).encode()).hexdigest()
+
+
+def make_entries(amount: int) -> list[FeedParserDict]:
+    items = ''.join(
+        f'<item><title>Post #{i}</title><link>https://example.com/posts/{i}</link><guid>urn:uuid:{i:08d}</guid>'
+        f'<description>&lt;p&gt;{"Content of the post. " * 10}&lt;/p&gt;</description>'
+        f'<pubDate>Mon, 06 Sep 2021 16:45:00 GMT</pubDate></item>'
+        for i in range(amount)
+    )
+    return parse(f'<rss version="2.0"><channel><title>Feed</title>{items}</channel></rss>').entries
+
+
+def measure_footprint(item_class, amount: int, read_dates: bool) -> float:
+    """Return the memory in bytes retained per item."""
+    entries = make_entries(amount)
+    gc.collect()
+    tracemalloc.start()
+    items = [item_class(entry) for entry in entries]
+    if read_dates:
+        for item in items:
+            _ = item.date
+    del entries
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return retained / amount
+
+
+def measure_creation(item_class, entries: list[FeedParserDict]) -> float:
+    """Return the time in microseconds needed to create an item."""
+    timer = timeit.Timer(lambda: [item_class(entry) for entry in entries])
+    return min(timer.repeat(repeat=5, number=1)) / len(entries) * 1000000
+
+
+def main() -> None:
+    print(f'{"items":>6} {"implementation":>15} {"bytes/item":>11} {"with dates":>11} {"create, us":>11}')
+    for amount in SIZES:
+        entries = make_entries(amount)
+        for name, item_class in (('legacy', LegacyFeedItem), ('slotted', FeedItem)):
+            footprint = measure_footprint(item_class, amount, False)
+            footprint_with_dates = measure_footprint(item_class, amount, True)
+            creation = measure_creation(item_class, entries)
+            print(f'{amount:>6} {name:>15} {footprint:>11.0f} {footprint_with_dates:>11.0f} {creation:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Compare reading of large feeds by feedparser and by the streaming reader.
+
+Feeds are served by a local HTTP server. The streaming reader is measured both for a feed seen for the first
+time and for a feed which was read before, when the reading stops at the known items.
+
+Usage: python -m benchmarks.feed_reading
+"""
+import logging
+import time
+import tracemalloc
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import requests
+from feedparser import parse
+
+from rss import Feed, RssReader
+
+
+SIZES = [100, 1000, 10000]
+# Items published since the previous reading of the feed
+NEW_ITEMS = 5
+
+
+def make_feed(amount: int) -> bytes:
+    items = ''.join(
+        f'<item><title>Post #{i}</title><link>https://example.com/posts/{i}</link><guid>urn:uuid:{i:08d}</guid>'
+        f'<description>&lt;p&gt;{"Content of the post. " * 50}&lt;/p&gt;</description>'
+        f'<pubDate>Mon, 06 Sep 2021 16:45:00 GMT</pubDate></item>'
+        for i in range(amount, 0, -1)
+    )
+    header = '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>Feed</title>'
+    return f'{header}{items}</channel></rss>'.encode()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    documents: dict[str, bytes] = {}
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        document = self.documents[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(document)))
+        self.end_headers()
+        try:
+            self.wfile.write(document)
+        except ConnectionError:
+            # The streaming reader closes the connection as soon as it has read enough
+            pass
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+def read_by_feedparser(url: str) -> Feed:
+    """The way the feeds were read before: the whole document is downloaded and parsed."""
+    response = requests.get(url, timeout=30)
+    return Feed(url, parse(response.content, response_headers={'content-location': url}))
+
+
+def measure(function) -> tuple[float, float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    feed = function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, len(feed.items)
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    reader = RssReader(logging.getLogger('RssReader'))
+
+    print(f'{"items":>6} {"size, MB":>9} {"reader":>14} {"time, ms":>9} {"peak, MB":>9} {"read items":>11}')
+    for size in SIZES:
+        FeedHandler.documents[f'/{size}'] = make_feed(size)
+        url = f'http://127.0.0.1:{server.server_port}/{size}'
+        known_keys = {f'urn:uuid:{i:08d}' for i in range(1, size - NEW_ITEMS + 1)}
+        readers = {
+            'feedparser': partial(read_by_feedparser, url),
+            'stream, new': partial(reader.get_feed, url),
+            'stream, known': partial(reader.get_feed, url, known_keys=known_keys),
+        }
+        for name, function in readers.items():
+            elapsed, peak, items = measure(function)
+            document_size = len(FeedHandler.documents[f'/{size}']) / 1024 / 1024
+            print(f'{size:>6} {document_size:>9.2f} {name:>14} {elapsed * 1000:>9.1f} {peak:>9.2f} {items:>11}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
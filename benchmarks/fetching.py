@@ -0,0 +1,98 @@
+"""Compare feed downloading with a new connection per feed and with the shared HTTP session.
+
+Feeds are served by a local HTTP/1.1 server, which delays every new connection to simulate the TCP and TLS
+handshakes with a remote host.
+
+Usage: python -m benchmarks.fetching
+"""
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+import requests
+from feedparser import USER_AGENT
+
+from http_client import DnsCache, create_session
+from rss import RssReader
+
+
+FEEDS = 200
+WORKERS = 8
+# Round trips of TCP and TLS 1.2 handshakes with a host 25 ms away
+HANDSHAKE_DELAY = 0.075
+DOCUMENT = (
+    '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>Feed</title>'
+    + ''.join(f'<item><title>Post #{i}</title><guid>urn:uuid:{i:08d}</guid></item>' for i in range(20))
+    + '</channel></rss>'
+).encode()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    connections_lock = Lock()
+
+    def setup(self) -> None:
+        with self.connections_lock:
+            FeedHandler.connections += 1
+        time.sleep(HANDSHAKE_DELAY)
+        super().setup()
+        # Headers and body are written separately, which is delayed by Nagle's algorithm on reused connections
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(DOCUMENT)))
+        self.end_headers()
+        self.wfile.write(DOCUMENT)
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+class NewConnectionSession:
+    """The way the feeds were downloaded before: every request opens a new connection."""
+
+    @staticmethod
+    def get(url: str, timeout: float | tuple[float, float], **kwargs) -> requests.Response:
+        return requests.get(url, timeout=timeout, **kwargs)
+
+
+def measure(reader: RssReader, urls: list[str]) -> tuple[float, int]:
+    FeedHandler.connections = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for feed in executor.map(reader.get_feed, urls):
+            assert len(feed.items) == 20
+    return time.perf_counter() - start, FeedHandler.connections
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    # Two host names of the same server, like the feeds of a few popular hosts
+    urls = [f'http://{host}:{server.server_port}/{i}' for i in range(FEEDS // 2) for host in ('127.0.0.1', 'localhost')]
+
+    logger = logging.getLogger('RssReader')
+    dns_cache = DnsCache()
+    readers = {
+        'new connection': RssReader(logger, session=NewConnectionSession()),
+        'shared session': RssReader(logger, session=create_session(USER_AGENT, 100, WORKERS, dns_cache)),
+    }
+
+    print(f'{"feeds":>6} {"reader":>15} {"time, ms":>9} {"connections":>12}')
+    for name, reader in readers.items():
+        elapsed, connections = measure(reader, urls)
+        print(f'{FEEDS:>6} {name:>15} {elapsed * 1000:>9.1f} {connections:>12}')
+    print(f'DNS cache hits: {dns_cache.hits}, misses: {dns_cache.misses}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
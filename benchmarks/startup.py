@@ -0,0 +1,142 @@
+"""Measure the start time of the entry scripts.
+
+The imports made at the top level of every script are timed in a fresh interpreter with `-X importtime`, which
+is what every run of the script pays before doing anything. The components are imported by the factories of
+app.py when they are built, so the imports of the factories the script always calls are timed too. The modules
+imported by the interpreter itself are not counted. The packages taking most of the time are reported too, with
+the time of all their modules.
+When RSSBOT_BENCHMARK_DSN is set, the initialization of the database is timed with the migrations applied
+and only checked.
+
+Usage: python -m benchmarks.startup [--runs 5]
+"""
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+
+SCRIPTS = ['bot.py', 'update.py', 'send.py', 'main.py']
+# Module building the components of the scripts
+FACTORIES = 'app.py'
+# Slowest packages reported for every script
+TOP_PACKAGES = 5
+DATABASE_INIT = (
+    'import logging, time\n'
+    'started = time.perf_counter()\n'
+    'from database import Database\n'
+    'Database({dsn!r}, logging.getLogger("Database"), migrations={migrations!r})\n'
+    'print(time.perf_counter() - started)\n'
+)
+
+
+def parse(path: str) -> ast.Module:
+    with open(path, encoding='utf-8') as file:
+        return ast.parse(file.read(), path)
+
+
+def get_imports(script: str) -> str:
+    """Return the import statements made at the top level of the script and by the factories it always calls."""
+    module = parse(script)
+    statements = [statement for statement in module.body if isinstance(statement, (ast.Import, ast.ImportFrom))]
+    # Calls made in the branches of the script depend on its arguments
+    called = {
+        node.func.id
+        for statement in module.body if isinstance(statement, (ast.Assign, ast.Expr))
+        for node in ast.walk(statement) if isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+    }
+    for function in parse(FACTORIES).body:
+        if isinstance(function, ast.FunctionDef) and function.name in called:
+            statements.extend(
+                node for node in ast.walk(function) if isinstance(node, (ast.Import, ast.ImportFrom))
+            )
+    return '\n'.join(ast.unparse(statement) for statement in statements)
+
+
+def run_imports(code: str) -> tuple[float, list[tuple[int, int, str]]]:
+    """Run the code in a new interpreter and return the wall time and the (self, cumulative, module) import times."""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True
+    )
+    wall_time = time.perf_counter() - started
+
+    imports = []
+    # Lines look like "import time:       123 |       4567 |   package.module", nested imports are indented
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        # Only the first space separates the columns, the rest is the nesting
+        imports.append((int(self_time), int(cumulative), name[1:].rstrip()))
+    return wall_time, imports
+
+
+def measure_imports(code: str, startup_modules: set[str]) -> tuple[float, float, dict[str, float]]:
+    """Return the wall time, the import time and the time per top-level package of the code in seconds."""
+    wall_time, imports = run_imports(code)
+    total = 0.0
+    packages: dict[str, float] = defaultdict(float)
+    for self_time, cumulative, name in imports:
+        module = name.strip()
+        if module in startup_modules:
+            continue
+        if not name.startswith(' '):
+            total += cumulative / 1e6
+        packages[module.split('.')[0]] += self_time / 1e6
+    return wall_time, total, packages
+
+
+def measure_database(dsn: str, migrations: str) -> float:
+    result = subprocess.run(
+        [sys.executable, '-c', DATABASE_INIT.format(dsn=dsn, migrations=migrations)],
+        capture_output=True, text=True, check=True
+    )
+    return float(result.stdout)
+
+
+def measure_script(script: str, runs: int, startup_modules: set[str]) -> tuple[float, float, list[tuple[float, str]]]:
+    """Return the median import time, wall time and the slowest (time, package) of the script in seconds."""
+    code = get_imports(script)
+    wall_times, import_times = [], []
+    packages: dict[str, list[float]] = defaultdict(list)
+    for _ in range(runs):
+        wall_time, import_time, run_packages = measure_imports(code, startup_modules)
+        wall_times.append(wall_time)
+        import_times.append(import_time)
+        for name, package_time in run_packages.items():
+            packages[name].append(package_time)
+
+    slowest = sorted(((statistics.median(times), name) for name, times in packages.items()), reverse=True)
+    return statistics.median(import_times), statistics.median(wall_times), slowest[:TOP_PACKAGES]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure the start time of the entry scripts.')
+    parser.add_argument('--runs', type=int, default=5, help='runs of every measurement, the median is reported')
+    args = parser.parse_args()
+
+    startup_modules = {name.strip() for _, _, name in run_imports('pass')[1]}
+
+    print(f'{"script":>10} {"imports, ms":>12} {"wall, ms":>9}  slowest packages, ms')
+    for script in SCRIPTS:
+        import_time, wall_time, slowest = measure_script(script, args.runs, startup_modules)
+        print(
+            f'{script:>10} {import_time * 1000:>12.1f} {wall_time * 1000:>9.1f}  '
+            + ', '.join(f'{name} {package_time * 1000:.0f}' for package_time, name in slowest)
+        )
+
+    dsn = os.getenv('RSSBOT_BENCHMARK_DSN')
+    if dsn:
+        print(f'\n{"migrations":>10} {"database init, ms":>18}')
+        for migrations in ['apply', 'check']:
+            elapsed = statistics.median(measure_database(dsn, migrations) for _ in range(args.runs))
+            print(f'{migrations:>10} {elapsed * 1000:>18.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""Local stand-ins for the feed hosts and the Telegram Bot API used by the benchmarks.
+
+Both servers are controlled over HTTP under /control/, so they can be shared by benchmark scenarios running in
+other processes.
+"""
+import json
+import re
+import socket
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Lock, Thread
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        super().setup()
+        # Headers and body are written separately, which is delayed by Nagle's algorithm on reused connections
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self) -> None:
+        try:
+            super().handle()
+        except ConnectionError:
+            # Clients close their idle keep-alive connections when they finish
+            pass
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self.server.stub.handle(self)
+
+    do_POST = do_GET
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send(self, status: int, body: bytes = b'', headers: dict[str, str] | None = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data) -> None:
+        self.send(200, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+class StubServer:
+    """HTTP server running in a background thread."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        # Delay of every response in seconds, to simulate a remote server
+        self.latency: float = latency
+        self.__server: ThreadingHTTPServer | None = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.__server.server_port}'
+
+    def start(self) -> None:
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), StubRequestHandler)
+        self.__server.daemon_threads = True
+        self.__server.request_queue_size = 128
+        self.__server.stub = self
+        Thread(target=self.__server.serve_forever, name=type(self).__name__, daemon=True).start()
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def handle(self, request: StubRequestHandler) -> None:
+        raise NotImplementedError
+
+
+class FeedServer(StubServer):
+    """Serves synthetic feeds at /feeds/<number>.xml, even feeds in RSS 2.0 and odd feeds in Atom.
+
+    Every feed contains the same amount of items ordered from the newest. POST /control/advance publishes
+    new items in a share of the feeds, the other feeds keep their ETags and are answered with 304 Not Modified.
+    """
+
+    PATH = re.compile(r'^/feeds/(\d+)\.xml$')
+    # Date of the first item of every feed, the next items are published a minute apart
+    FIRST_ITEM_DATE: float = 1600000000
+
+    def __init__(
+            self, items: int = 20, item_size: int = 500, new_items: int = 2, changing_share: float = 0.2,
+            latency: float = 0.0
+    ) -> None:
+        super().__init__(latency)
+        self.items: int = items
+        self.item_size: int = item_size
+        self.new_items: int = new_items
+        self.changing_share: float = changing_share
+        self.epoch: int = 0
+        self.stats: Counter = Counter()
+        self.__lock: Lock = Lock()
+
+    def feed_url(self, number: int) -> str:
+        return f'{self.url}/feeds/{number}.xml'
+
+    def handle(self, request: StubRequestHandler) -> None:
+        path = urlsplit(request.path).path
+        if path == '/control/advance':
+            request.read_body()
+            self.epoch += 1
+            request.send_json({'epoch': self.epoch})
+            return
+        if path == '/control/stats':
+            with self.__lock:
+                request.send_json(dict(self.stats))
+            return
+
+        match = self.PATH.match(path)
+        if match is None:
+            request.send(404)
+            return
+
+        time.sleep(self.latency)
+        number = int(match.group(1))
+        first_item = self.__get_first_item(number)
+        etag = f'"{number}-{first_item}"'
+        if request.headers.get('If-None-Match') == etag:
+            self.__count(not_modified=1)
+            request.send(304, headers={'ETag': etag})
+            return
+
+        body = self.__render(number, first_item).encode()
+        self.__count(responses=1, bytes=len(body))
+        content_type = 'application/atom+xml' if number % 2 else 'application/rss+xml'
+        request.send(200, body, {'Content-Type': f'{content_type}; charset=utf-8', 'ETag': etag})
+
+    def __get_first_item(self, number: int) -> int:
+        if number % 100 < self.changing_share * 100:
+            return self.epoch * self.new_items
+        return 0
+
+    def __render(self, number: int, first_item: int) -> str:
+        filler = ('Lorem ipsum dolor sit amet. ' * (self.item_size // 28 + 1))[:self.item_size]
+        indexes = range(first_item + self.items - 1, first_item - 1, -1)
+        url = f'{self.url}/posts/{number}'
+        if number % 2:
+            entries = ''.join(
+                f'<entry><title>Post #{i}</title><link href="{url}/{i}"/><id>{url}/{i}</id>'
+                f'<updated>{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.FIRST_ITEM_DATE + i * 60))}</updated>'
+                f'<summary>{filler}</summary></entry>'
+                for i in indexes
+            )
+            return (
+                f'<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                f'<title>Feed #{number}</title>{entries}</feed>'
+            )
+
+        items = ''.join(
+            f'<item><title>Post #{i}</title><link>{url}/{i}</link><guid>{url}/{i}</guid>'
+            f'<pubDate>{formatdate(self.FIRST_ITEM_DATE + i * 60, usegmt=True)}</pubDate>'
+            f'<description>{filler}</description></item>'
+            for i in indexes
+        )
+        return (
+            f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+            f'<title>Feed #{number}</title>{items}</channel></rss>'
+        )
+
+    def __count(self, **values: int) -> None:
+        with self.__lock:
+            self.stats.update(values)
+
+
+class TelegramStub(StubServer):
+    """Accepts the Bot API calls made by TeleBot and answers them locally.
+
+    Messages posted to /control/updates are handed out to the bot by getUpdates. Messages posted to
+    /control/webhook are sent to the webhook of the bot like Telegram does: over several connections, repeating
+    the rejected updates. The time from handing out a message to receiving the reply to it is recorded as
+    the command latency.
+    """
+
+    PATH = re.compile(r'^/bot[^/]+/(\w+)$')
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__(latency)
+        self.methods: Counter = Counter()
+        self.command_latencies: list[float] = []
+        self.__updates: deque[dict] = deque()
+        self.__dispatched: dict[int, float] = {}
+        self.__pushing: int = 0
+        self.__last_id: int = 0
+        self.__condition: Condition = Condition()
+
+    def handle(self, request: StubRequestHandler) -> None:
+        parts = urlsplit(request.path)
+        if parts.path == '/control/updates':
+            self.__queue_messages(json.loads(request.read_body()))
+            request.send_json({'ok': True})
+            return
+        if parts.path == '/control/webhook':
+            data = json.loads(request.read_body())
+            with self.__condition:
+                updates = [self.__make_update(message) for message in data['messages']]
+                self.__pushing += len(updates)
+            Thread(target=self.__push_updates, args=(data['url'], data['connections'], updates), daemon=True).start()
+            request.send_json({'ok': True})
+            return
+        if parts.path == '/control/stats':
+            with self.__condition:
+                request.send_json({
+                    'methods': dict(self.methods),
+                    'pending': len(self.__updates) + self.__pushing + len(self.__dispatched),
+                    'command_latencies': self.command_latencies,
+                })
+            return
+
+        match = self.PATH.match(parts.path)
+        if match is None:
+            request.send(404)
+            return
+
+        method = match.group(1)
+        params = dict(parse_qsl(parts.query))
+        body = request.read_body()
+        if request.headers.get('Content-Type', '').startswith('application/json'):
+            params.update(json.loads(body))
+        elif body:
+            params.update(parse_qsl(body.decode()))
+
+        if method == 'getUpdates':
+            result = self.__get_updates(float(params.get('timeout', 0)), int(params.get('limit', 100)))
+        else:
+            time.sleep(self.latency)
+            result = self.__call(method, params)
+        request.send_json({'ok': True, 'result': result})
+
+    def __call(self, method: str, params: dict) -> dict | bool:
+        with self.__condition:
+            self.methods[method] += 1
+            if method == 'getMe':
+                return self.BOT_USER
+            if method != 'sendMessage':
+                return True
+            reply_to = int(params.get('reply_to_message_id', 0))
+            if reply_to in self.__dispatched:
+                self.command_latencies.append(time.perf_counter() - self.__dispatched.pop(reply_to))
+            self.__last_id += 1
+            return {
+                'message_id': self.__last_id, 'date': int(time.time()), 'from': self.BOT_USER,
+                'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params.get('text', ''),
+            }
+
+    def __make_update(self, message: dict) -> dict:
+        self.__last_id += 1
+        command = message['text'].split()[0]
+        return {
+            'update_id': self.__last_id,
+            'message': {
+                'message_id': self.__last_id, 'date': int(time.time()), 'text': message['text'],
+                'chat': {'id': message['chat_id'], 'type': 'private'},
+                'from': {'id': message['chat_id'], 'is_bot': False, 'first_name': 'User'},
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+            },
+        }
+
+    def __queue_messages(self, messages: list[dict]) -> None:
+        with self.__condition:
+            self.__updates.extend(self.__make_update(message) for message in messages)
+            self.__condition.notify_all()
+
+    def __push_updates(self, url: str, connections: int, updates: list[dict]) -> None:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            for _ in executor.map(lambda update: self.__push_update(url, update), updates):
+                pass
+
+    def __push_update(self, url: str, update: dict) -> None:
+        with self.__condition:
+            self.__dispatched[update['message']['message_id']] = time.perf_counter()
+            self.__pushing -= 1
+        while True:
+            try:
+                response = requests.post(url, json=update, timeout=30)
+                if response.status_code != 503:
+                    return
+                time.sleep(int(response.headers.get('Retry-After', 1)))
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+    def __get_updates(self, timeout: float, limit: int) -> list[dict]:
+        with self.__condition:
+            # Long polling, shortened to let the bot notice that it is stopped
+            self.__condition.wait_for(lambda: self.__updates, min(timeout, 1))
+            updates = [self.__updates.popleft() for _ in range(min(limit, len(self.__updates)))]
+            now = time.perf_counter()
+            for update in updates:
+                self.__dispatched[update['message']['message_id']] = now
+            return updates
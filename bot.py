@@ -1,25 +1,17 @@
-import logging
-import os
-from dotenv import load_dotenv
+import signal
 
-from database import Database
-from telegram import CommandProcessor
+from app import Config, create_bot, create_database, create_metrics, setup_logging
 
 
-load_dotenv()
+config = Config()
+setup_logging(config, 'the bot')
+metrics = create_metrics(config)
+db = create_database(config, metrics)
+bot, webhook = create_bot(config, db, metrics)
 
-token = os.getenv('RSSBOT_TG_TOKEN')
-dsn = os.getenv('RSSBOT_DSN')
-log_level = os.getenv('LOG_LEVEL', 'INFO')
-
-print('Starting the bot with logging level', log_level.upper())
-logging.basicConfig(
-    level=log_level.upper(),
-    format='%(asctime)s: <%(name)s> [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-)
-
-db = Database(dsn, logging.getLogger('Database'))
-bot = CommandProcessor(token, db, logging.getLogger('CommandProcessor'))
-
-bot.run()
+if webhook is None:
+    bot.run()
+else:
+    signal.signal(signal.SIGTERM, lambda signum, frame: webhook.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: webhook.stop())
+    webhook.run()
@@ -0,0 +1,50 @@
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from threading import Lock
+from typing import Any
+
+
+class LruCache:
+    """Bounded thread-safe mapping which drops the least recently used entries.
+
+    Entries could also expire after the TTL, for data which might be changed by other processes.
+    """
+
+    def __init__(self, max_size: int, ttl: float | None = None, clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_size: int = max_size
+        self.ttl: float | None = ttl
+        self.clock: Callable[[], float] = clock
+        self.hits: int = 0
+        self.misses: int = 0
+        self.__entries: OrderedDict[Hashable, tuple[float | None, Any]] = OrderedDict()
+        self.__lock: Lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the value of the key, or the default if it is missing or expired."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] <= self.clock()):
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        with self.__lock:
+            self.__entries[key] = (expires, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
@@ -1,143 +1,480 @@
+from __future__ import annotations
+
+import os
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import timedelta
 from logging import Logger
-import psycopg2
+from threading import BoundedSemaphore, local
+from typing import TYPE_CHECKING
+from psycopg2 import ProgrammingError
+from psycopg2.errorcodes import UNDEFINED_TABLE
 from psycopg2.extensions import connection
-from psycopg2.extras import DictCursor, DictRow
-from yoyo import get_backend, read_migrations
+from psycopg2.extras import DictCursor, DictRow, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from cache import LruCache
 from exceptions import DisplayableException
-from rss import FeedItem
+from feed_url import get_url_key
+from metrics import Metrics
+
+if TYPE_CHECKING:
+    # Only used in the annotations, the bot does not need the feed parser
+    from feed_diff import FeedDiff
+    from rss import FeedItem
+
+
+class MeasuredCursor(DictCursor):
+    """Cursor measuring the duration of every statement by its type."""
+
+    metrics: Metrics | None = None
+
+    def execute(self, query, vars=None):  # pylint: disable=redefined-builtin
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.__observe(query, started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.__observe(query, started)
+
+    def __observe(self, query: str | bytes, started: float) -> None:
+        if self.metrics is None:
+            return
+        if isinstance(query, bytes):
+            query = query[:16].decode(errors='replace')
+        words = query.split(None, 1)
+        statement = words[0].upper() if words else ''
+        self.metrics.observe('db_query_duration_seconds', time.perf_counter() - started, statement=statement)
 
 
 class Database:
     """Implement interaction with the database."""
 
-    def __init__(self, dsn: str, log: Logger) -> None:
+    # Amount of rows sent in a single statement by bulk queries
+    PAGE_SIZE: int = 1000
+    # Subscriptions could be changed by the updater merging the feeds, so they are cached for a limited time
+    USER_FEEDS_TTL: float = 60
+    MIGRATIONS_DIR: str = './migrations'
+    # Pending migrations are applied on start
+    MIGRATIONS_APPLY: str = 'apply'
+    # Only checks that all migrations are applied, which is much faster and does not lock the database
+    MIGRATIONS_CHECK: str = 'check'
+
+    def __init__(
+            self, dsn: str, log: Logger, min_connections: int = 1, max_connections: int = 10, metrics: Metrics | None = None,
+            cache_size: int = 10000, migrations: str = MIGRATIONS_APPLY
+    ) -> None:
         """Initialize the database"""
         self.log: Logger = log
-        self.log.debug('Database.__init__(DSN=\'%s\')', dsn)
-        self.conn: connection = psycopg2.connect(dsn)
-        self.cur: DictCursor = self.conn.cursor(cursor_factory=DictCursor)
-        self.__migrate(dsn)
+        self.log.debug(
+            'Database.__init__(DSN=\'%s\', min_connections=%d, max_connections=%d, metrics=%s, cache_size=%d, '
+            'migrations=%s)',
+            dsn, min_connections, max_connections, metrics, cache_size, migrations
+        )
+        self.metrics: Metrics = metrics if metrics is not None else Metrics()
+        # Users are never deleted, so their IDs are cached until evicted
+        self.__user_ids: LruCache = LruCache(cache_size)
+        self.__user_feeds: LruCache = LruCache(cache_size, self.USER_FEEDS_TTL)
+        self.pool: ThreadedConnectionPool = ThreadedConnectionPool(min_connections, max_connections, dsn)
+        # The pool raises an error when it is exhausted, so the threads wait for a free connection here instead.
+        self.__pool_semaphore: BoundedSemaphore = BoundedSemaphore(max_connections)
+        self.__local: local = local()
+        if migrations == self.MIGRATIONS_CHECK:
+            self.__check_migrations()
+        else:
+            self.__migrate(dsn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[DictCursor]:
+        """Provide a cursor in a transaction, which is committed on success and rolled back on exception.
+
+        Nested calls in the same thread join the outer transaction.
+        """
+        outer_cursor: DictCursor | None = getattr(self.__local, 'cursor', None)
+        if outer_cursor is not None:
+            yield outer_cursor
+            return
+
+        started = time.perf_counter()
+        with self.__pool_semaphore:
+            conn: connection = self.pool.getconn()
+            self.metrics.observe('db_connection_wait_seconds', time.perf_counter() - started)
+            try:
+                with conn, conn.cursor(cursor_factory=MeasuredCursor) as cur:
+                    cur.metrics = self.metrics
+                    self.__local.cursor = cur
+                    try:
+                        yield cur
+                    finally:
+                        self.__local.cursor = None
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+                self.metrics.observe('db_transaction_duration_seconds', time.perf_counter() - started)
+
+    def close(self) -> None:
+        """Close all connections."""
+        self.log.debug('close()')
+        self.pool.closeall()
 
     def add_user(self, telegram_id: int) -> int:
         """Add a user's telegram id to the database and return its database id."""
         self.log.debug('add_user(telegram_id=\'%s\')', telegram_id)
-        self.cur.execute('INSERT INTO users (telegram_id) VALUES (%s) RETURNING id', [telegram_id])
-        self.conn.commit()
-        return self.cur.fetchone()[0]
+        with self.transaction() as cur:
+            cur.execute('INSERT INTO users (telegram_id) VALUES (%s) RETURNING id', [telegram_id])
+            user_id = cur.fetchone()[0]
+        self.__user_ids.put(telegram_id, user_id)
+        return user_id
 
     def find_user(self, telegram_id: int) -> int | None:
         """Get a user's telegram id and return its database id."""
         self.log.debug('find_user(telegram_id=\'%s\')', telegram_id)
-        self.cur.execute('SELECT id FROM users WHERE telegram_id = %s', [telegram_id])
-        row = self.cur.fetchone()
-        if row is None:
-            return None
+        user_id = self.__get_cached('user_ids', self.__user_ids, telegram_id)
+        if user_id is not None:
+            return user_id
+
+        with self.transaction() as cur:
+            cur.execute('SELECT id FROM users WHERE telegram_id = %s', [telegram_id])
+            row = cur.fetchone()
+            if row is None:
+                return None
+        self.__user_ids.put(telegram_id, row['id'])
+        return row['id']
+
+    def find_or_add_user(self, telegram_id: int) -> int:
+        """Return the database id of the user, registering the user if needed."""
+        self.log.debug('find_or_add_user(telegram_id=\'%s\')', telegram_id)
+        user_id = self.__get_cached('user_ids', self.__user_ids, telegram_id)
+        if user_id is not None:
+            return user_id
+
+        with self.transaction() as cur:
+            query = (
+                'WITH inserted AS ('
+                '   INSERT INTO users (telegram_id) VALUES (%(telegram_id)s) ON CONFLICT DO NOTHING RETURNING id'
+                ') '
+                'SELECT id FROM inserted UNION ALL SELECT id FROM users WHERE telegram_id = %(telegram_id)s'
+            )
+            cur.execute(query, {'telegram_id': telegram_id})
+            row = cur.fetchone()
+            if row is None:
+                # The user was added by a concurrent transaction, which is visible to the next statement
+                cur.execute(query, {'telegram_id': telegram_id})
+                row = cur.fetchone()
+        self.__user_ids.put(telegram_id, row['id'])
         return row['id']
 
+    def get_user_digest_mode(self, user_id: int) -> str:
+        """Return the digest mode of the user."""
+        self.log.debug('get_user_digest_mode(user_id=\'%s\')', user_id)
+        with self.transaction() as cur:
+            cur.execute('SELECT digest_mode FROM users WHERE id = %s', [user_id])
+            return cur.fetchone()['digest_mode']
+
+    def set_user_digest_mode(self, user_id: int, digest_mode: str) -> None:
+        """Change the digest mode of the user."""
+        self.log.debug('set_user_digest_mode(user_id=\'%s\', digest_mode=\'%s\')', user_id, digest_mode)
+        with self.transaction() as cur:
+            cur.execute('UPDATE users SET digest_mode = %s WHERE id = %s', [digest_mode, user_id])
+
     def add_feed(self, url: str) -> int:
         """Add a feed to the database and return its id."""
         self.log.debug('add_feed(url=\'%s\')', url)
-        self.cur.execute('INSERT INTO feeds (url) VALUES (%s) RETURNING id', [url])
-        self.conn.commit()
-        return self.cur.fetchone()[0]
+        with self.transaction() as cur:
+            cur.execute('INSERT INTO feeds (url, url_key) VALUES (%s, %s) RETURNING id', [url, get_url_key(url)])
+            return cur.fetchone()[0]
 
     def find_feed_by_url(self, url: str) -> int | None:
-        """Find feed ID by url."""
+        """Find feed ID by url. URLs differing only in the scheme, trailing slash or tracking parameters are the same."""
         self.log.debug('find_feed_by_url(url=\'%s\')', url)
-        self.cur.execute('SELECT id FROM feeds WHERE url = %s', [url])
-        row = self.cur.fetchone()
-        if row is None:
-            return None
-        return row['id']
+        with self.transaction() as cur:
+            cur.execute('SELECT id FROM feeds WHERE url_key = %s', [get_url_key(url)])
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return row['id']
 
     def subscribe_user_by_url(self, user_id: int, url: str) -> None:
         """Subscribe user to the feed creating it if does not exist yet."""
         self.log.debug('subscribe_user_by_url(user_id=\'%s\', url=\'%s\')', user_id, url)
-        feed_id = self.find_feed_by_url(url)
-        if feed_id is None:
-            feed_id = self.add_feed(url)
+        parameters = {'user_id': user_id, 'url': url, 'url_key': get_url_key(url)}
+        query = (
+            'WITH existing AS (SELECT id FROM feeds WHERE url_key = %(url_key)s), '
+            'inserted AS ('
+            '   INSERT INTO feeds (url, url_key) SELECT %(url)s, %(url_key)s WHERE NOT EXISTS (SELECT 1 FROM existing)'
+            '   ON CONFLICT DO NOTHING RETURNING id'
+            '), '
+            'feed AS (SELECT id FROM existing UNION ALL SELECT id FROM inserted), '
+            'subscribed AS ('
+            '   INSERT INTO subscriptions (user_id, feed_id) SELECT %(user_id)s, id FROM feed'
+            '   ON CONFLICT DO NOTHING RETURNING feed_id'
+            ') '
+            'SELECT (SELECT id FROM feed) AS feed_id, (SELECT feed_id FROM subscribed) AS subscribed_feed_id'
+        )
+        with self.transaction() as cur:
+            cur.execute(query, parameters)
+            row = cur.fetchone()
+            if row['feed_id'] is None:
+                # The feed was added by a concurrent transaction, which is visible to the next statement
+                cur.execute(query, parameters)
+                row = cur.fetchone()
+        self.__user_feeds.pop(user_id)
 
-        if self.is_user_subscribed(user_id, feed_id):
+        if row['subscribed_feed_id'] is None:
             raise DisplayableException('Already subscribed')
 
-        self.subscribe_user(user_id, feed_id)
+    def subscribe_user_by_urls(self, user_id: int, urls: list[str]) -> list[str]:
+        """Subscribe user to several feeds creating the missing ones, return the URLs of the new subscriptions.
+
+        Feeds are created by one statement and subscribed to by another regardless of their amount.
+        """
+        self.log.debug('subscribe_user_by_urls(user_id=\'%s\', urls=list(%d))', user_id, len(urls))
+        urls_by_key = {get_url_key(url): url for url in urls}
+        if not urls_by_key:
+            return []
+
+        with self.transaction() as cur:
+            cur.execute(
+                'INSERT INTO feeds (url, url_key) SELECT * FROM unnest(%s::text[], %s::text[]) ON CONFLICT DO NOTHING',
+                [list(urls_by_key.values()), list(urls_by_key)]
+            )
+            # The feeds added by concurrent transactions are visible to the next statement
+            cur.execute(
+                'WITH subscribed AS ('
+                '   INSERT INTO subscriptions (user_id, feed_id) SELECT %s, id FROM feeds WHERE url_key = ANY(%s)'
+                '   ON CONFLICT DO NOTHING RETURNING feed_id'
+                ') '
+                'SELECT f.url_key FROM feeds f JOIN subscribed s ON s.feed_id = f.id',
+                [user_id, list(urls_by_key)]
+            )
+            subscribed_keys = {row['url_key'] for row in cur.fetchall()}
+        self.__user_feeds.pop(user_id)
+
+        return [url for url_key, url in urls_by_key.items() if url_key in subscribed_keys]
 
     def subscribe_user(self, user_id: int, feed_id: int) -> None:
         """Subscribe a user to the feed."""
         self.log.debug('subscribe_user(user_id=\'%s\', feed_id=\'%s\')', user_id, feed_id)
-        self.cur.execute('INSERT INTO subscriptions (user_id, feed_id) VALUES (%s, %s)', [user_id, feed_id])
-        self.conn.commit()
+        with self.transaction() as cur:
+            cur.execute('INSERT INTO subscriptions (user_id, feed_id) VALUES (%s, %s)', [user_id, feed_id])
+        self.__user_feeds.pop(user_id)
 
     def unsubscribe_user_by_url(self, user_id: int, url: str) -> None:
-        """Subscribe a user to the feed by url."""
+        """Unsubscribe a user from the feed by url. The feed is deleted when it has no subscribers left."""
         self.log.debug('unsubscribe_user_by_url(user_id=\'%s\', url=\'%s\')', user_id, url)
-        feed_id = self.find_feed_by_url(url)
-        if feed_id is None:
-            raise DisplayableException('Feed does not exist')
+        with self.transaction() as cur:
+            cur.execute(
+                'WITH feed AS (SELECT id FROM feeds WHERE url_key = %(url_key)s), '
+                'unsubscribed AS ('
+                '   DELETE FROM subscriptions s USING feed WHERE s.feed_id = feed.id AND s.user_id = %(user_id)s'
+                '   RETURNING s.feed_id'
+                '), '
+                # The subscription deleted by this statement is still visible to it
+                'deleted AS ('
+                '   DELETE FROM feeds f USING unsubscribed u WHERE f.id = u.feed_id AND NOT EXISTS ('
+                '       SELECT 1 FROM subscriptions s WHERE s.feed_id = f.id AND s.user_id <> %(user_id)s'
+                '   ) RETURNING f.id'
+                ') '
+                'SELECT (SELECT id FROM feed) AS feed_id, (SELECT feed_id FROM unsubscribed) AS unsubscribed_feed_id, '
+                '   (SELECT id FROM deleted) AS deleted_feed_id',
+                {'user_id': user_id, 'url_key': get_url_key(url)}
+            )
+            row = cur.fetchone()
+        self.__user_feeds.pop(user_id)
 
-        if not self.is_user_subscribed(user_id, feed_id):
+        if row['feed_id'] is None:
+            raise DisplayableException('Feed does not exist')
+        if row['unsubscribed_feed_id'] is None:
             raise DisplayableException('Not subscribed')
-
-        self.unsubscribe_user(user_id, feed_id)
-
-        if self.get_feed_subscribers_count(feed_id) == 0:
-            # Feed is not used anymore. Removing.
-            self.delete_feed(feed_id)
+        if row['deleted_feed_id'] is not None:
+            self.log.debug('Feed [%d] is not used anymore and was deleted', row['deleted_feed_id'])
 
     def unsubscribe_user(self, user_id: int, feed_id: int) -> None:
         """Unsubscribe a user from the feed."""
         self.log.debug('unsubscribe_user(user_id=\'%s\', feed_id=\'%s\')', user_id, feed_id)
-        self.cur.execute('DELETE FROM subscriptions WHERE feed_id = %s AND user_id = %s', [feed_id, user_id])
-        self.conn.commit()
+        with self.transaction() as cur:
+            cur.execute('DELETE FROM subscriptions WHERE feed_id = %s AND user_id = %s', [feed_id, user_id])
+        self.__user_feeds.pop(user_id)
 
     def is_user_subscribed(self, user_id: int, feed_id: int) -> bool:
         """Check if user subscribed to specific feed."""
         self.log.debug('is_user_subscribed(user_id=\'%s\', feed_id=\'%s\')', user_id, feed_id)
-        self.cur.execute('SELECT 1 FROM subscriptions WHERE user_id = %s AND feed_id = %s', [user_id, feed_id])
-        row = self.cur.fetchone()
-        if row is None:
-            return False
-        return True
+        with self.transaction() as cur:
+            cur.execute('SELECT 1 FROM subscriptions WHERE user_id = %s AND feed_id = %s', [user_id, feed_id])
+            row = cur.fetchone()
+            if row is None:
+                return False
+            return True
+
+    def move_feeds(self, urls: dict[int, str]) -> dict[int, int]:
+        """Change URLs of the feeds which moved permanently. Feeds moved to the URL of another feed are merged into it.
+
+        Return IDs of the merged feeds mapped to the IDs of the feeds they were merged into.
+        """
+        self.log.debug('move_feeds(urls=dict(%d))', len(urls))
+        with self.transaction() as cur:
+            keys = {feed_id: get_url_key(url) for feed_id, url in urls.items()}
+            cur.execute('SELECT id, url_key FROM feeds WHERE url_key = ANY(%s) FOR UPDATE', [list(keys.values())])
+            owners = {row['url_key']: row['id'] for row in cur.fetchall()}
+
+            merges: dict[int, int] = {}
+            moves = []
+            for feed_id, url in urls.items():
+                owner = owners.setdefault(keys[feed_id], feed_id)
+                if owner == feed_id:
+                    moves.append((feed_id, url, keys[feed_id]))
+                elif owner not in urls:
+                    merges[feed_id] = owner
+                # Otherwise the feed is moved to a feed which is moving itself, this is left for the next update
+
+            if merges:
+                self.__merge_feeds(cur, merges)
+            if moves:
+                execute_values(
+                    cur,
+                    'UPDATE feeds f SET url = v.url, url_key = v.url_key FROM (VALUES %s) AS v (id, url, url_key) '
+                    'WHERE f.id = v.id',
+                    moves,
+                    page_size=self.PAGE_SIZE
+                )
+
+        if merges or moves:
+            self.__user_feeds.clear()
+        return merges
+
+    def __merge_feeds(self, cur: DictCursor, merges: dict[int, int]) -> None:
+        """Move subscriptions, known items and pending deliveries of the feeds to other feeds and delete them."""
+        self.log.debug('__merge_feeds(merges=%s)', merges)
+        feed_merges = 'unnest(%(old_ids)s::int[], %(new_ids)s::int[]) AS m (old_id, new_id)'
+        parameters = {'old_ids': list(merges.keys()), 'new_ids': list(merges.values())}
+        cur.execute(
+            'INSERT INTO subscriptions (user_id, feed_id, include_keywords, exclude_keywords) '
+            'SELECT s.user_id, m.new_id, s.include_keywords, s.exclude_keywords FROM subscriptions s '
+            f'JOIN {feed_merges} ON m.old_id = s.feed_id '
+            'ON CONFLICT DO NOTHING',
+            parameters
+        )
+        cur.execute(f'DELETE FROM subscriptions s USING {feed_merges} WHERE s.feed_id = m.old_id', parameters)
+        cur.execute(
+            'INSERT INTO feeds_last_items (feed_id, url, guid, hash, item_key, first_seen_at) '
+            'SELECT m.new_id, i.url, i.guid, i.hash, i.item_key, i.first_seen_at '
+            f'FROM feeds_last_items i JOIN {feed_merges} ON m.old_id = i.feed_id '
+            'ON CONFLICT (feed_id, item_key) DO NOTHING',
+            parameters
+        )
+        cur.execute(
+            'INSERT INTO outbox_items (feed_id, feed_title, item_key, guid, url, title, description, published_at) '
+            'SELECT m.new_id, o.feed_title, o.item_key, o.guid, o.url, o.title, o.description, o.published_at '
+            f'FROM outbox_items o JOIN {feed_merges} ON m.old_id = o.feed_id '
+            'ON CONFLICT (feed_id, item_key) DO NOTHING',
+            parameters
+        )
+        cur.execute(
+            'INSERT INTO deliveries (chat_id, item_id) '
+            'SELECT d.chat_id, t.id FROM deliveries d '
+            'JOIN outbox_items o ON o.id = d.item_id '
+            f'JOIN {feed_merges} ON m.old_id = o.feed_id '
+            'JOIN outbox_items t ON t.feed_id = m.new_id AND t.item_key = o.item_key '
+            'ON CONFLICT DO NOTHING',
+            parameters
+        )
+        # Items and deliveries left behind are deleted by the cascade
+        cur.execute(f'DELETE FROM feeds f USING {feed_merges} WHERE f.id = m.old_id', parameters)
 
     def delete_feed(self, feed_id: int) -> None:
         """Delete a feed."""
         self.log.debug('delete_feed(feed_id=\'%s\')', feed_id)
-        self.cur.execute('DELETE FROM feeds WHERE id = %s', [feed_id])
-        self.conn.commit()
+        with self.transaction() as cur:
+            cur.execute('DELETE FROM feeds WHERE id = %s', [feed_id])
+        self.__user_feeds.clear()
 
     def get_feed_subscribers_count(self, feed_id: int) -> int:
         """Count feed subscribers."""
         self.log.debug('get_feed_subscribers_count(feed_id=\'%s\')', feed_id)
-        self.cur.execute('SELECT COUNT(user_id) AS amount_subscribers FROM subscriptions WHERE feed_id = %s', [feed_id])
-        row = self.cur.fetchone()
-        return row['amount_subscribers']
+        with self.transaction() as cur:
+            cur.execute('SELECT COUNT(user_id) AS amount_subscribers FROM subscriptions WHERE feed_id = %s', [feed_id])
+            row = cur.fetchone()
+            return row['amount_subscribers']
 
     def find_feed_subscribers(self, feed_id: int) -> list[int]:
         """Return feed subscribers"""
         self.log.debug('find_feed_subscribers(feed_id=\'%s\')', feed_id)
-        self.cur.execute('SELECT telegram_id FROM users WHERE id IN (SELECT user_id FROM subscriptions WHERE feed_id = %s)',
-                         [feed_id])
-        subscribers = self.cur.fetchall()
-        return list(map(lambda x: x['telegram_id'], subscribers))
+        with self.transaction() as cur:
+            cur.execute('SELECT telegram_id FROM users WHERE id IN (SELECT user_id FROM subscriptions WHERE feed_id = %s)',
+                        [feed_id])
+            subscribers = cur.fetchall()
+            return list(map(lambda x: x['telegram_id'], subscribers))
 
     def find_feeds(self) -> list[dict]:
         """Get a list of feeds."""
         self.log.debug('find_feeds()')
-        self.cur.execute('SELECT * FROM feeds')
-        return self.__dictrow_to_dict_list(self.cur.fetchall())
+        with self.transaction() as cur:
+            cur.execute('SELECT * FROM feeds')
+            return self.__dictrow_to_dict_list(cur.fetchall())
+
+    def lease_feeds(self, owner: str, limit: int, lease_time: timedelta, min_interval: timedelta) -> list[dict]:
+        """Lease feeds which were not checked for min_interval to the owner.
+
+        Feeds leased by others are skipped until the lease is released or expired, so several updaters could
+        process the feeds together without overlap. The lease of a crashed updater expires after lease_time.
+        """
+        self.log.debug(
+            'lease_feeds(owner=\'%s\', limit=%d, lease_time=%s, min_interval=%s)', owner, limit, lease_time, min_interval
+        )
+        with self.transaction() as cur:
+            cur.execute(
+                'UPDATE feeds SET locked_by = %s, locked_until = now() + %s WHERE id IN ('
+                '   SELECT id FROM feeds'
+                '   WHERE (locked_until IS NULL OR locked_until < now()) AND (checked_at IS NULL OR checked_at < now() - %s)'
+                '   ORDER BY checked_at NULLS FIRST, id LIMIT %s FOR UPDATE SKIP LOCKED'
+                ') RETURNING *',
+                [owner, lease_time, min_interval, limit]
+            )
+            return self.__dictrow_to_dict_list(cur.fetchall())
+
+    def renew_feeds(self, owner: str, feed_ids: list[int], lease_time: timedelta) -> int:
+        """Extend the lease of the feeds still leased by the owner and return their amount."""
+        self.log.debug('renew_feeds(owner=\'%s\', feed_ids=list(%d), lease_time=%s)', owner, len(feed_ids), lease_time)
+        with self.transaction() as cur:
+            cur.execute(
+                'UPDATE feeds SET locked_until = now() + %s WHERE id = ANY(%s) AND locked_by = %s',
+                [lease_time, feed_ids, owner]
+            )
+            return cur.rowcount
+
+    def release_feeds(self, owner: str, feed_ids: list[int]) -> None:
+        """Release the feeds leased by the owner marking them as checked."""
+        self.log.debug('release_feeds(owner=\'%s\', feed_ids=list(%d))', owner, len(feed_ids))
+        with self.transaction() as cur:
+            cur.execute(
+                'UPDATE feeds SET locked_by = NULL, locked_until = NULL, checked_at = now() '
+                'WHERE id = ANY(%s) AND locked_by = %s',
+                [feed_ids, owner]
+            )
 
     def find_user_feeds(self, user_id: int) -> list[dict]:
         """Return a list of feeds the user is subscribed to."""
         self.log.debug('find_user_feeds(user_id=\'%s\')', user_id)
-        self.cur.execute('SELECT * FROM feeds WHERE id IN (SELECT feed_id FROM subscriptions WHERE user_id = %s)',
-                         [user_id])
-        return self.__dictrow_to_dict_list(self.cur.fetchall())
+        feeds = self.__get_cached('user_feeds', self.__user_feeds, user_id)
+        if feeds is None:
+            with self.transaction() as cur:
+                cur.execute('SELECT * FROM feeds WHERE id IN (SELECT feed_id FROM subscriptions WHERE user_id = %s)',
+                            [user_id])
+                feeds = self.__dictrow_to_dict_list(cur.fetchall())
+            self.__user_feeds.put(user_id, feeds)
+        return [dict(feed) for feed in feeds]
 
     def find_feed_items(self, feed_id: int) -> list[dict]:
         """Get last feed items."""
         self.log.debug('find_feed_items(feed_id=\'%s\')', feed_id)
-        self.cur.execute('SELECT * FROM feeds_last_items WHERE feed_id = %s', [feed_id])
-        return self.__dictrow_to_dict_list(self.cur.fetchall())
+        with self.transaction() as cur:
+            cur.execute('SELECT * FROM feeds_last_items WHERE feed_id = %s', [feed_id])
+            return self.__dictrow_to_dict_list(cur.fetchall())
 
     def find_feed_items_urls(self, feed_id: int) -> list[str]:
         """Return urls last feed items"""
@@ -147,25 +484,254 @@ class Database:
             return []
         return list(map(lambda x: x['url'], items))
 
-    def update_feed_items(self, feed_id: int, new_items: list[FeedItem]) -> None:
-        """Replace last feed items with a list items that receive."""
-        self.log.debug('update_feed_items(feed_id=\'%s\', new_items=list(%d))', feed_id, len(new_items))
-        for i, _ in enumerate(new_items):
-            new_items[i] = [feed_id, new_items[i].url, new_items[i].guid]
-        self.cur.execute('DELETE FROM feeds_last_items WHERE feed_id = %s', [feed_id])
-        self.cur.executemany(
-            'INSERT INTO feeds_last_items (feed_id, url, guid) VALUES (%s, %s, %s)', new_items)
-        self.conn.commit()
+    def find_feeds_items(self, feed_ids: list[int]) -> dict[int, list[dict]]:
+        """Get last items of several feeds grouped by feed ID."""
+        self.log.debug('find_feeds_items(feed_ids=list(%d))', len(feed_ids))
+        with self.transaction() as cur:
+            cur.execute('SELECT * FROM feeds_last_items WHERE feed_id = ANY(%s)', [feed_ids])
+            items: dict[int, list[dict]] = {}
+            for item in self.__dictrow_to_dict_list(cur.fetchall()):
+                items.setdefault(item['feed_id'], []).append(item)
+            return items
+
+    def find_feeds_filters(self, feed_ids: list[int]) -> dict[int, list[dict]]:
+        """Return the telegram IDs of the subscribers with keyword filters and their keywords grouped by feed ID."""
+        self.log.debug('find_feeds_filters(feed_ids=list(%d))', len(feed_ids))
+        with self.transaction() as cur:
+            cur.execute(
+                'SELECT s.feed_id, u.telegram_id, s.include_keywords, s.exclude_keywords '
+                'FROM subscriptions s JOIN users u ON u.id = s.user_id '
+                'WHERE s.feed_id = ANY(%s) AND (s.include_keywords <> \'{}\' OR s.exclude_keywords <> \'{}\')',
+                [feed_ids]
+            )
+            filters: dict[int, list[dict]] = {}
+            for row in self.__dictrow_to_dict_list(cur.fetchall()):
+                filters.setdefault(row.pop('feed_id'), []).append(row)
+            return filters
+
+    def get_subscription_filters(self, user_id: int, url: str) -> tuple[list[str], list[str]]:
+        """Return the included and the excluded keywords of the subscription to the feed."""
+        self.log.debug('get_subscription_filters(user_id=\'%s\', url=\'%s\')', user_id, url)
+        with self.transaction() as cur:
+            cur.execute(
+                'SELECT s.include_keywords, s.exclude_keywords FROM subscriptions s JOIN feeds f ON f.id = s.feed_id '
+                'WHERE f.url_key = %s AND s.user_id = %s',
+                [get_url_key(url), user_id]
+            )
+            row = cur.fetchone()
+        if row is None:
+            raise DisplayableException('Not subscribed')
+        return row['include_keywords'], row['exclude_keywords']
+
+    def set_subscription_filters(self, user_id: int, url: str, include_keywords: list[str], exclude_keywords: list[str]) -> None:
+        """Change the keywords which the items of the feed should and should not contain to be sent to the user."""
+        self.log.debug(
+            'set_subscription_filters(user_id=\'%s\', url=\'%s\', include_keywords=%s, exclude_keywords=%s)',
+            user_id, url, include_keywords, exclude_keywords
+        )
+        with self.transaction() as cur:
+            cur.execute(
+                'UPDATE subscriptions s SET include_keywords = %s, exclude_keywords = %s FROM feeds f '
+                'WHERE f.id = s.feed_id AND f.url_key = %s AND s.user_id = %s',
+                [include_keywords, exclude_keywords, get_url_key(url), user_id]
+            )
+            if cur.rowcount == 0:
+                raise DisplayableException('Not subscribed')
+
+    def update_feeds_state(
+            self, diffs: dict[int, FeedDiff], current_keys: dict[int, list[str]],
+            cache_headers: dict[int, tuple[str | None, str | None]], retention: timedelta,
+            updates: dict[int, tuple[str, list[FeedItem]]], filtered: dict[tuple[int, int], list[str]] | None = None
+    ) -> None:
+        """Save the state of updated feeds and queue the updates for delivery in a single transaction.
+
+        New items are added and edited items are updated. Items which left the feed more than retention ago are
+        removed from the feeds having all their current item keys in current_keys. HTTP cache validators are saved
+        to use them in the next conditional request. Updates (feed title and items by feed ID) are queued for every
+        subscriber of the feed, except the subscribers with keyword filters, which get only the item keys passed
+        for them in filtered by (chat ID, feed ID).
+        """
+        self.log.debug(
+            'update_feeds_state(diffs=dict(%d), current_keys=dict(%d), cache_headers=dict(%d), retention=%s, '
+            'updates=dict(%d), filtered=dict(%d))',
+            len(diffs), len(current_keys), len(cache_headers), retention, len(updates), len(filtered or {})
+        )
+        filtered = filtered or {}
+        new_items = [
+            (feed_id, item.key, item.url, item.guid, item.hash) for feed_id, diff in diffs.items() for item in diff.new
+        ]
+        edited_items = [
+            (feed_id, item.key, item.url, item.hash) for feed_id, diff in diffs.items() for item in diff.edited
+        ]
+        # The same item could be listed in a feed several times, but it should be queued only once.
+        outbox_items = list({
+            (feed_id, item.key): (feed_id, title, item.key, item.guid, item.url, item.title, item.description, item.date)
+            for feed_id, (title, items) in updates.items() for item in items
+        }.values())
+
+        with self.transaction() as cur:
+            if new_items:
+                execute_values(
+                    cur,
+                    'INSERT INTO feeds_last_items (feed_id, item_key, url, guid, hash) VALUES %s '
+                    'ON CONFLICT (feed_id, item_key) DO NOTHING',
+                    new_items, page_size=self.PAGE_SIZE
+                )
+
+            if edited_items:
+                execute_values(
+                    cur,
+                    'UPDATE feeds_last_items f SET url = v.url, hash = v.hash '
+                    'FROM (VALUES %s) AS v (feed_id, item_key, url, hash) '
+                    'WHERE f.feed_id = v.feed_id AND f.item_key = v.item_key',
+                    edited_items, page_size=self.PAGE_SIZE
+                )
+
+            if current_keys:
+                execute_values(
+                    cur,
+                    'DELETE FROM feeds_last_items f USING (VALUES %s) AS v (feed_id, item_keys, retention) '
+                    'WHERE f.feed_id = v.feed_id AND f.first_seen_at < now() - v.retention '
+                    'AND f.item_key <> ALL(v.item_keys)',
+                    [(feed_id, keys, retention) for feed_id, keys in current_keys.items()],
+                    template='(%s, %s::text[], %s::interval)', page_size=self.PAGE_SIZE
+                )
+
+            if cache_headers:
+                execute_values(
+                    cur,
+                    'UPDATE feeds f SET etag = v.etag, last_modified = v.last_modified '
+                    'FROM (VALUES %s) AS v (id, etag, last_modified) WHERE f.id = v.id',
+                    [(feed_id, etag, last_modified) for feed_id, (etag, last_modified) in cache_headers.items()],
+                    template='(%s, %s::text, %s::text)', page_size=self.PAGE_SIZE
+                )
+
+            if outbox_items:
+                # A pending item is updated in place, so an edited item is not delivered twice.
+                rows = execute_values(
+                    cur,
+                    'INSERT INTO outbox_items (feed_id, feed_title, item_key, guid, url, title, description, published_at) '
+                    'VALUES %s ON CONFLICT (feed_id, item_key) DO UPDATE SET feed_title = EXCLUDED.feed_title, '
+                    'url = EXCLUDED.url, title = EXCLUDED.title, description = EXCLUDED.description, '
+                    'published_at = EXCLUDED.published_at RETURNING id',
+                    outbox_items, template='(%s, %s, %s, %s, %s, %s, %s, %s::timestamp)', page_size=self.PAGE_SIZE,
+                    fetch=True
+                )
+                cur.execute(
+                    'INSERT INTO deliveries (chat_id, item_id) '
+                    'SELECT u.telegram_id, i.id FROM outbox_items i '
+                    'JOIN subscriptions s ON s.feed_id = i.feed_id JOIN users u ON u.id = s.user_id '
+                    'WHERE i.id = ANY(%(item_ids)s) AND NOT EXISTS ('
+                    '   SELECT 1 FROM unnest(%(chat_ids)s::bigint[], %(feed_ids)s::int[]) AS f (chat_id, feed_id)'
+                    '   WHERE f.chat_id = u.telegram_id AND f.feed_id = s.feed_id'
+                    ') ON CONFLICT DO NOTHING',
+                    {
+                        'item_ids': [row['id'] for row in rows],
+                        'chat_ids': [chat_id for chat_id, _ in filtered],
+                        'feed_ids': [feed_id for _, feed_id in filtered],
+                    }
+                )
+
+            filtered_deliveries = [
+                (chat_id, feed_id, item_key) for (chat_id, feed_id), item_keys in filtered.items() for item_key in item_keys
+            ]
+            if filtered_deliveries:
+                execute_values(
+                    cur,
+                    'INSERT INTO deliveries (chat_id, item_id) '
+                    'SELECT v.chat_id, i.id FROM (VALUES %s) AS v (chat_id, feed_id, item_key) '
+                    'JOIN outbox_items i ON i.feed_id = v.feed_id AND i.item_key = v.item_key ON CONFLICT DO NOTHING',
+                    filtered_deliveries, page_size=self.PAGE_SIZE
+                )
+
+    def claim_deliveries(self, limit: int, lease_time: timedelta) -> list[dict]:
+        """Lease pending deliveries skipping the ones leased by other workers.
+
+        The lease is committed right away, so nothing is locked while the messages are being sent. The deliveries
+        of a crashed worker are sent again after the lease expires.
+        """
+        self.log.debug('claim_deliveries(limit=%d, lease_time=%s)', limit, lease_time)
+        with self.transaction() as cur:
+            cur.execute(
+                'WITH claimed AS ('
+                '   UPDATE deliveries SET locked_until = now() + %s WHERE (chat_id, item_id) IN ('
+                '       SELECT chat_id, item_id FROM deliveries WHERE locked_until IS NULL OR locked_until < now()'
+                '       ORDER BY item_id, chat_id LIMIT %s FOR UPDATE SKIP LOCKED'
+                '   ) RETURNING chat_id, item_id'
+                ') '
+                'SELECT d.chat_id, d.item_id, i.feed_id, i.feed_title, i.guid, i.url, i.title, i.description, '
+                'i.published_at, COALESCE(u.digest_mode, \'off\') AS digest_mode '
+                'FROM claimed d JOIN outbox_items i ON i.id = d.item_id LEFT JOIN users u ON u.telegram_id = d.chat_id '
+                'ORDER BY d.item_id, d.chat_id',
+                [lease_time, limit]
+            )
+            return self.__dictrow_to_dict_list(cur.fetchall())
+
+    def lock_deliveries(self, deliveries: list[tuple[int, int]], lock_time: timedelta) -> None:
+        """Keep the (chat ID, item ID) deliveries from being claimed for lock_time from now.
+
+        Used to extend the lease of a long batch or to postpone the deliveries which could not be sent.
+        """
+        self.log.debug('lock_deliveries(deliveries=list(%d), lock_time=%s)', len(deliveries), lock_time)
+        with self.transaction() as cur:
+            execute_values(
+                cur,
+                'UPDATE deliveries d SET locked_until = now() + v.lock_time FROM (VALUES %s) AS v (chat_id, item_id, lock_time) '
+                'WHERE d.chat_id = v.chat_id AND d.item_id = v.item_id',
+                [(chat_id, item_id, lock_time) for chat_id, item_id in deliveries],
+                template='(%s, %s, %s::interval)', page_size=self.PAGE_SIZE
+            )
+
+    def delete_deliveries(self, deliveries: list[tuple[int, int]]) -> None:
+        """Delete sent (chat ID, item ID) deliveries and the items which have no pending deliveries left."""
+        self.log.debug('delete_deliveries(deliveries=list(%d))', len(deliveries))
+        with self.transaction() as cur:
+            execute_values(
+                cur,
+                'DELETE FROM deliveries d USING (VALUES %s) AS v (chat_id, item_id) '
+                'WHERE d.chat_id = v.chat_id AND d.item_id = v.item_id',
+                deliveries, page_size=self.PAGE_SIZE
+            )
+            cur.execute(
+                'DELETE FROM outbox_items i WHERE i.id = ANY(%s) '
+                'AND NOT EXISTS (SELECT 1 FROM deliveries d WHERE d.item_id = i.id)',
+                [list({item_id for _, item_id in deliveries})]
+            )
 
     def __migrate(self, dsn: str) -> None:
         """Migrate or initialize the database schema"""
         self.log.debug(f'Database.__migrate(dsn={dsn})')
+        # yoyo takes a noticeable part of the start time, so it is only imported when the migrations are applied
+        from yoyo import get_backend, read_migrations  # pylint: disable=import-outside-toplevel
+
         backend = get_backend(dsn)
-        migrations = read_migrations('./migrations')
+        migrations = read_migrations(self.MIGRATIONS_DIR)
 
         with backend.lock():
             backend.apply_migrations(backend.to_apply(migrations))
 
+    def __check_migrations(self) -> None:
+        """Make sure every migration is applied comparing the migration files with the yoyo log."""
+        self.log.debug('Database.__check_migrations()')
+        expected = {name[:-len('.py')] for name in os.listdir(self.MIGRATIONS_DIR) if name.endswith('.py')}
+        try:
+            with self.transaction() as cur:
+                cur.execute('SELECT migration_id FROM _yoyo_migration')
+                applied = {row['migration_id'] for row in cur.fetchall()}
+        except ProgrammingError as exception:
+            if exception.pgcode != UNDEFINED_TABLE:
+                raise
+            applied = set()
+
+        missing = sorted(expected - applied)
+        if missing:
+            raise RuntimeError('Database schema is outdated, migrations are not applied: ' + ', '.join(missing))
+
+    def __get_cached(self, name: str, cache: LruCache, key: int):
+        value = cache.get(key)
+        self.metrics.inc('cache_total', cache=name, result='miss' if value is None else 'hit')
+        return value
+
     @staticmethod
     def __dictrow_to_dict_list(rows: list[DictRow]) -> list[dict]:
         """Convert list of DictRows to list of dicts"""
@@ -0,0 +1,133 @@
+import time
+from datetime import timedelta
+from logging import Logger
+from threading import Event
+
+from database import Database
+from rss import FeedItem
+from telegram import Notifier
+
+
+class DeliveryWorker:
+    """Sends the updates queued in the database outbox.
+
+    Deliveries are leased for the time they are being sent, so several workers in different threads or processes
+    could drain the outbox together without sending a message twice. The deliveries of a chat are deleted as soon
+    as its messages are sent, and the chats which could not be reached are postponed for retry_delay. A chat could
+    only receive its messages again if the worker dies or its lease expires before they are deleted.
+    """
+
+    # Time the claimed deliveries are leased for, the lease is extended while the batch is being sent
+    LEASE_TIME: timedelta = timedelta(minutes=10)
+    # Time after which the deliveries to the chats which could not be reached are sent again
+    RETRY_DELAY: timedelta = timedelta(minutes=1)
+
+    def __init__(
+            self, database: Database, notifier: Notifier, logger: Logger, batch_size: int = 500, poll_interval: float = 5,
+            lease_time: timedelta = LEASE_TIME, retry_delay: timedelta = RETRY_DELAY
+    ) -> None:
+        self.log: Logger = logger
+        self.log.debug(
+            'DeliveryWorker.__init__(database=%s, notifier=%s, logger=%s, batch_size=%d, poll_interval=%s, '
+            'lease_time=%s, retry_delay=%s)',
+            database, notifier, logger, batch_size, poll_interval, lease_time, retry_delay
+        )
+        self.database: Database = database
+        self.notifier: Notifier = notifier
+        self.batch_size: int = batch_size
+        self.poll_interval: float = poll_interval
+        self.lease_time: timedelta = lease_time
+        self.retry_delay: timedelta = retry_delay
+        self.__stop_event: Event = Event()
+        self.__finish_event: Event = Event()
+
+    def run(self) -> None:
+        """Keep sending the deliveries until stop() is called or finish() is called and the outbox is empty."""
+        self.log.info('Starting the delivery worker')
+        while not self.__stop_event.is_set():
+            try:
+                if self.send_batch():
+                    continue
+            except Exception:  # pylint: disable=broad-except
+                # The deliveries left are sent again after their lease expires
+                self.log.exception('Unable to send a batch of deliveries')
+            if self.__finish_event.is_set():
+                break
+            # The wait() without arguments is the one telebot patches into its events, not this one
+            self.__stop_event.wait(self.poll_interval)  # pylint: disable=too-many-function-args
+
+        self.log.info(
+            'Delivery worker stopped. Rendered messages: %d, render cache hits: %d, sanitizer calls: %d, '
+            'sanitizer time: %.3f s, rate limit waits: %.3f s',
+            self.notifier.render_cache_misses, self.notifier.render_cache_hits,
+            self.notifier.sanitizer_calls, self.notifier.sanitizer_time, self.notifier.rate_limiter.slept
+        )
+
+    def stop(self) -> None:
+        """Request the worker to stop after the current batch."""
+        self.__stop_event.set()
+
+    def finish(self) -> None:
+        """Request the worker to stop as soon as there is nothing to send."""
+        self.__finish_event.set()
+
+    def send_pending(self) -> int:
+        """Send all pending deliveries and return their amount."""
+        sent = 0
+        while batch_size := self.send_batch():
+            sent += batch_size
+        return sent
+
+    def send_batch(self) -> int:
+        """Send a batch of deliveries and return its size."""
+        deliveries = self.database.claim_deliveries(self.batch_size, self.lease_time)
+        if not deliveries:
+            return 0
+        started = time.perf_counter()
+        self.log.debug('Claimed %d deliveries', len(deliveries))
+
+        pending = queue_deliveries(self.notifier, deliveries)
+        leased_at = time.monotonic()
+
+        def on_sent(chat_id: int) -> None:
+            nonlocal leased_at
+            self.database.delete_deliveries(pending.pop(chat_id))
+            if pending and time.monotonic() - leased_at > self.lease_time.total_seconds() / 2:
+                self.database.lock_deliveries([key for keys in pending.values() for key in keys], self.lease_time)
+                leased_at = time.monotonic()
+
+        self.notifier.send_digests(on_sent)
+        if pending:
+            self.log.warning('Postponing the deliveries to %d chats for %s', len(pending), self.retry_delay)
+            self.database.lock_deliveries([key for keys in pending.values() for key in keys], self.retry_delay)
+
+        self.notifier.metrics.observe('delivery_batch_duration_seconds', time.perf_counter() - started)
+        self.notifier.metrics.inc('deliveries_total', len(deliveries) - sum(len(keys) for keys in pending.values()))
+        return len(deliveries)
+
+
+def queue_deliveries(notifier: Notifier, deliveries: list[dict]) -> dict[int, list[tuple[int, int]]]:
+    """Queue the messages of the claimed deliveries and return the (chat ID, item ID) deliveries of every chat."""
+    # Items of every chat are grouped by feed preserving the order they were queued in.
+    chats: dict[int, dict[int, list[dict]]] = {}
+    for delivery in deliveries:
+        chats.setdefault(delivery['chat_id'], {}).setdefault(delivery['feed_id'], []).append(delivery)
+
+    for chat_id, feeds in chats.items():
+        for feed_deliveries in feeds.values():
+            notifier.queue_updates(
+                {chat_id: feed_deliveries[0]['digest_mode']},
+                [
+                    FeedItem.from_values(
+                        delivery['url'], delivery['title'], delivery['description'], delivery['guid'],
+                        delivery['published_at']
+                    )
+                    for delivery in feed_deliveries
+                ],
+                feed_deliveries[0]['feed_title']
+            )
+
+    return {
+        chat_id: [(chat_id, delivery['item_id']) for feed_deliveries in feeds.values() for delivery in feed_deliveries]
+        for chat_id, feeds in chats.items()
+    }
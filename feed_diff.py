@@ -0,0 +1,51 @@
+from rss import FeedItem
+
+
+class FeedDiff:
+    """Difference between the current feed items and the previously seen ones."""
+
+    def __init__(self, new: list[FeedItem], edited: list[FeedItem]) -> None:
+        self.new: list[FeedItem] = new
+        self.edited: list[FeedItem] = edited
+
+    def __bool__(self) -> bool:
+        return bool(self.new or self.edited)
+
+
+def calculate_difference(new_items: list[FeedItem], old_items: list[dict]) -> FeedDiff:
+    """Find new and edited feed items.
+
+    Items are matched by GUID. Items without GUID are matched by URL. Unmatched items are still considered
+    known if an item with the same content hash was seen before. Matched items with a different content hash
+    are considered edited.
+    """
+    if not old_items:
+        return FeedDiff(list(new_items), [])
+
+    old_by_guid: dict[str, dict] = {}
+    old_by_url: dict[str, dict] = {}
+    old_hashes: set[str] = set()
+    for old_item in old_items:
+        if old_item['guid']:
+            old_by_guid[old_item['guid']] = old_item
+        elif old_item['url']:
+            old_by_url[old_item['url']] = old_item
+        if old_item['hash']:
+            old_hashes.add(old_item['hash'])
+
+    new = []
+    edited = []
+    for item in new_items:
+        if item.guid:
+            old_item = old_by_guid.get(item.guid)
+        else:
+            old_item = old_by_url.get(item.url)
+
+        if old_item is None:
+            if item.hash not in old_hashes:
+                new.append(item)
+        # Items saved before the content hash was introduced can't be checked for edits.
+        elif old_item['hash'] and old_item['hash'] != item.hash:
+            edited.append(item)
+
+    return FeedDiff(new, edited)
@@ -0,0 +1,40 @@
+from urllib.parse import unquote, urlsplit, urlunsplit
+
+# Query parameters which only track the source of a visit and never change the feed
+TRACKING_PARAMETERS = {'fbclid', 'gclid', 'yclid', 'mc_cid', 'mc_eid', '_ga', 'ref_src'}
+TRACKING_PREFIXES = ('utm_',)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    """Return the URL which should be used to fetch the feed.
+
+    The scheme and the host are lowercased, default ports, fragments and tracking parameters are removed.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').rstrip('.')
+    if ':' in netloc:
+        netloc = f'[{netloc}]'
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += f':{parts.port}'
+    if parts.username is not None:
+        credentials = parts.username if parts.password is None else f'{parts.username}:{parts.password}'
+        netloc = f'{credentials}@{netloc}'
+    # The parameters are filtered as they are, some servers are sensitive to the way the query is encoded
+    query = '&'.join(
+        parameter for parameter in parts.query.split('&')
+        if parameter and not _is_tracking_parameter(unquote(parameter.partition('=')[0]).lower())
+    )
+
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def get_url_key(url: str) -> str:
+    """Return the identity of the feed: URLs differing only in the scheme, trailing slash or tracking have the same key."""
+    parts = urlsplit(normalize_url(url))
+    return urlunsplit(('', parts.netloc, parts.path.rstrip('/') or '/', parts.query, ''))[2:]
+
+
+def _is_tracking_parameter(name: str) -> bool:
+    return name in TRACKING_PARAMETERS or name.startswith(TRACKING_PREFIXES)
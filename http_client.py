@@ -0,0 +1,264 @@
+import socket
+import time
+from collections import Counter, OrderedDict, deque
+from collections.abc import Callable
+from concurrent.futures import CancelledError, Executor, Future, ThreadPoolExecutor
+from functools import partial
+from http.cookiejar import DefaultCookiePolicy
+from logging import Logger
+from threading import Lock
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.request import ACCEPT_ENCODING
+
+
+class DnsCache:
+    """Small cache of resolved host addresses. Many feeds are often hosted on the same domain."""
+
+    TTL: float = 300
+    MAX_SIZE: int = 1000
+
+    def __init__(
+            self, ttl: float = TTL, max_size: int = MAX_SIZE, clock: Callable[[], float] = time.monotonic,
+            resolver: Callable[..., list] = socket.getaddrinfo
+    ) -> None:
+        self.ttl: float = ttl
+        self.max_size: int = max_size
+        self.clock: Callable[[], float] = clock
+        self.resolver: Callable[..., list] = resolver
+        self.hits: int = 0
+        self.misses: int = 0
+        self.__addresses: OrderedDict[str, tuple[float, list[str]]] = OrderedDict()
+        self.__lock: Lock = Lock()
+
+    def resolve(self, host: str, port: int) -> list[str]:
+        """Return IP addresses of the host in the order returned by the resolver."""
+        now = self.clock()
+        with self.__lock:
+            if host in self.__addresses and self.__addresses[host][0] > now:
+                self.hits += 1
+                self.__addresses.move_to_end(host)
+                return self.__addresses[host][1]
+
+        addresses = []
+        for _, _, _, _, address in self.resolver(host, port, 0, socket.SOCK_STREAM):
+            if address[0] not in addresses:
+                addresses.append(address[0])
+
+        with self.__lock:
+            self.misses += 1
+            self.__addresses[host] = (now + self.ttl, addresses)
+            self.__addresses.move_to_end(host)
+            while len(self.__addresses) > self.max_size:
+                self.__addresses.popitem(last=False)
+
+        return addresses
+
+    def forget(self, host: str) -> None:
+        """Drop the addresses of the host, for example when none of them is reachable anymore."""
+        with self.__lock:
+            self.__addresses.pop(host, None)
+
+
+class DnsCachingConnectionMixin:
+    """Connects to the addresses from the DNS cache. TLS still uses the host name for SNI and verification."""
+
+    def __init__(self, *args, dns_cache: DnsCache, **kwargs) -> None:
+        self.dns_cache: DnsCache = dns_cache
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self) -> socket.socket:
+        host = self._dns_host
+        try:
+            addresses = self.dns_cache.resolve(host, self.port)
+        except socket.gaierror:
+            # Let urllib3 report the resolution error in its own way
+            return super()._new_conn()
+
+        error = None
+        for address in addresses:
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except (ConnectTimeoutError, NewConnectionError) as exception:
+                error = exception
+            finally:
+                self._dns_host = host
+
+        self.dns_cache.forget(host)
+        raise error
+
+
+class DnsCachingHTTPConnection(DnsCachingConnectionMixin, HTTPConnection):
+    pass
+
+
+class DnsCachingHTTPSConnection(DnsCachingConnectionMixin, HTTPSConnection):
+    pass
+
+
+class DnsCachingPoolMixin:
+    def __init__(self, *args, dns_cache: DnsCache, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.conn_kw['dns_cache'] = dns_cache
+
+
+class DnsCachingHTTPConnectionPool(DnsCachingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = DnsCachingHTTPConnection
+
+
+class DnsCachingHTTPSConnectionPool(DnsCachingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = DnsCachingHTTPSConnection
+
+
+class DnsCachingAdapter(HTTPAdapter):
+    """Transport adapter keeping the connections to every host open and resolving the hosts through the DNS cache."""
+
+    def __init__(self, dns_cache: DnsCache, **kwargs) -> None:
+        self.dns_cache: DnsCache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': partial(DnsCachingHTTPConnectionPool, dns_cache=self.dns_cache),
+            'https': partial(DnsCachingHTTPSConnectionPool, dns_cache=self.dns_cache),
+        }
+
+
+def create_session(
+        user_agent: str, hosts: int = 100, connections_per_host: int = 2, dns_cache: DnsCache | None = None
+) -> requests.Session:
+    """Create an HTTP session reusing the connections to the hosts which serve many feeds.
+
+    The session may be shared by the threads: cookies, the only state kept between the requests, are disabled.
+    """
+    session = requests.Session()
+    session.headers['User-Agent'] = user_agent
+    # gzip and deflate, and brotli if the brotli package is installed
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = DnsCachingAdapter(dns_cache or DnsCache(), pool_connections=hosts, pool_maxsize=connections_per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HostLimiter:
+    """Passes the requests to the executors, no more than `per_host_limit` requests to a host at once.
+
+    The other requests wait in the queue of their host instead of a worker of the executor, so the workers never
+    wait for a slow host while the URLs of other hosts could be requested.
+    """
+
+    def __init__(self, per_host_limit: int, on_start: Callable[[float], None] | None = None) -> None:
+        self.per_host_limit: int = per_host_limit
+        # Called with the time the request waited for the other requests to the host
+        self.on_start: Callable[[float], None] | None = on_start
+        # Requests to every host passed to the executors and the ones waiting for them to finish
+        self.__host_running: Counter = Counter()
+        self.__host_queues: dict[str, deque[tuple[Executor, Callable, tuple, Future, float]]] = {}
+        self.__lock: Lock = Lock()
+
+    def submit(self, executor: Executor, url: str, function: Callable, *args) -> Future:
+        """Schedule the call requesting the URL and return its future."""
+        future: Future = Future()
+        host = urlparse(url).hostname or ''
+        with self.__lock:
+            self.__host_queues.setdefault(host, deque()).append((executor, function, args, future, time.perf_counter()))
+            if self.__host_running[host] >= self.per_host_limit:
+                return future
+            self.__host_running[host] += 1
+        self.__start_next(host)
+        return future
+
+    def __start_next(self, host: str) -> None:
+        """Pass the next call waiting for the host to its executor, or free the slot of the host."""
+        while True:
+            with self.__lock:
+                queue = self.__host_queues[host]
+                if not queue:
+                    self.__host_running[host] -= 1
+                    if not self.__host_running[host]:
+                        del self.__host_running[host]
+                        del self.__host_queues[host]
+                    return
+                executor, function, args, future, queued_at = queue.popleft()
+
+            # Calls could be cancelled while they wait, e.g. when the update is interrupted
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.on_start is not None:
+                self.on_start(time.perf_counter() - queued_at)
+            try:
+                call = executor.submit(function, *args)
+            except RuntimeError as exception:
+                # The executor is shut down
+                future.set_exception(exception)
+                continue
+            call.add_done_callback(partial(self.__complete, host, future))
+            return
+
+    def __complete(self, host: str, future: Future, call: Future) -> None:
+        if call.cancelled():
+            future.set_exception(CancelledError())
+        elif call.exception() is not None:
+            future.set_exception(call.exception())
+        else:
+            future.set_result(call.result())
+        self.__start_next(host)
+
+
+class UrlChecker:
+    """Checks that the URLs are reachable requesting many of them at the same time.
+
+    Like the updater, it does not make more than `per_host_limit` requests to a host at once.
+    """
+
+    WORKERS: int = 20
+    TIMEOUT: float = 10
+
+    def __init__(
+            self, logger: Logger, session: requests.Session | None = None, workers: int = WORKERS, timeout: float = TIMEOUT,
+            per_host_limit: int = 2
+    ) -> None:
+        self.log: Logger = logger
+        self.log.debug(
+            'UrlChecker.__init__(logger=%s, session=%s, workers=%d, timeout=%s, per_host_limit=%d)',
+            logger, session, workers, timeout, per_host_limit
+        )
+        self.workers: int = workers
+        self.timeout: float = timeout
+        self.per_host_limit: int = per_host_limit
+        self.__session: requests.Session | None = session
+
+    def find_unreachable(self, urls: list[str]) -> dict[str, str]:
+        """Return the reasons the URLs could not be fetched for, by URL."""
+        self.log.debug('find_unreachable(urls=list(%d))', len(urls))
+        if not urls:
+            return {}
+        if self.__session is None:
+            # The feed parser is imported on the first check only, it is slow to import
+            from feedparser import USER_AGENT  # pylint: disable=import-outside-toplevel
+            self.__session = create_session(USER_AGENT, connections_per_host=self.per_host_limit)
+
+        hosts = HostLimiter(self.per_host_limit)
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(urls)), thread_name_prefix='UrlChecker') as executor:
+            checks = [hosts.submit(executor, url, self.__check, url) for url in urls]
+            errors = {url: check.result() for url, check in zip(urls, checks)}
+        return {url: error for url, error in errors.items() if error is not None}
+
+    def __check(self, url: str) -> str | None:
+        try:
+            # Only the headers are read, the body is not needed
+            with self.__session.get(url, timeout=self.timeout, stream=True) as response:
+                if response.status_code >= 400:
+                    return f'HTTP {response.status_code}'
+        except requests.RequestException as exception:
+            self.log.debug('Unable to fetch %s: %s', url, exception)
+            return type(exception).__name__
+        return None
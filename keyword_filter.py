@@ -0,0 +1,54 @@
+import re
+from collections.abc import Iterable
+from html import unescape
+
+from rss import FeedItem
+
+
+TAG_PATTERN = re.compile(r'<[^>]*>')
+
+
+class KeywordMatcher:
+    """Finds which of the keywords occur in a text scanning it once.
+
+    All keywords are combined into a single case-insensitive regular expression. A keyword matches whole words
+    only, so "ai" does not match "said". The expression is tried at every position of the text, and the keywords
+    contained in a longer matched keyword are reported together with it, so overlapping keywords are not missed.
+    """
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.keywords: frozenset[str] = frozenset(keyword.lower() for keyword in keywords)
+        self.__pattern: re.Pattern | None = None
+        if self.keywords:
+            # The longest keyword is matched at a position, the shorter ones are added from the contained keywords
+            alternatives = '|'.join(re.escape(keyword) for keyword in sorted(self.keywords, key=len, reverse=True))
+            self.__pattern = re.compile(rf'(?=(?<!\w)({alternatives})(?!\w))', re.IGNORECASE)
+        self.__contained: dict[str, frozenset[str]] = {
+            keyword: frozenset(
+                other for other in self.keywords if re.search(rf'(?<!\w){re.escape(other)}(?!\w)', keyword)
+            )
+            for keyword in self.keywords
+        }
+
+    def find(self, text: str) -> set[str]:
+        """Return the keywords found in the text."""
+        found: set[str] = set()
+        if self.__pattern is None:
+            return found
+        for match in self.__pattern.finditer(text):
+            found.update(self.__contained.get(match.group(1).lower(), ()))
+        return found
+
+    def find_in_item(self, item: FeedItem) -> set[str]:
+        """Return the keywords found in the title and in the text of the description of the item."""
+        return self.find(item.title + '\n' + unescape(TAG_PATTERN.sub(' ', item.description)))
+
+
+def is_accepted(found: set[str], include_keywords: list[str], exclude_keywords: list[str]) -> bool:
+    """Check if an item containing the found keywords passes the filter of a subscription.
+
+    The item should contain any of the included keywords, if there are any, and none of the excluded ones.
+    """
+    if include_keywords and found.isdisjoint(include_keywords):
+        return False
+    return found.isdisjoint(exclude_keywords)
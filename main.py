@@ -0,0 +1,85 @@
+import logging
+import signal
+import sys
+from collections.abc import Callable
+from threading import Event, Thread, current_thread
+
+from app import (
+    Config, create_bot, create_database, create_delivery_workers, create_metrics, create_scheduler,
+    create_update_manager, setup_logging
+)
+from http_client import UrlChecker
+
+
+config = Config()
+setup_logging(config, 'the bot and the updater')
+log = logging.getLogger('main')
+metrics = create_metrics(config)
+
+# The bot, the updater and the senders share the connection pool, the caches and the metrics
+db = create_database(config, metrics)
+updater = create_update_manager(config, db, metrics)
+scheduler = create_scheduler(config, updater)
+delivery_workers = create_delivery_workers(config, db, metrics, config.sender_workers)
+
+# Feeds imported by the users are checked over the connections of the updater
+url_checker = UrlChecker(
+    logging.getLogger('UrlChecker'), updater.rss_reader.session, per_host_limit=config.per_host_limit
+)
+bot, webhook = create_bot(config, db, metrics, url_checker)
+
+stopping = Event()
+failed = Event()
+
+
+def stop(signum, frame):
+    # pylint: disable=unused-argument
+    stopping.set()
+    scheduler.stop()
+    for delivery_worker in delivery_workers:
+        delivery_worker.stop()
+    if webhook is not None:
+        webhook.stop()
+    else:
+        bot.stop()
+
+
+def supervise(target: Callable[[], None]) -> Callable[[], None]:
+    """Wrap the loop of a component, so the whole process is stopped if the loop ends before stop() is called."""
+    def run() -> None:
+        try:
+            target()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('%s has crashed', current_thread().name)
+        if not stopping.is_set():
+            log.error('%s has stopped unexpectedly, stopping the process', current_thread().name)
+            failed.set()
+            stop(None, None)
+    return run
+
+
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+threads = [Thread(target=supervise(scheduler.run), name='UpdateScheduler')] + [
+    Thread(target=supervise(worker.run), name=f'DeliveryWorker-{index}') for index, worker in enumerate(delivery_workers)
+]
+for thread in threads:
+    thread.start()
+
+try:
+    # Signals are only delivered to the main thread, so the bot runs here
+    if webhook is not None:
+        webhook.run()
+    else:
+        bot.run()
+finally:
+    # The bot could stop on its own, the other components are stopped with it
+    stop(None, None)
+    for thread in threads:
+        thread.join()
+    if config.metrics_file:
+        metrics.write(config.metrics_file)
+
+if failed.is_set():
+    sys.exit(1)
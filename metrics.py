@@ -0,0 +1,163 @@
+import json
+import os
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+class Metrics:
+    """Collects counters and timings of the bot and exports them in the Prometheus text format.
+
+    Feeds are too many to be used as metric labels, so the measurements of every feed are kept separately
+    for the run report, which lists the slowest and the largest feeds.
+    """
+
+    PREFIX: str = 'rssbot_'
+    # Amount of feeds listed in every section of the run report
+    REPORT_FEEDS: int = 20
+
+    def __init__(self) -> None:
+        self.started: datetime = datetime.now(timezone.utc)
+        self.__counters: dict[tuple[str, tuple], float] = {}
+        self.__gauges: dict[tuple[str, tuple], float] = {}
+        self.__summaries: dict[tuple[str, tuple], list[float]] = {}
+        self.__feeds: dict[int, dict] = {}
+        self.__lock: Lock = Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """Increase the counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set the current value of the gauge."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        """Add the duration to the summary."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            summary = self.__summaries.setdefault(key, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += seconds
+            summary[2] = max(summary[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Measure the duration of the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def record_feed(self, feed_id: int, url: str, **values) -> None:
+        """Save the measurements of the last update of the feed for the run report."""
+        with self.__lock:
+            self.__feeds[feed_id] = {'id': feed_id, 'url': url, **values}
+
+    def update_feed_record(self, feed_id: int, **values) -> None:
+        """Add measurements of the later phases to the record of the feed."""
+        with self.__lock:
+            if feed_id in self.__feeds:
+                self.__feeds[feed_id].update(values)
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            gauges = sorted(self.__gauges.items())
+            summaries = sorted(self.__summaries.items())
+
+        described = set()
+        for metric_type, values in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in values:
+                if name not in described:
+                    lines.append(f'# TYPE {self.PREFIX}{name} {metric_type}')
+                    described.add(name)
+                lines.append(f'{self.PREFIX}{name}{self.__format_labels(labels)} {value:g}')
+        for (name, labels), (count, total, _) in summaries:
+            if name not in described:
+                lines.append(f'# TYPE {self.PREFIX}{name} summary')
+                described.add(name)
+            lines.append(f'{self.PREFIX}{name}_count{self.__format_labels(labels)} {count}')
+            lines.append(f'{self.PREFIX}{name}_sum{self.__format_labels(labels)} {total:.6f}')
+
+        return '\n'.join(lines) + '\n'
+
+    def report(self) -> dict:
+        """Return the summary of the run with the slowest, the largest and the failed feeds."""
+        with self.__lock:
+            counters = dict(self.__counters)
+            summaries = dict(self.__summaries)
+            feeds = list(self.__feeds.values())
+
+        return {
+            'started': self.started.isoformat(),
+            'finished': datetime.now(timezone.utc).isoformat(),
+            'counters': {self.__format_key(key): value for key, value in sorted(counters.items())},
+            'timings': {
+                self.__format_key(key): {'count': count, 'total': round(total, 6), 'max': round(maximum, 6)}
+                for key, (count, total, maximum) in sorted(summaries.items())
+            },
+            'slowest_feeds': sorted(feeds, key=lambda feed: feed.get('fetch_seconds', 0), reverse=True)[:self.REPORT_FEEDS],
+            'largest_feeds': sorted(feeds, key=lambda feed: feed.get('bytes', 0), reverse=True)[:self.REPORT_FEEDS],
+            'failed_feeds': [feed for feed in feeds if feed.get('status') == 'error'],
+        }
+
+    def write(self, path: str) -> None:
+        """Write the metrics to the file, e.g. for the textfile collector of the node exporter."""
+        self.__write_atomically(path, self.render())
+
+    def write_report(self, path: str) -> None:
+        """Write the run report to the file as JSON."""
+        self.__write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def serve(self, port: int, host: str = '') -> ThreadingHTTPServer:
+        """Serve the metrics over HTTP in a background thread."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # pylint: disable=invalid-name
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+        return server
+
+    @staticmethod
+    def __format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        escaped = (
+            (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels
+        )
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    @staticmethod
+    def __format_key(key: tuple[str, tuple]) -> str:
+        name, labels = key
+        return name + ''.join(f' {label}={value}' for label, value in labels)
+
+    @staticmethod
+    def __write_atomically(path: str, content: str) -> None:
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(temporary_path, path)
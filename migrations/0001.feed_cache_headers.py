@@ -0,0 +1,11 @@
+from yoyo import step
+
+__depends__ = {'0000.initial_schema'}
+
+steps = [
+    step(
+        'ALTER TABLE feeds'
+        '   ADD COLUMN etag TEXT,'
+        '   ADD COLUMN last_modified TEXT'
+    )
+]
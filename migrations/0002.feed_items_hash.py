@@ -0,0 +1,7 @@
+from yoyo import step
+
+__depends__ = {'0001.feed_cache_headers'}
+
+steps = [
+    step('ALTER TABLE feeds_last_items ADD COLUMN hash TEXT')
+]
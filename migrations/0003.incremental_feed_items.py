@@ -0,0 +1,17 @@
+from yoyo import step
+
+__depends__ = {'0002.feed_items_hash'}
+
+steps = [
+    step('ALTER TABLE feeds_last_items ADD COLUMN item_key TEXT'),
+    step("UPDATE feeds_last_items SET item_key = COALESCE(NULLIF(guid, ''), NULLIF(url, ''), hash)"),
+    step('DELETE FROM feeds_last_items WHERE item_key IS NULL'),
+    step(
+        'DELETE FROM feeds_last_items a'
+        '   USING feeds_last_items b'
+        '   WHERE a.feed_id = b.feed_id AND a.item_key = b.item_key AND a.ctid > b.ctid'
+    ),
+    step('ALTER TABLE feeds_last_items ALTER COLUMN item_key SET NOT NULL'),
+    step('ALTER TABLE feeds_last_items ADD COLUMN first_seen_at TIMESTAMPTZ NOT NULL DEFAULT now()'),
+    step('CREATE UNIQUE INDEX feeds_last_items_feed_id_item_key_idx ON feeds_last_items (feed_id, item_key)'),
+]
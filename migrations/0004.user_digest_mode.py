@@ -0,0 +1,10 @@
+from yoyo import step
+
+__depends__ = {'0003.incremental_feed_items'}
+
+steps = [
+    step(
+        "ALTER TABLE users ADD COLUMN digest_mode TEXT NOT NULL DEFAULT 'off'"
+        "   CHECK (digest_mode IN ('off', 'feed', 'all'))"
+    )
+]
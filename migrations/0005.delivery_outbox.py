@@ -0,0 +1,28 @@
+from yoyo import step
+
+__depends__ = {'0004.user_digest_mode'}
+
+steps = [
+    step(
+        'CREATE TABLE outbox_items ('
+        '   id BIGSERIAL PRIMARY KEY,'
+        '   feed_id INTEGER NOT NULL REFERENCES feeds ON DELETE CASCADE,'
+        '   feed_title TEXT NOT NULL,'
+        '   item_key TEXT NOT NULL,'
+        '   guid TEXT NOT NULL,'
+        '   url TEXT NOT NULL,'
+        '   title TEXT NOT NULL,'
+        '   description TEXT NOT NULL,'
+        '   published_at TIMESTAMP,'
+        '   UNIQUE (feed_id, item_key)'
+        ')'
+    ),
+    step(
+        'CREATE TABLE deliveries ('
+        '   chat_id BIGINT NOT NULL,'
+        '   item_id BIGINT NOT NULL REFERENCES outbox_items ON DELETE CASCADE,'
+        '   PRIMARY KEY (chat_id, item_id)'
+        ')'
+    ),
+    step('CREATE INDEX deliveries_item_id_idx ON deliveries (item_id)'),
+]
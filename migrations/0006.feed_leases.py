@@ -0,0 +1,12 @@
+from yoyo import step
+
+__depends__ = {'0005.delivery_outbox'}
+
+steps = [
+    step(
+        'ALTER TABLE feeds'
+        '   ADD COLUMN locked_by TEXT,'
+        '   ADD COLUMN locked_until TIMESTAMPTZ,'
+        '   ADD COLUMN checked_at TIMESTAMPTZ'
+    )
+]
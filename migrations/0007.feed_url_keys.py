@@ -0,0 +1,53 @@
+from yoyo import step
+from feed_url import get_url_key
+
+__depends__ = {'0006.feed_leases'}
+
+
+def fill_url_keys(conn) -> None:
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, url FROM feeds')
+    keys = [(get_url_key(url), feed_id) for feed_id, url in cursor.fetchall()]
+    cursor.executemany('UPDATE feeds SET url_key = %s WHERE id = %s', keys)
+
+
+steps = [
+    step('ALTER TABLE feeds ADD COLUMN url_key TEXT'),
+    step(fill_url_keys),
+    # Feeds with the same key are merged into the oldest one
+    step(
+        'CREATE TEMPORARY TABLE feed_merges AS'
+        '   SELECT id AS old_id, MIN(id) OVER (PARTITION BY url_key) AS new_id FROM feeds'
+    ),
+    step('DELETE FROM feed_merges WHERE old_id = new_id'),
+    step(
+        'INSERT INTO subscriptions (user_id, feed_id)'
+        '   SELECT s.user_id, m.new_id FROM subscriptions s JOIN feed_merges m ON m.old_id = s.feed_id'
+        '   ON CONFLICT DO NOTHING'
+    ),
+    step('DELETE FROM subscriptions s USING feed_merges m WHERE s.feed_id = m.old_id'),
+    step(
+        'INSERT INTO feeds_last_items (feed_id, url, guid, hash, item_key, first_seen_at)'
+        '   SELECT m.new_id, i.url, i.guid, i.hash, i.item_key, i.first_seen_at'
+        '   FROM feeds_last_items i JOIN feed_merges m ON m.old_id = i.feed_id'
+        '   ON CONFLICT (feed_id, item_key) DO NOTHING'
+    ),
+    step(
+        'INSERT INTO outbox_items (feed_id, feed_title, item_key, guid, url, title, description, published_at)'
+        '   SELECT m.new_id, o.feed_title, o.item_key, o.guid, o.url, o.title, o.description, o.published_at'
+        '   FROM outbox_items o JOIN feed_merges m ON m.old_id = o.feed_id'
+        '   ON CONFLICT (feed_id, item_key) DO NOTHING'
+    ),
+    step(
+        'INSERT INTO deliveries (chat_id, item_id)'
+        '   SELECT d.chat_id, t.id FROM deliveries d'
+        '   JOIN outbox_items o ON o.id = d.item_id'
+        '   JOIN feed_merges m ON m.old_id = o.feed_id'
+        '   JOIN outbox_items t ON t.feed_id = m.new_id AND t.item_key = o.item_key'
+        '   ON CONFLICT DO NOTHING'
+    ),
+    step('DELETE FROM feeds f USING feed_merges m WHERE f.id = m.old_id'),
+    step('DROP TABLE feed_merges'),
+    step('ALTER TABLE feeds ALTER COLUMN url_key SET NOT NULL'),
+    step('CREATE UNIQUE INDEX feeds_url_key_idx ON feeds (url_key)'),
+]
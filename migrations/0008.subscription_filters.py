@@ -0,0 +1,11 @@
+from yoyo import step
+
+__depends__ = {'0007.feed_url_keys'}
+
+steps = [
+    step(
+        "ALTER TABLE subscriptions"
+        "   ADD COLUMN include_keywords TEXT[] NOT NULL DEFAULT '{}',"
+        "   ADD COLUMN exclude_keywords TEXT[] NOT NULL DEFAULT '{}'"
+    )
+]
@@ -0,0 +1,7 @@
+from yoyo import step
+
+__depends__ = {'0008.subscription_filters'}
+
+steps = [
+    step('ALTER TABLE deliveries ADD COLUMN locked_until TIMESTAMPTZ')
+]
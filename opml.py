@@ -0,0 +1,40 @@
+from xml.etree.ElementTree import Element, ParseError, SubElement, fromstring, tostring
+from xml.parsers.expat import ExpatError, ParserCreate
+
+from exceptions import DisplayableException
+
+
+def parse_opml(document: bytes) -> list[str]:
+    """Return the feed URLs of the OPML document in the order they appear, without duplicates.
+
+    Outlines could be nested into categories, every outline having the xmlUrl attribute is a feed.
+    """
+    # OPML never needs a document type, so no entities could be declared and expanded at all. The parser
+    # decodes the document first, so a declaration could not be hidden by another encoding.
+    checker = ParserCreate()
+    checker.StartDoctypeDeclHandler = _reject_declaration
+    checker.EntityDeclHandler = _reject_declaration
+    try:
+        checker.Parse(document, True)
+        root = fromstring(document)
+    except (ExpatError, ParseError) as exception:
+        raise DisplayableException('Invalid OPML file') from exception
+    if root.tag != 'opml':
+        raise DisplayableException('Invalid OPML file')
+
+    urls = (outline.get('xmlUrl', '').strip() for outline in root.iter('outline'))
+    return list(dict.fromkeys(url for url in urls if url))
+
+
+def _reject_declaration(*args) -> None:
+    raise DisplayableException('Invalid OPML file')
+
+
+def build_opml(urls: list[str], title: str) -> bytes:
+    """Return an OPML document with the feeds."""
+    root = Element('opml', version='2.0')
+    SubElement(SubElement(root, 'head'), 'title').text = title
+    body = SubElement(root, 'body')
+    for url in urls:
+        SubElement(body, 'outline', type='rss', text=url, xmlUrl=url)
+    return tostring(root, encoding='utf-8', xml_declaration=True)
@@ -0,0 +1,133 @@
+import asyncio
+import time
+from collections.abc import Callable
+from threading import Lock
+
+
+class TokenBucket:
+    """Token bucket continuously refilled with the given rate up to its capacity."""
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = now
+
+    def get_delay(self, now: float) -> float:
+        """Return the time left until a token is available."""
+        self.__refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        """Take a token. The balance goes negative if the bucket is empty, delaying the next token."""
+        self.__refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Make the bucket empty for the given amount of seconds."""
+        self.__refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self, now: float) -> bool:
+        self.__refill(now)
+        return self.tokens >= self.capacity
+
+    def __refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+
+class RateLimiter:
+    """Keeps the message sending rate within the Telegram Bot API limits.
+
+    https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+    """
+
+    # Messages per second for all chats together
+    GLOBAL_RATE: float = 25
+    # Messages per second to a single chat
+    CHAT_RATE: float = 1
+    # Messages per second to a single group
+    GROUP_RATE: float = 20 / 60
+    # Amount of tracked chats after which the idle chat buckets are dropped
+    MAX_IDLE_BUCKETS: int = 10000
+
+    def __init__(
+            self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE, group_rate: float = GROUP_RATE,
+            clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep
+    ) -> None:
+        self.chat_rate: float = chat_rate
+        self.group_rate: float = group_rate
+        self.clock: Callable[[], float] = clock
+        self.sleep: Callable[[float], None] = sleep
+        self.global_bucket: TokenBucket = TokenBucket(global_rate, global_rate, clock())
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        # Group chats are limited by both the chat and the group buckets
+        self.group_buckets: dict[int, TokenBucket] = {}
+        self.slept: float = 0.0
+        self.__lock: Lock = Lock()
+
+    def get_chat_delay(self, chat_id: int) -> float:
+        """Return the time left until the chat can receive a message not taking the global limit into account."""
+        with self.__lock:
+            return max(bucket.get_delay(self.clock()) for bucket in self.__get_chat_buckets(chat_id))
+
+    def acquire(self, chat_id: int) -> float:
+        """Wait until a message could be sent to the chat and return the time spent waiting."""
+        waited = 0.0
+        while (delay := self.__try_acquire(chat_id, waited)) > 0:
+            self.sleep(delay)
+            waited += delay
+        return waited
+
+    async def acquire_async(self, chat_id: int) -> float:
+        """Same as acquire(), but waits without blocking the event loop."""
+        waited = 0.0
+        while (delay := self.__try_acquire(chat_id, waited)) > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+    def pause_chat(self, chat_id: int, seconds: float) -> None:
+        """Stop sending messages to the chat for the given time, e.g. after the 429 error with retry_after."""
+        with self.__lock:
+            for bucket in self.__get_chat_buckets(chat_id):
+                bucket.pause(self.clock(), seconds)
+
+    def __try_acquire(self, chat_id: int, waited: float) -> float:
+        """Take the tokens and return 0 if a message could be sent to the chat now, otherwise return the delay."""
+        with self.__lock:
+            now = self.clock()
+            buckets = [self.global_bucket, *self.__get_chat_buckets(chat_id)]
+            delay = max(bucket.get_delay(now) for bucket in buckets)
+            if delay > 0:
+                return delay
+            for bucket in buckets:
+                bucket.consume(now)
+            self.slept += waited
+            return 0.0
+
+    def __get_chat_buckets(self, chat_id: int) -> list[TokenBucket]:
+        now = self.clock()
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) >= self.MAX_IDLE_BUCKETS:
+                self.__drop_idle_buckets(now)
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1, now)
+            # Group and channel IDs are negative
+            if chat_id < 0:
+                self.group_buckets[chat_id] = TokenBucket(self.group_rate, 1, now)
+
+        if chat_id < 0:
+            return [self.chat_buckets[chat_id], self.group_buckets[chat_id]]
+        return [self.chat_buckets[chat_id]]
+
+    def __drop_idle_buckets(self, now: float) -> None:
+        """Forget full buckets, they are the same as newly created ones."""
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            group_bucket = self.group_buckets.get(chat_id)
+            if bucket.is_full(now) and (group_bucket is None or group_bucket.is_full(now)):
+                del self.chat_buckets[chat_id]
+                self.group_buckets.pop(chat_id, None)
@@ -1,38 +1,496 @@
+import hashlib
+import re
+import time
+from collections import deque
+from collections.abc import Collection, Iterator
 from logging import Logger
-from datetime import datetime
+from datetime import datetime, timedelta
 from time import mktime
-from feedparser import FeedParserDict, parse
+from xml.etree.ElementTree import Element, ParseError, XMLPullParser, tostring
+import requests
+from feedparser import USER_AGENT, FeedParserDict, parse
+# Private helpers are used deliberately: streamed entries must get exactly the same links, IDs, dates and texts
+# as the entries parsed by feedparser, otherwise items would be reported as new after a switch of the parser.
+from feedparser.datetimes import _parse_date
+from feedparser.html import _cp1252
+from feedparser.mixin import _FeedParserMixin
+from feedparser.sanitizer import _sanitize_html
+from feedparser.urls import _urljoin, resolve_relative_uris
+from feed_url import normalize_url
+from http_client import create_session
+from metrics import Metrics
 
 
 class FeedItem:
+    """Item of a feed.
+
+    Items of a feed are kept in memory while the feed is processed, but only a few new ones are ever sent,
+    so the item is slotted, shares the strings with the parsed entry and creates the date only when it is needed.
+    """
+
+    __slots__ = ('url', 'guid', 'hash', 'title', 'description', '_date')
+
     def __init__(self, item: FeedParserDict) -> None:
-        self.url = item.get('link', '')
-        self.title = item.get('title', '')
-        self.description = item.get('summary', '')
-        self.guid = item.get('id', '')
-        if 'updated' in item:
-            self.date = datetime.fromtimestamp(mktime(item.updated_parsed))
-        elif 'published' in item:
-            self.date = datetime.fromtimestamp(mktime(item.published_parsed))
-        else:
-            self.date = None
+        self.url: str = item.get('link', '')
+        self.guid: str = item.get('id', '')
+        self.title: str = item.get('title', '')
+        self.description: str = item.get('summary', '')
+        self.hash: str = self.calculate_hash(self.url, self.title, self.description)
+        # The timestamp is much smaller than the time tuple and is converted to datetime on the first access
+        date_parsed = item.get('updated_parsed') or item.get('published_parsed')
+        self._date: float | datetime | None = mktime(date_parsed) if date_parsed else None
+
+    @classmethod
+    def from_values(cls, url: str, title: str, description: str, guid: str, date: datetime | None) -> 'FeedItem':
+        """Restore an item saved earlier."""
+        item = cls(FeedParserDict(link=url, title=title, summary=description, id=guid))
+        item._date = date
+        return item
+
+    @property
+    def key(self) -> str:
+        """Identity of the item in the feed: GUID, URL or the content hash if nothing else is available."""
+        return self.guid or self.url or self.hash
+
+    @property
+    def date(self) -> datetime | None:
+        if isinstance(self._date, float):
+            self._date = datetime.fromtimestamp(self._date)
+        return self._date
+
+    @staticmethod
+    def calculate_hash(url: str, title: str, description: str) -> str:
+        """Calculate a stable hash of the item content."""
+        return hashlib.sha1('\0'.join((url, title, description)).encode()).hexdigest()
 
 
 class Feed:
-    def __init__(self, url: str, feed: FeedParserDict) -> None:
+    __slots__ = (
+        'url', 'items', 'title', 'etag', 'last_modified', 'not_modified', 'moved_to', 'size', 'parse_time', 'complete'
+    )
+
+    def __init__(
+            self, url: str, feed: FeedParserDict | None, etag: str | None = None, last_modified: str | None = None
+    ) -> None:
+        """Create a feed. The parsed feed is None when the server reported that it has not been modified."""
         self.url = url
         self.items = []
+        self.title = ''
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = feed is None
+        # New URL of the feed if the server redirected to it permanently
+        self.moved_to: str | None = None
+        # Size of the document read and the time spent parsing it
+        self.size: int = 0
+        self.parse_time: float = 0.0
+        # Whether every entry of the document was read, otherwise the items missing from it could still be in the feed
+        self.complete: bool = True
+        if feed is None:
+            return
+
         self.title = feed.feed.get('title', '')
         for item in feed.entries:
             self.items.append(FeedItem(item))
 
+    @classmethod
+    def from_items(
+            cls, url: str, title: str, items: list[FeedItem], etag: str | None = None, last_modified: str | None = None
+    ) -> 'Feed':
+        """Create a feed of the items which were already read."""
+        feed = cls(url, FeedParserDict(feed=FeedParserDict(title=title), entries=[]), etag, last_modified)
+        feed.items = items
+        return feed
+
+
+class UnsupportedFeedError(Exception):
+    """The document could not be read by the streaming parser."""
+
+
+class StreamingFeedParser:
+    """Incremental parser of the common subset of RSS 2.0, RSS 1.0 and Atom.
+
+    Entries are produced as soon as they are read and dropped from the document tree afterwards, so the memory
+    does not grow with the size of the feed. Entries get the same keys and the same texts as the ones produced
+    by feedparser. UnsupportedFeedError is raised for anything unusual to let the caller fall back to feedparser.
+    """
+
+    ATOM_NS = 'http://www.w3.org/2005/Atom'
+    RSS1_NS = 'http://purl.org/rss/1.0/'
+    RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+    CONTENT_NS = 'http://purl.org/rss/1.0/modules/content/'
+    DC_NS = 'http://purl.org/dc/elements/1.1/'
+    XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+    HTML_TYPES = ('text/html', 'application/xhtml+xml')
+    CONTENT_TYPES = {'text': 'text/plain', 'plain': 'text/plain', 'html': 'text/html', 'xhtml': 'application/xhtml+xml'}
+    ENTRY_TAGS = ('{%s}entry' % ATOM_NS, 'item', '{%s}item' % RSS1_NS)
+    # Entry keys of the date elements
+    DATE_KEYS = {'pubDate': 'published', 'published': 'published', 'issued': 'published', 'updated': 'updated',
+                 'modified': 'updated'}
+    FEED_TAGS = ('{%s}feed' % ATOM_NS, 'channel', '{%s}channel' % RSS1_NS)
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url: str = base_url
+        self.title: str = ''
+        self.__parser: XMLPullParser = XMLPullParser(events=('start', 'end'))
+        self.__stack: list[Element] = []
+        self.__is_atom: bool = False
+
+    def feed(self, data: bytes) -> Iterator[FeedParserDict]:
+        """Parse the next chunk of the document and return the entries completed by it."""
+        self.__parser.feed(data)
+        return self.__read_events()
+
+    def close(self) -> Iterator[FeedParserDict]:
+        """Finish the document and return the remaining entries."""
+        self.__parser.close()
+        return self.__read_events()
+
+    def __read_events(self) -> Iterator[FeedParserDict]:
+        for event, element in self.__parser.read_events():
+            if event == 'start':
+                self.__start(element)
+                continue
+
+            self.__stack.pop()
+            if element.tag in self.ENTRY_TAGS and not any(parent.tag in self.ENTRY_TAGS for parent in self.__stack):
+                entry = self.__parse_entry(element)
+                # Forget the entry, the document is never kept as a whole.
+                self.__stack[-1].remove(element)
+                yield entry
+            elif self.__stack and element.tag in ('title', '{%s}title' % self.ATOM_NS, '{%s}title' % self.RSS1_NS):
+                if self.__stack[-1].tag in self.FEED_TAGS and not self.title:
+                    self.title = self.__get_content(element, 'text/plain')
+
+    def __start(self, element: Element) -> None:
+        if not self.__stack and element.tag not in ('rss', '{%s}feed' % self.ATOM_NS, '{%s}RDF' % self.RDF_NS):
+            raise UnsupportedFeedError(f'Unknown document type {element.tag}')
+        if not self.__stack:
+            self.__is_atom = element.tag == '{%s}feed' % self.ATOM_NS
+        if self.XML_BASE in element.attrib:
+            raise UnsupportedFeedError('xml:base is not supported')
+        self.__stack.append(element)
+
+    def __parse_entry(self, element: Element) -> FeedParserDict:
+        entry = FeedParserDict()
+        links = []
+        # feedparser keeps the first of the descriptions and the contents of the entry, whichever it is
+        summary = None
+        for child in element:
+            namespace, _, name = child.tag[1:].rpartition('}') if child.tag[0] == '{' else ('', '', child.tag)
+            if namespace == self.DC_NS and name == 'date':
+                self.__set_date(entry, 'updated', child.text)
+            elif namespace == self.CONTENT_NS and name == 'encoded':
+                summary = summary if summary is not None else self.__get_content(child, 'text/html')
+            elif namespace not in ('', self.ATOM_NS, self.RSS1_NS):
+                continue
+            elif name == 'title':
+                entry['title'] = self.__get_content(child, 'text/plain')
+            elif name == 'link' and 'href' in child.attrib:
+                links.append(child)
+            elif name == 'link':
+                # feedparser "fixes" query strings in the links in the same way
+                link = self.__resolve((child.text or '').strip()).replace('&amp;', '&')
+                entry['link'] = re.sub('&([A-Za-z0-9_]+);', r'&\g<1>', link)
+            elif name in ('guid', 'id'):
+                self.__set_id(entry, child)
+            elif name == 'description':
+                summary = summary if summary is not None else self.__get_content(child, 'text/html')
+            elif name in ('summary', 'content'):
+                summary = summary if summary is not None else self.__get_content(child, 'text/plain')
+            elif name in self.DATE_KEYS:
+                self.__set_date(entry, self.DATE_KEYS[name], child.text)
+
+        self.__set_link(entry, element, links)
+        if summary is not None:
+            entry['summary'] = summary
+        return entry
+
+    def __set_link(self, entry: FeedParserDict, element: Element, links: list[Element]) -> None:
+        """Set the link and the ID of the entry from its Atom links and RDF about attribute."""
+        about = element.get('{%s}about' % self.RDF_NS)
+        if about and 'id' not in entry:
+            entry['id'] = about
+        for link in links:
+            rel = link.get('rel', 'alternate').lower()
+            content_type = link.get('type', 'application/atom+xml' if rel == 'self' else 'text/html').lower()
+            if rel == 'alternate' and self.CONTENT_TYPES.get(content_type, content_type) in self.HTML_TYPES:
+                entry['link'] = self.__resolve(link.get('href').strip())
+        if entry.get('guidislink') and 'link' not in entry:
+            entry['link'] = entry['id']
+
+    def __set_id(self, entry: FeedParserDict, element: Element) -> None:
+        is_permalink = next((value for key, value in element.attrib.items() if key.lower() == 'ispermalink'), 'true')
+        entry['id'] = (element.text or '').strip()
+        entry['guidislink'] = is_permalink == 'true'
+        if entry['guidislink'] and entry['id']:
+            entry['id'] = self.__resolve(entry['id'])
+
+    def __resolve(self, url: str) -> str:
+        return _urljoin(self.base_url, url) if url else url
+
+    def __get_content(self, element: Element, default_type: str) -> str:
+        """Return the text of the element with the markup cleaned up like feedparser does it.
+
+        Relative URLs of HTML are resolved and the dangerous markup is removed, so the content hash of an item
+        does not depend on the parser which read it.
+        """
+        content_type = element.get('type', default_type).lower()
+        content_type = self.CONTENT_TYPES.get(content_type, content_type)
+        if element.get('mode') == 'base64' or not content_type.startswith('text/') and not content_type.endswith('xml'):
+            raise UnsupportedFeedError(f'Encoded content of type {content_type} is not supported')
+
+        text = self.__get_text(element)
+        # Unlike Atom, RSS does not tell whether the text is HTML, so it is guessed
+        if not self.__is_atom and content_type == 'text/plain' and _FeedParserMixin.looks_like_html(text):
+            content_type = 'text/html'
+        if content_type in self.HTML_TYPES:
+            text = _sanitize_html(resolve_relative_uris(text, self.base_url, 'utf-8', content_type), 'utf-8', content_type)
+        try:
+            # UTF-8 text which was encoded twice is restored
+            text = text.encode('iso-8859-1').decode('utf-8')
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+        return text.translate(_cp1252)
+
+    @staticmethod
+    def __set_date(entry: FeedParserDict, name: str, value: str | None) -> None:
+        value = (value or '').strip()
+        entry[name] = value
+        entry[name + '_parsed'] = _parse_date(value)
+        if entry[name + '_parsed'] is None:
+            # feedparser keeps unparseable dates as well, but FeedItem expects them to be parsed
+            del entry[name], entry[name + '_parsed']
+
+    @staticmethod
+    def __get_text(element: Element) -> str:
+        if element.get('type') == 'xhtml':
+            for child in element.iter():
+                child.tag = child.tag.rpartition('}')[2]
+            # Atom wraps XHTML into a div which is not a part of the text
+            if len(element) == 1 and element[0].tag == 'div' and not (element.text or '').strip():
+                element = element[0]
+            inner = ''.join(tostring(child, encoding='unicode') for child in element)
+            return ((element.text or '') + inner).strip()
+        if len(element):
+            raise UnsupportedFeedError(f'Markup in {element.tag} is not supported')
+        return (element.text or '').strip()
+
+
+class EntrySelector:
+    """Decide which entries of a feed are worth reading, so the rest of the document could be skipped.
+
+    While the dates show that the feed is ordered from the newest entries, the reading stops after the limit
+    of entries, after several known entries in a row or after several entries older than the cutoff. The order
+    is decided by most of the consecutive dates, so a pinned or bumped entry does not change it. Feeds without
+    dates are expected to be ordered from the newest entries too. Feeds ordered from the oldest entries are read
+    to the end keeping the last entries up to the limit.
+    """
+
+    KNOWN_ENTRIES_LIMIT = 3
+
+    def __init__(self, known_keys: Collection[str], max_entries: int, max_age: timedelta | None = None) -> None:
+        self.known_keys: Collection[str] = known_keys
+        self.max_entries: int = max_entries
+        self.cutoff: datetime | None = datetime.now() - max_age if max_age else None
+        self.items: deque[FeedItem] = deque(maxlen=max_entries)
+        # Whether every entry was either taken or older than the cutoff
+        self.complete: bool = True
+        self.__known_in_row: int = 0
+        self.__old_in_row: int = 0
+        self.__last_date: datetime | None = None
+        # Consecutive dated entries going back and forward in time
+        self.__older_steps: int = 0
+        self.__newer_steps: int = 0
+
+    def add(self, entry: FeedParserDict) -> bool:
+        """Take the item of the entry if it is needed and return False when the rest of the feed should be skipped."""
+        item = FeedItem(entry)
+        if item.date is not None:
+            if self.__last_date is not None and item.date < self.__last_date:
+                self.__older_steps += 1
+            elif self.__last_date is not None and item.date > self.__last_date:
+                self.__newer_steps += 1
+            self.__last_date = item.date
+        newest_first = self.__older_steps >= self.__newer_steps
+
+        if self.cutoff is not None and item.date is not None and item.date < self.cutoff:
+            self.__old_in_row += 1
+            if newest_first and self.__old_in_row >= self.KNOWN_ENTRIES_LIMIT:
+                return self.__stop()
+            return True
+        self.__old_in_row = 0
+
+        # Known entries are still taken to let the database know they are in the feed.
+        if len(self.items) == self.max_entries:
+            # Only the feeds ordered from the oldest entries get here, their first entries are dropped
+            self.complete = False
+        self.items.append(item)
+        self.__known_in_row = self.__known_in_row + 1 if item.key in self.known_keys else 0
+
+        if newest_first and len(self.items) >= self.max_entries:
+            return self.__stop()
+        if newest_first and self.__known_in_row >= self.KNOWN_ENTRIES_LIMIT:
+            return self.__stop()
+        return True
+
+    def __stop(self) -> bool:
+        """Remember that the rest of the feed is skipped and return False."""
+        self.complete = False
+        return False
+
 
 class RssReader:
 
-    def __init__(self, logger: Logger):
+    CHUNK_SIZE = 64 * 1024
+    STREAMED_CHARSETS = ('utf-8', 'utf8', 'us-ascii')
+    PERMANENT_REDIRECTS = (301, 308)
+    # Rest of the response which is still read when the reading stops early, so the connection could be reused
+    DRAIN_LIMIT = 256 * 1024
+
+    def __init__(
+            self, logger: Logger, timeout: float = 30, max_size: int = 10 * 1024 * 1024, max_items: int = 200,
+            max_age: timedelta | None = None, session: requests.Session | None = None, connect_timeout: float = 10,
+            metrics: Metrics | None = None
+    ):
         self.log: Logger = logger
-        self.log.debug('RssReader.__init__(logger=%s)', logger)
+        self.log.debug(
+            'RssReader.__init__(logger=%s, timeout=%s, max_size=%d, max_items=%d, max_age=%s, session=%s, '
+            'connect_timeout=%s, metrics=%s)',
+            logger, timeout, max_size, max_items, max_age, session, connect_timeout, metrics
+        )
+        self.metrics: Metrics = metrics if metrics is not None else Metrics()
+        self.session: requests.Session = session or create_session(USER_AGENT)
+        self.timeout: float = timeout
+        self.connect_timeout: float = connect_timeout
+        self.max_size: int = max_size
+        self.max_items: int = max_items
+        self.max_age: timedelta | None = max_age
+
+    def get_feed(
+            self, url: str, etag: str | None = None, last_modified: str | None = None, known_keys: Collection[str] = ()
+    ) -> Feed:
+        """Download and parse the feed. Cache validators from the previous fetch allow to skip unchanged feeds.
+
+        Only the head of the feed is read: the reading stops at the entries with known keys, at the entries older
+        than the maximal age and at the maximal number of entries or the maximal size of the document.
+        """
+        self.log.debug(
+            'get_feed(url=\'%s\', etag=\'%s\', last_modified=\'%s\', known_keys=%d)',
+            url, etag, last_modified, len(known_keys)
+        )
+        request_headers = {}
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+
+        timeout = (self.connect_timeout, self.timeout)
+        with self.session.get(url, headers=request_headers, timeout=timeout, stream=True) as response:
+            self.metrics.inc('feed_responses_total', status=str(response.status_code))
+            response.raise_for_status()
+
+            if response.status_code == 304:
+                self.log.debug('Feed is not modified')
+                feed = Feed(url, None, etag, last_modified)
+            else:
+                started = time.perf_counter()
+                stats = {'size': 0, 'read_time': 0.0, 'truncated': False}
+                title, items = self.__parse_response(response, known_keys, stats)
+                self.__release_connection(response)
+                feed = Feed.from_items(url, title, items, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                feed.complete = stats['complete'] and not stats['truncated']
+                feed.size = stats['size']
+                feed.parse_time = time.perf_counter() - started - stats['read_time']
+                self.metrics.inc('feed_parser_total', parser=stats['parser'])
+                self.metrics.inc('feed_downloaded_bytes_total', feed.size)
+                self.metrics.inc('feed_items_read_total', len(feed.items))
+                self.metrics.observe('feed_parse_duration_seconds', feed.parse_time)
+
+            if response.history and all(r.status_code in self.PERMANENT_REDIRECTS for r in response.history):
+                self.log.info('%s has moved permanently to %s', url, response.url)
+                feed.moved_to = normalize_url(response.url)
+
+            return feed
+
+    def __parse_response(
+            self, response: requests.Response, known_keys: Collection[str], stats: dict
+    ) -> tuple[str, list[FeedItem]]:
+        """Read the title and the items of the feed."""
+        selector = EntrySelector(known_keys, self.max_items, self.max_age)
+        parser = StreamingFeedParser(response.url)
+        # The document is kept until it is clear that the streaming parser understands it.
+        document = bytearray()
+        chunks = self.__read_chunks(response, stats)
+        stats['parser'] = 'stream'
+
+        try:
+            if not self.__is_streamed(response):
+                raise UnsupportedFeedError(f'Charset of {response.headers.get("Content-Type")} is not supported')
+            for chunk in chunks:
+                document += chunk
+                for entry in parser.feed(chunk):
+                    if not selector.add(entry):
+                        self.log.debug('Reading stopped after %d entries and %d bytes', len(selector.items), len(document))
+                        stats['complete'] = False
+                        return parser.title, list(selector.items)
+            for entry in parser.close():
+                if not selector.add(entry):
+                    break
+            stats['complete'] = selector.complete
+            return parser.title, list(selector.items)
+        except ParseError as exception:
+            if len(document) >= self.max_size and selector.items:
+                # The document was cut at the maximal size, the entries read before are still good.
+                stats['complete'] = False
+                return parser.title, list(selector.items)
+            self.log.debug('Falling back to feedparser: %s', exception)
+        except UnsupportedFeedError as exception:
+            self.log.debug('Falling back to feedparser: %s', exception)
+
+        stats['parser'] = 'feedparser'
+        for chunk in chunks:
+            document += chunk
+
+        # Let feedparser detect the encoding and resolve relative links as if it fetched the document itself.
+        headers = {key.lower(): value for key, value in response.headers.items()}
+        headers.setdefault('content-location', response.url)
+        parsed = parse(bytes(document), response_headers=headers)
+
+        selector = EntrySelector(known_keys, self.max_items, self.max_age)
+        for entry in parsed.entries:
+            if not selector.add(entry):
+                break
+        stats['complete'] = selector.complete
+        return parsed.feed.get('title', ''), list(selector.items)
+
+    def __release_connection(self, response: requests.Response) -> None:
+        """Read the rest of a small response, otherwise the connection is closed instead of returning to the pool."""
+        length = response.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) - response.raw.tell() <= self.DRAIN_LIMIT:
+            response.raw.drain_conn()
+
+    def __read_chunks(self, response: requests.Response, stats: dict) -> Iterator[bytes]:
+        """Read the decompressed document up to the maximal size counting its size and the time spent reading."""
+        chunks = response.iter_content(self.CHUNK_SIZE)
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            stats['read_time'] += time.perf_counter() - started
+            if chunk is None:
+                return
+
+            stats['size'] += len(chunk)
+            if stats['size'] > self.max_size:
+                self.log.warning('%s is larger than %d bytes, the rest is skipped', response.url, self.max_size)
+                self.metrics.inc('feed_truncated_total')
+                stats['truncated'] = True
+                yield chunk[:len(chunk) - (stats['size'] - self.max_size)]
+                stats['size'] = self.max_size
+                return
+            yield chunk
 
-    def get_feed(self, url: str) -> Feed:
-        self.log.debug('get_feed(url=\'%s\')', url)
-        return Feed(url, parse(url))
+    def __is_streamed(self, response: requests.Response) -> bool:
+        """The streaming parser relies on the XML declaration, so the documents with other charsets are left to feedparser."""
+        charset = re.search(r'charset=["\']?([\w.:-]+)', response.headers.get('Content-Type', ''), re.IGNORECASE)
+        return charset is None or charset.group(1).lower() in self.STREAMED_CHARSETS
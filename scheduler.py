@@ -0,0 +1,120 @@
+import time
+from logging import Logger
+from threading import Event
+
+from database import Database
+from update_manager import UpdateManager
+
+
+class FeedSchedule:
+    """Polling state of a single feed."""
+
+    def __init__(self, feed: dict, interval: float, next_update: float) -> None:
+        self.feed: dict = feed
+        self.interval: float = interval
+        self.next_update: float = next_update
+        self.failures: int = 0
+
+
+class UpdateScheduler:
+    """Keeps updating feeds, polling each feed with an interval adapted to its publishing frequency."""
+
+    # Interval multipliers for active and idle feeds
+    SPEED_UP_FACTOR: float = 0.5
+    SLOW_DOWN_FACTOR: float = 1.5
+
+    def __init__(
+            self, database: Database, update_manager: UpdateManager, logger: Logger,
+            min_interval: float = 300, max_interval: float = 86400, refresh_interval: float = 60
+    ) -> None:
+        self.log: Logger = logger
+        self.log.debug(
+            'UpdateScheduler.__init__(database=%s, update_manager=%s, logger=%s, min_interval=%s, max_interval=%s, '
+            'refresh_interval=%s)',
+            database, update_manager, logger, min_interval, max_interval, refresh_interval
+        )
+        self.database: Database = database
+        self.update_manager: UpdateManager = update_manager
+        self.min_interval: float = min_interval
+        self.max_interval: float = max_interval
+        self.refresh_interval: float = refresh_interval
+        self.schedules: dict[int, FeedSchedule] = {}
+        self.__stop_event: Event = Event()
+        self.__next_refresh: float = 0
+
+    def run(self) -> None:
+        """Run the update loop until stop() is called."""
+        self.log.info('Starting the update scheduler')
+        while not self.__stop_event.is_set():
+            now = time.monotonic()
+            if now >= self.__next_refresh:
+                try:
+                    self.__refresh_feeds(now)
+                except Exception:  # pylint: disable=broad-except
+                    # The feeds known so far are still updated
+                    self.log.exception('Unable to refresh the feed list')
+                self.__next_refresh = now + self.refresh_interval
+
+            due = [schedule for schedule in self.schedules.values() if schedule.next_update <= now]
+            if not due:
+                # pylint reads Event.wait() as the one telebot.util.OrEvent patches in, which has no arguments
+                self.__stop_event.wait(self.__get_sleep_time(now))  # pylint: disable=too-many-function-args
+                continue
+
+            # The most overdue feeds are updated first, the stop is checked after every batch
+            due.sort(key=lambda schedule: schedule.next_update)
+            for start in range(0, len(due), self.update_manager.batch_size):
+                batch = due[start:start + self.update_manager.batch_size]
+                try:
+                    results = self.update_manager.update_feeds([schedule.feed for schedule in batch])
+                except Exception:  # pylint: disable=broad-except
+                    # The feeds of the batch back off like the failed ones
+                    self.log.exception('Unable to update a batch of %d feeds', len(batch))
+                    results = {}
+                finished = time.monotonic()
+                for schedule in batch:
+                    self.__reschedule(schedule, results.get(schedule.feed['id']), finished)
+                if self.__stop_event.is_set():
+                    break
+
+        self.log.info('Update scheduler stopped')
+
+    def stop(self) -> None:
+        """Request the scheduler to stop after the batch of feeds being updated right now is processed."""
+        self.log.info('Stopping the update scheduler')
+        self.__stop_event.set()
+
+    def __refresh_feeds(self, now: float) -> None:
+        """Synchronize the schedule with the feed list from the database."""
+        self.log.debug('__refresh_feeds()')
+        feeds = {feed['id']: feed for feed in self.database.find_feeds()}
+
+        for feed_id in self.schedules.keys() - feeds.keys():
+            self.log.debug('Feed %d was removed', feed_id)
+            del self.schedules[feed_id]
+
+        for feed_id, feed in feeds.items():
+            if feed_id in self.schedules:
+                self.schedules[feed_id].feed = feed
+            else:
+                self.log.debug('New feed [%d] %s', feed_id, feed['url'])
+                self.schedules[feed_id] = FeedSchedule(feed, self.min_interval, now)
+
+    def __reschedule(self, schedule: FeedSchedule, new_items: int | None, now: float) -> None:
+        """Calculate the next update time of the feed."""
+        if new_items is None:
+            # Exponential backoff for failing feeds
+            schedule.failures += 1
+            delay = min(self.max_interval, schedule.interval * 2 ** schedule.failures)
+        else:
+            schedule.failures = 0
+            factor = self.SPEED_UP_FACTOR if new_items else self.SLOW_DOWN_FACTOR
+            schedule.interval = min(self.max_interval, max(self.min_interval, schedule.interval * factor))
+            delay = schedule.interval
+
+        schedule.next_update = now + delay
+        self.log.debug('Next update of [%d] in %d seconds', schedule.feed['id'], delay)
+
+    def __get_sleep_time(self, now: float) -> float:
+        next_update = min((schedule.next_update for schedule in self.schedules.values()), default=self.__next_refresh)
+        return max(0.0, min(next_update, self.__next_refresh) - now)
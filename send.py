@@ -0,0 +1,25 @@
+import argparse
+import signal
+
+from app import Config, create_database, create_delivery_workers, create_metrics, setup_logging
+
+
+parser = argparse.ArgumentParser(description='Deliver the queued updates to the subscribers.')
+parser.add_argument('--daemon', action='store_true', help='keep waiting for new updates when the queue is empty')
+args = parser.parse_args()
+
+config = Config()
+setup_logging(config, 'the sender')
+metrics = create_metrics(config)
+db = create_database(config, metrics)
+worker, = create_delivery_workers(config, db, metrics, 1)
+
+signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+if not args.daemon:
+    worker.finish()
+try:
+    worker.run()
+finally:
+    if config.metrics_file:
+        metrics.write(config.metrics_file)
@@ -1,43 +1,108 @@
+from __future__ import annotations
+
+import heapq
 import time
+from collections import deque
+from collections.abc import Callable
+from html import escape
 from logging import Logger
-from bleach.sanitizer import Cleaner
+from typing import TYPE_CHECKING
+from requests import RequestException
 from telebot import TeleBot
+from telebot.apihelper import ApiException, ApiTelegramException
 from telebot.handler_backends import BaseMiddleware
-from telebot.types import Message
-import validators
+from telebot.types import Message, Update
 
+from cache import LruCache
 from database import Database
 from exceptions import DisplayableException
-from rss import FeedItem
+from feed_url import get_url_key, normalize_url
+from http_client import UrlChecker
+from metrics import Metrics
+from opml import build_opml, parse_opml
+from rate_limiter import RateLimiter
+
+if TYPE_CHECKING:
+    # The sanitizer and the feed parser are slow to import and not needed by the bot
+    from bleach.sanitizer import Cleaner
+    from rss import FeedItem
+
+
+class BatchSafeTeleBot(TeleBot):
+    """TeleBot handling every message of an update batch when class middlewares are used.
+
+    pyTelegramBotAPI 4.5.0 stops after the first message of a batch in this mode, so the commands sent
+    by other users at the same time were lost.
+    """
+
+    def _notify_command_handlers(self, handlers, new_messages, update_type):
+        for message in new_messages:
+            super()._notify_command_handlers(handlers, [message], update_type)
 
 
 class CommandProcessor:
     """Processes user input and dispatches the data to other services."""
 
-    def __init__(self, token: str, database: Database, logger: Logger):
+    # Maximum amount of keywords in the filter of a subscription
+    FILTER_MAX_KEYWORDS: int = 20
+    # Maximum length of a filter keyword
+    FILTER_MAX_KEYWORD_LENGTH: int = 50
+    # Maximum amount of feeds in an imported OPML file
+    IMPORT_MAX_FEEDS: int = 1000
+    # Maximum size of an imported OPML file in bytes
+    IMPORT_MAX_FILE_SIZE: int = 1024 * 1024
+
+    def __init__(
+            self, token: str, database: Database, logger: Logger, threaded: bool = True, url_checker: UrlChecker | None = None
+    ):
         self.log = logger
         self.log.debug(
-            'CommandProcessor.__init__(token=\'%s\', database=%s, logger=%s)', token[:8] + '...', database, logger
+            'CommandProcessor.__init__(token=\'%s\', database=%s, logger=%s, threaded=%s, url_checker=%s)',
+            token[:8] + '...', database, logger, threaded, url_checker
         )
         if token is None or len(token) == 0:
             raise ValueError("Token should not be empty")
-        self.bot: TeleBot = TeleBot(token, use_class_middlewares=True)
+        # Without threads the updates are handled in the thread which passes them to process_updates()
+        self.bot: TeleBot = BatchSafeTeleBot(token, threaded=threaded, use_class_middlewares=True)
         self.bot.setup_middleware(UserAuthMiddleware(database, logger))
         self.bot.setup_middleware(ExceptionHandlerMiddleware(self.bot, logger))
         self.database: Database = database
+        self.url_checker: UrlChecker = url_checker if url_checker is not None else UrlChecker(logger)
 
-    def run(self):
-        """Run a bot and poll for new messages indefinitely."""
         self.log.debug('Registering handlers')
         self.bot.register_message_handler(commands=['add'], callback=self.__add_feed)
         self.bot.register_message_handler(commands=['list'], callback=self.__list_feeds)
         self.bot.register_message_handler(commands=['del'], callback=self.__delete_feed)
+        self.bot.register_message_handler(commands=['digest'], callback=self.__digest_mode)
+        self.bot.register_message_handler(commands=['filter'], callback=self.__filter)
+        self.bot.register_message_handler(commands=['import'], callback=self.__import_feeds)
+        self.bot.register_message_handler(content_types=['document'], callback=self.__import_feeds)
+        self.bot.register_message_handler(commands=['export'], callback=self.__export_feeds)
         self.bot.register_message_handler(commands=['help', 'start'], callback=self.__command_help)
         self.bot.register_message_handler(callback=self.__command_help)
 
+    def run(self):
+        """Run a bot and poll for new messages indefinitely."""
         self.log.info('Starting to poll the servers')
+        # Polling does not work while a webhook is set
+        self.bot.remove_webhook()
         self.bot.infinity_polling()
 
+    def stop(self):
+        """Stop polling the servers. Could be called from a signal handler."""
+        self.log.info('Stopping polling')
+        self.bot.stop_polling()
+
+    def set_webhook(self, url: str, max_connections: int):
+        """Ask Telegram to send the updates to the URL instead of waiting for them to be polled."""
+        # The URL is not logged, its path is the secret of the webhook
+        self.log.info('Setting the webhook')
+        self.bot.set_webhook(url=url, max_connections=max_connections)
+
+    def process_updates(self, updates: list[Update]):
+        """Handle the updates received by the webhook."""
+        self.bot.process_new_updates(updates)
+
     def __command_help(self, message: Message, data: dict):
         # pylint: disable=unused-argument
         self.log.debug('__command_help(message=\'%s\', data=\'%s\')', message, data)
@@ -47,6 +112,10 @@ class CommandProcessor:
             '  /add <feed url> - Add new feed\n'
             '  /list - List currently added feeds\n'
             '  /del <feed url> - Remove feed\n'
+            '  /digest [off|feed|all] - Show or change how updates are grouped into messages\n'
+            '  /filter <feed url> [word -word ...|off] - Show or change the keywords updates of a feed should contain\n'
+            '  /import - Subscribe to the feeds of an OPML file sent to the bot\n'
+            '  /export - Get the list of your feeds as an OPML file\n'
             '  /help - Get this help message'
         )
 
@@ -61,7 +130,7 @@ class CommandProcessor:
         if not self.__is_url_valid(url):
             raise DisplayableException('Invalid feed URL')
 
-        self.database.subscribe_user_by_url(data['user_id'], url)
+        self.database.subscribe_user_by_url(data['user_id'], normalize_url(url))
         self.log.info('Subscription added')
 
         self.bot.reply_to(message, 'Successfully subscribed to feed.')
@@ -92,8 +161,131 @@ class CommandProcessor:
 
         self.bot.reply_to(message, 'Unsubscribed.')
 
+    def __digest_mode(self, message: Message, data: dict):
+        self.log.debug('__digest_mode(message=\'%s\', data=\'%s\')', message, data)
+        args = message.text.split()
+        if len(args) < 2:
+            digest_mode = self.database.get_user_digest_mode(data['user_id'])
+            self.bot.reply_to(
+                message,
+                f'Current digest mode: {digest_mode}\n'
+                '  off - Send every update in a separate message\n'
+                '  feed - Group updates of a feed into as few messages as possible\n'
+                '  all - Group updates of all feeds into as few messages as possible'
+            )
+            return
+
+        digest_mode = args[1].lower()
+        if digest_mode not in Notifier.DIGEST_MODES:
+            raise DisplayableException('Digest mode should be one of: ' + ', '.join(Notifier.DIGEST_MODES))
+
+        self.log.info('User %s changed digest mode to %s', data['user_id'], digest_mode)
+        self.database.set_user_digest_mode(data['user_id'], digest_mode)
+
+        self.bot.reply_to(message, f'Digest mode changed to {digest_mode}.')
+
+    def __filter(self, message: Message, data: dict):
+        self.log.debug('__filter(message=\'%s\', data=\'%s\')', message, data)
+        args = message.text.split()
+        if len(args) < 2:
+            raise DisplayableException('Feed URL should be specified')
+
+        url = str(args[1])
+        if not self.__is_url_valid(url):
+            raise DisplayableException('Invalid feed URL')
+
+        if len(args) < 3:
+            include_keywords, exclude_keywords = self.database.get_subscription_filters(data['user_id'], url)
+            self.bot.reply_to(
+                message,
+                f'Included keywords: {", ".join(include_keywords) or "-"}\n'
+                f'Excluded keywords: {", ".join(exclude_keywords) or "-"}\n'
+                'Only the updates containing any of the included keywords (if there are any) and none of '
+                'the excluded ones are sent. Change the filter with /filter <feed url> word -excluded_word ..., '
+                'remove it with /filter <feed url> off'
+            )
+            return
+
+        keywords = [] if args[2:] == ['off'] else [keyword.lower() for keyword in args[2:]]
+        if len(keywords) > self.FILTER_MAX_KEYWORDS:
+            raise DisplayableException(f'No more than {self.FILTER_MAX_KEYWORDS} keywords are allowed')
+        if any(len(keyword.lstrip('-')) > self.FILTER_MAX_KEYWORD_LENGTH for keyword in keywords):
+            raise DisplayableException(f'Keywords should not be longer than {self.FILTER_MAX_KEYWORD_LENGTH} characters')
+        if '-' in keywords:
+            raise DisplayableException('Keywords should not be empty')
+
+        include_keywords = list(dict.fromkeys(keyword for keyword in keywords if not keyword.startswith('-')))
+        exclude_keywords = list(dict.fromkeys(keyword[1:] for keyword in keywords if keyword.startswith('-')))
+        self.log.info('User %s changed the filter of %s', data['user_id'], url)
+        self.database.set_subscription_filters(data['user_id'], url, include_keywords, exclude_keywords)
+
+        self.bot.reply_to(message, 'Filter removed.' if not keywords else 'Filter changed.')
+
+    def __import_feeds(self, message: Message, data: dict):
+        self.log.debug('__import_feeds(message=\'%s\', data=\'%s\')', message, data)
+        # The file could be sent with any caption or replied to with /import
+        document = message.document
+        if document is None and message.reply_to_message is not None:
+            document = message.reply_to_message.document
+        if document is None:
+            self.bot.reply_to(message, 'Send an OPML file exported from another reader to subscribe to all its feeds.')
+            return
+        if document.file_size is not None and document.file_size > self.IMPORT_MAX_FILE_SIZE:
+            raise DisplayableException(f'The file should not be larger than {self.IMPORT_MAX_FILE_SIZE // 1024} KB')
+
+        urls = parse_opml(self.bot.download_file(self.bot.get_file(document.file_id).file_path))
+        if not urls:
+            raise DisplayableException('No feeds found in the file')
+        if len(urls) > self.IMPORT_MAX_FEEDS:
+            raise DisplayableException(f'No more than {self.IMPORT_MAX_FEEDS} feeds could be imported at once')
+        self.log.info('User %s requested to import %d feeds', data['user_id'], len(urls))
+
+        invalid_urls = []
+        # URLs of the same feed are imported once, the feeds the user is subscribed to are not checked
+        new_urls: dict[str, str] = {}
+        for url in urls:
+            if self.__is_url_valid(url):
+                new_urls.setdefault(get_url_key(url), normalize_url(url))
+            else:
+                invalid_urls.append(url)
+        subscribed_keys = {get_url_key(feed['url']) for feed in self.database.find_user_feeds(data['user_id'])}
+        checked_urls = [url for url_key, url in new_urls.items() if url_key not in subscribed_keys]
+
+        self.bot.reply_to(message, f'Found {len(urls)} feeds, checking {len(checked_urls)} new ones...')
+        unreachable = self.url_checker.find_unreachable(checked_urls)
+        reachable_urls = [url for url in checked_urls if url not in unreachable]
+        subscribed_urls = self.database.subscribe_user_by_urls(data['user_id'], reachable_urls)
+        self.log.info('User %s subscribed to %d imported feeds', data['user_id'], len(subscribed_urls))
+
+        lines = [
+            f'Subscribed to {len(subscribed_urls)} feeds.',
+            f'Already subscribed: {len(new_urls) - len(subscribed_urls) - len(unreachable)}.',
+        ]
+        if invalid_urls:
+            lines += [f'Invalid URLs ({len(invalid_urls)}):'] + invalid_urls
+        if unreachable:
+            lines += [f'Unreachable feeds ({len(unreachable)}):'] + [f'{url} - {error}' for url, error in unreachable.items()]
+        text = '\n'.join(lines)
+        if len(text) > Notifier.MESSAGE_LENGTH_LIMIT:
+            text = text[:Notifier.MESSAGE_LENGTH_LIMIT - 4].rsplit('\n', 1)[0] + '\n...'
+        self.bot.reply_to(message, text)
+
+    def __export_feeds(self, message: Message, data: dict):
+        self.log.debug('__export_feeds(message=\'%s\', data=\'%s\')', message, data)
+        feeds = self.database.find_user_feeds(data['user_id'])
+        if not feeds:
+            raise DisplayableException('No feeds to export')
+
+        document = build_opml([feed['url'] for feed in feeds], 'RSS bot subscriptions')
+        self.bot.send_document(
+            message.chat.id, document, reply_to_message_id=message.message_id, visible_file_name='feeds.opml'
+        )
+
     @staticmethod
     def __is_url_valid(url: str) -> bool:
+        # Imported on the first command, so it does not slow down the start
+        import validators  # pylint: disable=import-outside-toplevel
+
         if not validators.url(url):
             return False
 
@@ -106,23 +298,49 @@ class CommandProcessor:
 class Notifier:
     """Sends notifications to users about new RSS feed items."""
 
-    # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
-    BATCH_LIMIT: int = 25
     # https://core.telegram.org/bots/api#sendmessage
     MESSAGE_LENGTH_LIMIT: int = 4096
-
-    sent_counter: int = 0
-
-    def __init__(self, token: str, logger: Logger):
+    # How many times to retry a message after the 429 Too Many Requests or a network error
+    MAX_RETRIES: int = 5
+
+    # Every item is sent in a separate message
+    DIGEST_OFF: str = 'off'
+    # Items of a feed are packed into as few messages as possible
+    DIGEST_FEED: str = 'feed'
+    # Items of all feeds are packed into as few messages as possible once per update run
+    DIGEST_ALL: str = 'all'
+    DIGEST_MODES: tuple[str, ...] = (DIGEST_OFF, DIGEST_FEED, DIGEST_ALL)
+    # Maximum length of an item description in digests
+    DIGEST_DESCRIPTION_LIMIT: int = 300
+    # Amount of rendered items kept in memory
+    RENDER_CACHE_SIZE: int = 10000
+
+    def __init__(
+            self, token: str, logger: Logger, rate_limiter: RateLimiter | None = None, metrics: Metrics | None = None
+    ):
         self.log = logger
-        self.log.debug('Notifier.__init__(token=\'%s\', logger=%s)', token[:8] + '...', logger)
-        self.bot: TeleBot = TeleBot(token)
-        self.html_sanitizer: Cleaner = Cleaner(
-            tags=[],
-            attributes={},
-            protocols=[],
-            strip=True,
+        self.log.debug(
+            'Notifier.__init__(token=\'%s\', logger=%s, rate_limiter=%s, metrics=%s)',
+            token[:8] + '...', logger, rate_limiter, metrics
         )
+        self.bot: TeleBot = TeleBot(token)
+        self.rate_limiter: RateLimiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics: Metrics = metrics if metrics is not None else Metrics()
+        # Created on the first use, as most runs of the updater send nothing
+        self.html_sanitizer: Cleaner | None = None
+        self.__queues: dict[int, deque[tuple[str, str | None]]] = {}
+        self.__digests: dict[int, list[str]] = {}
+        self.__render_cache: LruCache = LruCache(self.RENDER_CACHE_SIZE)
+        self.sanitizer_calls: int = 0
+        self.sanitizer_time: float = 0.0
+
+    @property
+    def render_cache_hits(self) -> int:
+        return self.__render_cache.hits
+
+    @property
+    def render_cache_misses(self) -> int:
+        return self.__render_cache.misses
 
     def send_updates(self, chat_ids: list[int], updates: list[FeedItem], feed_title: str):
         """Send notification about new items to the user"""
@@ -130,63 +348,224 @@ class Notifier:
             'send_updates(chat_ids=list(%d), updates=list(%d), feed_title=\'%s\')',
             len(chat_ids), len(updates), feed_title
         )
-        if not updates:
-            self.log.debug('No updates to send')
-            return
+        self.queue_updates(dict.fromkeys(chat_ids, self.DIGEST_OFF), updates, feed_title)
+        self.send_queued()
 
-        self.log.debug('%d updates to send to %d chats', len(updates), len(chat_ids))
-        for chat_id in chat_ids:
-            self.log.debug('Processing chat_id=%s', chat_id)
-            self.__count_request_and_wait()
-            self.bot.send_message(
-                chat_id=chat_id,
-                text=f'Updates from the {feed_title} feed:'
-            )
-
-            for update in updates:
-                self.__count_request_and_wait()
-                self.__send_update(chat_id, update)
-
-    def __send_update(self, chat_id: int, update: FeedItem):
-        self.log.debug('__send_update(chat_id=\'%s\', update=\'%s\')', chat_id, update)
-        self.bot.send_message(
-            chat_id=chat_id,
-            text=self.__format_message(update),
-            parse_mode='HTML'
+    def queue_updates(self, subscribers: dict[int, str], updates: list[FeedItem], feed_title: str):
+        """Queue notifications about new items for the chats according to their digest modes."""
+        self.log.debug(
+            'queue_updates(subscribers=dict(%d), updates=list(%d), feed_title=\'%s\')',
+            len(subscribers), len(updates), feed_title
         )
+        if not updates:
+            self.log.debug('No updates to queue')
+            return
 
-    def __count_request_and_wait(self):
-        self.log.debug('__count_request_and_wait()')
-        if self.sent_counter >= self.BATCH_LIMIT:
-            self.log.debug('Requests limit exceeded, sleeping for a second')
-            time.sleep(1)
-            self.log.debug('Resetting counter')
-            self.sent_counter = 0
-        self.sent_counter += 1
+        messages: list[tuple[str, str | None]] = []
+        digest_messages: list[tuple[str, str | None]] = []
+        digest_section: list[str] = []
+
+        for chat_id, digest_mode in subscribers.items():
+            if digest_mode == self.DIGEST_ALL:
+                if not digest_section:
+                    digest_section = self.__format_digest_section(updates, feed_title)
+                self.__digests.setdefault(chat_id, []).extend(digest_section)
+                continue
+
+            if digest_mode == self.DIGEST_FEED:
+                if not digest_messages:
+                    digest_messages = [
+                        (text, 'HTML') for text in self.__pack_blocks(self.__format_digest_section(updates, feed_title))
+                    ]
+                self.__queues.setdefault(chat_id, deque()).extend(digest_messages)
+                continue
+
+            if not messages:
+                messages = [(f'Updates from the {feed_title} feed:', None)]
+                messages += [(self.__format_message(update), 'HTML') for update in updates]
+            self.__queues.setdefault(chat_id, deque()).extend(messages)
+
+    def send_queued(self, on_sent: Callable[[int], None] | None = None):
+        """Send the queued per-item and per-feed notifications.
+
+        on_sent is called with the chat ID once all messages of the chat are sent or rejected by Telegram.
+        It is not called for the chats given up on after network errors, their messages could be sent later.
+        """
+        self.log.debug('send_queued(on_sent=%s)', on_sent)
+        queues = self.take_queued()
+        if queues:
+            self.__send_messages(queues, on_sent)
+
+    def send_digests(self, on_sent: Callable[[int], None] | None = None):
+        """Send the queued notifications together with the digests of all feeds collected during the run."""
+        self.log.debug('send_digests(on_sent=%s)', on_sent)
+        self.queue_digests()
+        self.send_queued(on_sent)
+
+    def queue_digests(self):
+        """Pack the digests of all feeds collected during the run into messages and queue them."""
+        digests, self.__digests = self.__digests, {}
+        for chat_id, blocks in digests.items():
+            self.__queues.setdefault(chat_id, deque()).extend((text, 'HTML') for text in self.__pack_blocks(blocks))
+
+    def take_queued(self) -> dict[int, deque[tuple[str, str | None]]]:
+        """Return the queued (text, parse mode) messages of every chat and leave the queues empty."""
+        queues, self.__queues = self.__queues, {}
+        return queues
+
+    def handle_send_error(
+            self, chat_id: int, queue: deque[tuple[str, str | None]], retries: dict[int, int], exception: Exception
+    ) -> bool:
+        """Handle the failure to send the first message of the queue and return False if the chat is given up on.
+
+        The message is retried after the 429 error, a network or a server error or a response which is not
+        from the Bot API, like an error page of a proxy. A message rejected by Telegram is skipped, and all
+        messages are dropped if the chat is no longer available.
+        """
+        # Timeouts have no message
+        reason = str(exception) or type(exception).__name__
+        if isinstance(exception, ApiTelegramException) and exception.error_code != 429 and exception.error_code < 500:
+            if exception.error_code == 403 or 'chat not found' in exception.description.lower():
+                self.log.warning('Unable to send messages to chat_id=%s: %s', chat_id, reason)
+                self.metrics.inc('messages_total', len(queue), result='failed')
+                queue.clear()
+            else:
+                self.log.warning('Unable to send a message to chat_id=%s, skipping it: %s', chat_id, reason)
+                self.metrics.inc('messages_total', result='failed')
+                queue.popleft()
+            return True
+
+        if retries[chat_id] >= self.MAX_RETRIES:
+            self.log.warning('Unable to send messages to chat_id=%s, postponing them: %s', chat_id, reason)
+            self.metrics.inc('messages_total', len(queue), result='postponed')
+            return False
+        if isinstance(exception, ApiTelegramException) and exception.error_code == 429:
+            retry_after = exception.result_json.get('parameters', {}).get('retry_after', 1)
+            self.log.warning('Too many requests to chat_id=%s, retrying after %s seconds', chat_id, retry_after)
+        else:
+            retry_after = 2 ** retries[chat_id]
+            self.log.warning('Unable to send a message to chat_id=%s, retrying after %s seconds: %s',
+                             chat_id, retry_after, reason)
+        self.rate_limiter.pause_chat(chat_id, retry_after)
+        retries[chat_id] += 1
+        self.metrics.inc('messages_total', result='retried')
+        return True
 
-    def __format_message(self, item: FeedItem) -> str:
+    def __send_messages(self, queues: dict[int, deque[tuple[str, str | None]]], on_sent: Callable[[int], None] | None):
+        """Send queued (text, parse mode) messages to the chats.
+
+        Chats are interleaved, so a chat waiting for its rate limit does not hold up the others.
+        """
+        self.log.debug('__send_messages(queues=dict(%d), on_sent=%s)', len(queues), on_sent)
+        clock = self.rate_limiter.clock
+        ready_chats = [(clock(), index, chat_id) for index, chat_id in enumerate(queues)]
+        retries = dict.fromkeys(queues, 0)
+
+        while ready_chats:
+            _, index, chat_id = heapq.heappop(ready_chats)
+            queue = queues[chat_id]
+            text, parse_mode = queue[0]
+
+            self.metrics.inc('rate_limit_wait_seconds_total', self.rate_limiter.acquire(chat_id))
+            started = time.perf_counter()
+            try:
+                self.log.debug('Sending a message to chat_id=%s', chat_id)
+                self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                queue.popleft()
+                retries[chat_id] = 0
+                self.metrics.inc('messages_total', result='sent')
+            except (ApiException, RequestException) as exception:
+                if not self.handle_send_error(chat_id, queue, retries, exception):
+                    continue
+            finally:
+                self.metrics.observe('telegram_request_duration_seconds', time.perf_counter() - started)
+
+            if queue:
+                heapq.heappush(ready_chats, (clock() + self.rate_limiter.get_chat_delay(chat_id), index, chat_id))
+            elif on_sent is not None:
+                on_sent(chat_id)
+
+        self.log.debug('Total time spent waiting for rate limits: %.2f seconds', self.rate_limiter.slept)
+
+    def __format_message(self, item: FeedItem, description_limit: int = MESSAGE_LENGTH_LIMIT) -> str:
+        """Format the item once and reuse the result for every chat and every feed in which the item appears."""
+        cache_key = (item.key, item.hash, item.date, description_limit)
+        message = self.__render_cache.get(cache_key)
+        if message is not None:
+            self.metrics.inc('render_cache_total', result='hit')
+            return message
+
+        self.metrics.inc('render_cache_total', result='miss')
+        message = self.__render_message(item, description_limit)
+        self.__render_cache.put(cache_key, message)
+        return message
+
+    def __render_message(self, item: FeedItem, description_limit: int) -> str:
         date_string = ''
         if item.date is not None:
             date_string = item.date.strftime('%m.%d.%Y %H:%M')
 
         header = (
-            f"<strong><a href=\"{item.url}\">{item.title}</a></strong>\n"
+            f"<strong><a href=\"{escape(item.url)}\">{escape(item.title)}</a></strong>\n"
             f"{date_string}\n\n"
         )
 
+        # All tags are stripped, so the description is escaped text
         sanitized_description = self.__sanitize_html(item.description)
 
-        if len(sanitized_description) > (self.MESSAGE_LENGTH_LIMIT - len(header)):
+        limit = min(description_limit, self.MESSAGE_LENGTH_LIMIT - len(header))
+        if len(sanitized_description) > limit:
             cut = '[...]'
-            trim_index = self.MESSAGE_LENGTH_LIMIT - len(header) - len(cut) - 1
+            trim_index = limit - len(cut) - 1
+            # Telegram rejects the message with a part of an entity like &amp;
+            entity_start = sanitized_description.rfind('&', 0, trim_index)
+            if entity_start != -1 and sanitized_description.find(';', entity_start, trim_index) == -1:
+                trim_index = entity_start
             sanitized_description = sanitized_description[:trim_index] + cut
 
         return header + sanitized_description
 
+    def __format_digest_section(self, updates: list[FeedItem], feed_title: str) -> list[str]:
+        """Format a feed header and its items as separate text blocks."""
+        blocks = [f'<strong>Updates from the {escape(feed_title)} feed:</strong>']
+        blocks += [self.__format_message(update, self.DIGEST_DESCRIPTION_LIMIT) for update in updates]
+        return blocks
+
+    def __pack_blocks(self, blocks: list[str]) -> list[str]:
+        """Join text blocks into as few messages as possible not exceeding the message length limit."""
+        separator = '\n\n'
+        messages = []
+        current = ''
+        for block in blocks:
+            if current and len(current) + len(separator) + len(block) <= self.MESSAGE_LENGTH_LIMIT:
+                current += separator + block
+                continue
+            if current:
+                messages.append(current)
+            current = block
+        if current:
+            messages.append(current)
+        return messages
+
     def __sanitize_html(self, html: str) -> str:
         if not html:
             return ''
-        return self.html_sanitizer.clean(html)
+        if self.html_sanitizer is None:
+            from bleach.sanitizer import Cleaner  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+            self.html_sanitizer = Cleaner(
+                tags=[],
+                attributes={},
+                protocols=[],
+                strip=True,
+            )
+        started = time.perf_counter()
+        sanitized = self.html_sanitizer.clean(html)
+        elapsed = time.perf_counter() - started
+        self.sanitizer_calls += 1
+        self.sanitizer_time += elapsed
+        self.metrics.observe('sanitizer_duration_seconds', elapsed)
+        return sanitized
 
 
 class UserAuthMiddleware(BaseMiddleware):
@@ -212,10 +591,8 @@ class UserAuthMiddleware(BaseMiddleware):
         telegram_id = message.from_user.id
         self.log.debug('Telegram chat_id=%s', telegram_id)
 
-        user_id = self.database.find_user(telegram_id)
+        user_id = self.database.find_or_add_user(telegram_id)
         self.log.debug('Database user ID is \'%s\'', user_id)
-        if user_id is None:
-            return self.database.add_user(telegram_id)
         return user_id
 
 
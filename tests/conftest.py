@@ -0,0 +1,18 @@
+import logging
+import os
+
+import pytest
+
+from database import Database
+
+
+@pytest.fixture
+def database() -> Database:
+    """Database of the tests, which is WIPED before every test using it."""
+    dsn = os.getenv('RSSBOT_TEST_DSN')
+    if not dsn:
+        pytest.skip('RSSBOT_TEST_DSN is not set')
+    db = Database(dsn, logging.getLogger('Database'))
+    with db.transaction() as cur:
+        cur.execute('TRUNCATE users, feeds, subscriptions, feeds_last_items, outbox_items, deliveries RESTART IDENTITY CASCADE')
+    return db
@@ -0,0 +1,35 @@
+import logging
+from contextlib import contextmanager
+from threading import Event
+from urllib.parse import urlparse
+
+from http_client import UrlChecker
+
+
+class StubResponse:
+
+    status_code = 200
+
+
+class SlowHostSession:
+    """Session answering the requests to slow.example.com only after a request to another host is answered."""
+
+    def __init__(self) -> None:
+        self.fast_answered: Event = Event()
+
+    @contextmanager
+    def get(self, url: str, timeout: float, stream: bool):
+        # pylint: disable=unused-argument
+        if urlparse(url).hostname == 'slow.example.com':
+            # pylint: disable-next=too-many-function-args
+            assert self.fast_answered.wait(5), 'the other host was not requested while the slow one was waited for'
+        else:
+            self.fast_answered.set()
+        yield StubResponse()
+
+
+def test_slow_host_does_not_hold_up_other_hosts():
+    slow_urls = [f'https://slow.example.com/{number}.xml' for number in range(3)]
+    checker = UrlChecker(logging.getLogger('UrlChecker'), SlowHostSession(), workers=2, per_host_limit=1)
+
+    assert not checker.find_unreachable(slow_urls + ['https://fast.example.com/feed.xml'])
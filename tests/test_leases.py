@@ -0,0 +1,67 @@
+import logging
+import time
+from datetime import timedelta
+from threading import Event, Thread
+
+from database import Database
+from rss import Feed
+from update_manager import UpdateManager
+
+
+LEASE_TIME = timedelta(seconds=0.3)
+
+
+class SlowReader:
+    """Reader taking longer than the lease to find out that a feed is not modified."""
+
+    def __init__(self, delay: float) -> None:
+        self.delay: float = delay
+        self.started: Event = Event()
+
+    def get_feed(self, url: str, etag: str | None, last_modified: str | None, known_keys: set[str]) -> Feed:
+        # pylint: disable=unused-argument
+        self.started.set()
+        time.sleep(self.delay)
+        return Feed(url, None, etag, last_modified)
+
+
+def add_feeds(database: Database, amount: int) -> list[int]:
+    user_id = database.add_user(1)
+    for number in range(amount):
+        database.subscribe_user_by_url(user_id, f'https://example.com/{number}.xml')
+    return sorted(feed['id'] for feed in database.find_feeds())
+
+
+def lease_feed_ids(database: Database, owner: str) -> list[int]:
+    return sorted(feed['id'] for feed in database.lease_feeds(owner, 10, LEASE_TIME, timedelta(hours=1)))
+
+
+def test_expired_lease_is_taken_over(database: Database):
+    feed_ids = add_feeds(database, 2)
+    assert lease_feed_ids(database, 'crashed') == feed_ids
+    assert not lease_feed_ids(database, 'other')
+
+    time.sleep(LEASE_TIME.total_seconds() * 2)
+    assert lease_feed_ids(database, 'other') == feed_ids
+    # The previous owner could neither renew nor release the feeds taken over
+    assert database.renew_feeds('crashed', feed_ids, LEASE_TIME) == 0
+    database.release_feeds('crashed', feed_ids)
+    assert not lease_feed_ids(database, 'third')
+
+
+def test_lease_is_renewed_during_slow_update(database: Database):
+    add_feeds(database, 1)
+    reader = SlowReader(LEASE_TIME.total_seconds() * 4)
+    manager = UpdateManager(database, reader, logging.getLogger('UpdateManager'))
+
+    updater = Thread(target=manager.update_leased, args=('slow', LEASE_TIME, timedelta(hours=1)))
+    updater.start()
+    assert reader.started.wait(5)  # pylint: disable=too-many-function-args
+    # The lease would have expired by now if it was not renewed
+    time.sleep(LEASE_TIME.total_seconds() * 2)
+    taken = lease_feed_ids(database, 'other')
+    updater.join()
+
+    assert not taken
+    # The feed is released as checked once the update is finished
+    assert not lease_feed_ids(database, 'other')
@@ -0,0 +1,31 @@
+import pytest
+
+from exceptions import DisplayableException
+from opml import build_opml, parse_opml
+
+
+URLS = ['https://example.com/feed.xml', 'https://example.org/rss']
+
+ENTITIES = '''<?xml version="1.0" encoding="{encoding}"?>
+<!DOCTYPE opml [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>
+<opml version="2.0"><body><outline xmlUrl="https://example.com/&b;"/></body></opml>
+'''
+
+
+def test_exported_feeds_are_imported():
+    assert parse_opml(build_opml(URLS, 'Feeds')) == URLS
+
+
+def test_other_encodings_are_imported():
+    document = build_opml(URLS, 'Feeds').decode().replace("encoding='utf-8'", "encoding='utf-16'")
+    assert parse_opml(document.encode('utf-16')) == URLS
+
+
+@pytest.mark.parametrize('document', [
+    ENTITIES.format(encoding='utf-8').encode(),
+    ENTITIES.format(encoding='utf-16').encode('utf-16'),
+    b'<?xml version="1.0"?>\n<!DOCTYPE opml SYSTEM "https://example.com/opml.dtd">\n<opml version="2.0"/>',
+], ids=['entities', 'utf-16 entities', 'external dtd'])
+def test_document_types_are_rejected(document):
+    with pytest.raises(DisplayableException):
+        parse_opml(document)
@@ -0,0 +1,183 @@
+import time
+
+import pytest
+from feedparser import FeedParserDict, parse
+
+from rss import EntrySelector, FeedItem, StreamingFeedParser, UnsupportedFeedError
+
+
+BASE_URL = 'https://example.com/blog/feed.xml'
+
+HTML_RSS = b'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/">
+<channel>
+<title>Blog &amp; news</title>
+<item>
+    <title>Bold &lt;b&gt;title&lt;/b&gt; &amp;amp; more</title>
+    <link>/posts/1</link>
+    <guid>/posts/1</guid>
+    <description><![CDATA[<p style="color: red" onclick="alert(1)">Read <a href="../about">more</a>
+        <img src="img/1.png"></p><script>alert(1)</script>]]></description>
+</item>
+<item>
+    <title>Escaped markup</title>
+    <link>https://example.com/posts/2</link>
+    <description>&lt;p&gt;An &lt;a href="/posts/1"&gt;earlier post&lt;/a&gt; &amp;amp;
+        &lt;iframe src="x"&gt;&lt;/iframe&gt;&lt;/p&gt;</description>
+</item>
+<item>
+    <title>Full content</title>
+    <link>https://example.com/posts/3</link>
+    <content:encoded><![CDATA[<div><object data="x.swf"></object>
+        <a href="3#comments">Comments</a> &eacute;t&eacute;</div>]]></content:encoded>
+</item>
+<item>
+    <title>Plain text</title>
+    <link>https://example.com/posts/4</link>
+    <description>5 &lt; 6 and 7 &gt; 3</description>
+</item>
+<item>
+    <title>Content first</title>
+    <link>https://example.com/posts/5</link>
+    <content:encoded><![CDATA[<p>The whole <b>post</b></p>]]></content:encoded>
+    <description>The summary</description>
+</item>
+<item>
+    <title>Description first</title>
+    <link>https://example.com/posts/6</link>
+    <description>The summary</description>
+    <content:encoded><![CDATA[<p>The whole <b>post</b></p>]]></content:encoded>
+    <description>Another summary</description>
+</item>
+</channel>
+</rss>
+'''
+
+HTML_ATOM = b'''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title type="html">Blog &lt;i&gt;feed&lt;/i&gt;</title>
+<entry>
+    <title type="html">&lt;em&gt;HTML&lt;/em&gt; title</title>
+    <link rel="alternate" type="text/html" href="/posts/1"/>
+    <id>urn:uuid:1</id>
+    <updated>2022-05-01T10:00:00Z</updated>
+    <summary type="html">&lt;a href="2"&gt;Next&lt;/a&gt;&lt;script&gt;alert(1)&lt;/script&gt;</summary>
+</entry>
+<entry>
+    <title>Text title &lt;b&gt;</title>
+    <link href="posts/2"/>
+    <id>urn:uuid:2</id>
+    <updated>2022-05-01T09:00:00Z</updated>
+    <content type="xhtml"><div xmlns="http://www.w3.org/1999/xhtml">
+        <p>See <a href="/posts/1" onmouseover="x()">this</a></p>
+    </div></content>
+</entry>
+<entry>
+    <title>Text summary</title>
+    <link href="https://example.com/posts/3"/>
+    <id>urn:uuid:3</id>
+    <updated>2022-05-01T08:00:00Z</updated>
+    <summary>1 &lt; 2 &amp; &lt;b&gt;not bold&lt;/b&gt;</summary>
+</entry>
+<entry>
+    <title>Content first</title>
+    <link href="https://example.com/posts/4"/>
+    <id>urn:uuid:4</id>
+    <updated>2022-05-01T07:00:00Z</updated>
+    <content type="html">&lt;p&gt;The whole &lt;b&gt;post&lt;/b&gt;&lt;/p&gt;</content>
+    <summary>The summary</summary>
+</entry>
+</feed>
+'''
+
+
+def read_streamed(document: bytes) -> tuple[str, list[FeedItem]]:
+    parser = StreamingFeedParser(BASE_URL)
+    entries = list(parser.feed(document)) + list(parser.close())
+    return parser.title, [FeedItem(entry) for entry in entries]
+
+
+def read_parsed(document: bytes) -> tuple[str, list[FeedItem]]:
+    parsed = parse(document, response_headers={'content-location': BASE_URL, 'content-type': 'application/xml'})
+    return parsed.feed.get('title', ''), [FeedItem(entry) for entry in parsed.entries]
+
+
+def assert_same_items(document: bytes) -> None:
+    streamed_title, streamed = read_streamed(document)
+    parsed_title, parsed = read_parsed(document)
+
+    assert streamed_title == parsed_title
+    assert len(streamed) == len(parsed)
+    for streamed_item, parsed_item in zip(streamed, parsed):
+        assert (streamed_item.key, streamed_item.url, streamed_item.title, streamed_item.description) == \
+               (parsed_item.key, parsed_item.url, parsed_item.title, parsed_item.description)
+        assert streamed_item.hash == parsed_item.hash
+        assert streamed_item.date == parsed_item.date
+
+
+def test_html_rss_items_match_feedparser():
+    assert_same_items(HTML_RSS)
+
+
+def test_html_atom_items_match_feedparser():
+    assert_same_items(HTML_ATOM)
+
+
+def test_unescaped_markup_is_left_to_feedparser():
+    with pytest.raises(UnsupportedFeedError):
+        read_streamed(HTML_RSS.replace(b'<title>Full content</title>', b'<title>Full <b>content</b></title>'))
+
+
+def make_entries(amount: int) -> list[FeedParserDict]:
+    """Entries from the oldest to the newest one, an entry a minute."""
+    return [
+        FeedParserDict(id=f'g{number}', updated_parsed=time.gmtime(1_650_000_000 + number * 60)) for number in range(amount)
+    ]
+
+
+def test_newest_first_feed_is_read_up_to_limit():
+    selector = EntrySelector((), 200)
+    entries = make_entries(300)[::-1]
+
+    assert all(selector.add(entry) for entry in entries[:199])
+    assert not selector.add(entries[199])
+    assert [item.guid for item in selector.items] == [f'g{number}' for number in range(299, 99, -1)]
+    assert not selector.complete
+
+
+@pytest.mark.parametrize('bumped', [0, 50])
+def test_newest_first_feed_with_bumped_entry_is_read_up_to_limit(bumped):
+    selector = EntrySelector((), 200)
+    entries = make_entries(300)[::-1]
+    # A pinned or edited entry is newer than the entries before it
+    entries[bumped]['updated_parsed'] = time.gmtime(1_650_000_000 + 400 * 60)
+
+    assert all(selector.add(entry) for entry in entries[:199])
+    assert not selector.add(entries[199])
+    assert [item.guid for item in selector.items] == [f'g{number}' for number in range(299, 99, -1)]
+
+
+def test_undated_feed_stops_at_known_entries():
+    selector = EntrySelector({'g7', 'g6', 'g5'}, 200)
+    entries = [FeedParserDict(id=f'g{number}') for number in range(9, -1, -1)]
+
+    assert all(selector.add(entry) for entry in entries[:4])
+    assert not selector.add(entries[4])
+    assert len(selector.items) == 5
+    assert not selector.complete
+
+
+def test_oldest_first_feed_keeps_last_entries():
+    selector = EntrySelector((), 200)
+
+    assert all(selector.add(entry) for entry in make_entries(300))
+    assert [item.guid for item in selector.items] == [f'g{number}' for number in range(100, 300)]
+    assert not selector.complete
+
+
+def test_feed_within_limit_is_complete():
+    selector = EntrySelector({'g5', 'g6', 'g7'}, 200)
+
+    assert all(selector.add(entry) for entry in make_entries(10))
+    assert len(selector.items) == 10
+    assert selector.complete
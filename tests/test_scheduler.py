@@ -0,0 +1,44 @@
+import logging
+
+from scheduler import UpdateScheduler
+
+
+class StubDatabase:
+
+    def __init__(self) -> None:
+        self.failures: int = 1
+
+    def find_feeds(self) -> list[dict]:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('database is down')
+        return [{'id': 1, 'url': 'https://example.com/feed.xml'}]
+
+
+class FailingUpdateManager:
+    """Update manager failing the first batch and stopping the scheduler on the next one."""
+
+    batch_size = 100
+
+    def __init__(self) -> None:
+        self.scheduler: UpdateScheduler | None = None
+        self.calls: int = 0
+
+    def update_feeds(self, feeds: list[dict]) -> dict[int, int]:
+        self.calls += 1
+        if self.calls == 1:
+            raise ConnectionError('database is down')
+        self.scheduler.stop()
+        return {feed['id']: 0 for feed in feeds}
+
+
+def test_scheduler_survives_errors():
+    manager = FailingUpdateManager()
+    scheduler = UpdateScheduler(
+        StubDatabase(), manager, logging.getLogger('UpdateScheduler'), min_interval=0.01, refresh_interval=0.01
+    )
+    manager.scheduler = scheduler
+
+    scheduler.run()
+    assert manager.calls == 2
+    assert scheduler.schedules[1].failures == 0
@@ -0,0 +1,28 @@
+import logging
+import re
+
+from feedparser import FeedParserDict
+
+from rss import FeedItem
+from telegram import Notifier
+
+
+def test_digest_items_are_valid_html():
+    notifier = Notifier('123456789:token', logging.getLogger('Notifier'))
+    items = [
+        FeedItem(FeedParserDict(
+            id=f'g{number}', link=f'https://example.com/?post={number}&page="1"', title='Q&A <live>',
+            summary='x' * number + ' &amp; <b>bold</b>' * 50
+        ))
+        for number in range(280, 300)
+    ]
+
+    notifier.queue_updates({1: Notifier.DIGEST_FEED}, items, 'Feed')
+    messages = notifier.take_queued()[1]
+    text = '\n\n'.join(text for text, _ in messages)
+
+    assert {parse_mode for _, parse_mode in messages} == {'HTML'}
+    assert '<a href="https://example.com/?post=280&amp;page=&quot;1&quot;">Q&amp;A &lt;live&gt;</a>' in text
+    # Every ampersand starts a whole entity, the descriptions are cut between them
+    assert not re.search(r'&(?!(amp|lt|gt|quot|#x27);)', text)
+    assert '<b>' not in text
@@ -0,0 +1,49 @@
+import logging
+from datetime import timedelta
+
+from feedparser import FeedParserDict
+
+from database import Database
+from rss import Feed
+from update_manager import UpdateManager
+
+
+URL = 'https://example.com/feed.xml'
+
+
+class StubReader:
+    """Reader returning the feed with the given item GUIDs."""
+
+    def __init__(self) -> None:
+        self.guids: list[str] = []
+        self.complete: bool = True
+
+    def get_feed(self, url: str, etag: str | None, last_modified: str | None, known_keys: set[str]) -> Feed:
+        # pylint: disable=unused-argument
+        entries = [FeedParserDict(id=guid, link=f'{url}/{guid}', title=guid) for guid in self.guids]
+        feed = Feed(url, FeedParserDict(feed=FeedParserDict(title='Feed'), entries=entries))
+        feed.complete = self.complete
+        return feed
+
+
+def get_item_keys(database: Database) -> list[str]:
+    return sorted(item['item_key'] for item in database.find_feed_items(database.find_feeds()[0]['id']))
+
+
+def test_items_are_pruned_only_from_feeds_read_to_end(database: Database):
+    database.subscribe_user_by_url(database.add_user(1), URL)
+    reader = StubReader()
+    manager = UpdateManager(database, reader, logging.getLogger('UpdateManager'), items_retention=timedelta(0))
+
+    reader.guids = ['a', 'b', 'c']
+    manager.update()
+    assert get_item_keys(database) == ['a', 'b', 'c']
+
+    # Only the head of the feed was read, the other items could still be in it
+    reader.guids, reader.complete = ['d', 'c'], False
+    manager.update()
+    assert get_item_keys(database) == ['a', 'b', 'c', 'd']
+
+    reader.guids, reader.complete = ['e', 'd', 'c'], True
+    manager.update()
+    assert get_item_keys(database) == ['c', 'd', 'e']
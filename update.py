@@ -1,29 +1,72 @@
+import argparse
 import logging
 import os
-from dotenv import load_dotenv
+import signal
+import socket
+from threading import Thread
 
-from rss import RssReader
-from update_manager import UpdateManager
-from database import Database
-from telegram import Notifier
+from app import (
+    Config, create_async_delivery_worker, create_database, create_delivery_workers, create_metrics, create_scheduler,
+    create_update_manager, setup_logging
+)
 
 
-load_dotenv()
+parser = argparse.ArgumentParser(description='Send new feed items to the subscribers.')
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--daemon', action='store_true', help='keep running and update each feed on its own schedule')
+mode.add_argument('--shard', action='store_true', help='share the feeds with other updaters running at the same time')
+mode.add_argument(
+    '--async', dest='asynchronous', action='store_true',
+    help='overlap fetching, saving and sending in an asyncio pipeline, sending many messages at once'
+)
+parser.add_argument('--no-send', action='store_true', help='only queue the updates, send.py will deliver them')
+args = parser.parse_args()
 
-token = os.getenv('RSSBOT_TG_TOKEN')
-dsn = os.getenv('RSSBOT_DSN')
-log_level = os.getenv('LOG_LEVEL', 'INFO')
+config = Config()
+setup_logging(config, 'the updater')
+metrics = create_metrics(config)
+db = create_database(config, metrics)
+updater = create_update_manager(config, db, metrics)
 
-print('Starting the updater with logging level', log_level.upper())
-logging.basicConfig(
-    level=log_level.upper(),
-    format='%(asctime)s: <%(name)s> [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# Updates are delivered by separate threads while the feeds are still being fetched.
+delivery_workers = []
+if not args.no_send and not args.asynchronous:
+    delivery_workers = create_delivery_workers(config, db, metrics, config.sender_workers)
+delivery_threads = [
+    Thread(target=worker.run, name=f'DeliveryWorker-{index}') for index, worker in enumerate(delivery_workers)
+]
+for thread in delivery_threads:
+    thread.start()
+
+try:
+    if args.daemon:
+        scheduler = create_scheduler(config, updater)
+
+        def stop(signum, frame):
+            # pylint: disable=unused-argument
+            scheduler.stop()
+            for worker in delivery_workers:
+                worker.stop()
 
-db = Database(dsn, logging.getLogger('Database'))
-notifier = Notifier(token, logging.getLogger('Notifier'))
-rss_reader = RssReader(logging.getLogger('RssReader'))
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        scheduler.run()
+    elif args.shard:
+        updater.update_leased(f'{socket.gethostname()}:{os.getpid()}', config.shard_lease_time, config.shard_min_interval)
+    elif args.asynchronous:
+        # aiohttp is the slowest import of all, only the asyncio pipeline needs it
+        from update_pipeline import UpdatePipeline  # pylint: disable=import-outside-toplevel
 
-updater = UpdateManager(db, notifier, rss_reader, logging.getLogger('UpdateManager'))
-updater.update()
+        async_delivery_worker = None if args.no_send else create_async_delivery_worker(config, db, metrics)
+        UpdatePipeline(updater, logging.getLogger('UpdatePipeline'), async_delivery_worker).run()
+    else:
+        updater.update()
+finally:
+    for delivery_worker in delivery_workers:
+        delivery_worker.finish()
+    for thread in delivery_threads:
+        thread.join()
+    if config.metrics_file:
+        metrics.write(config.metrics_file)
+    if config.report_file:
+        metrics.write_report(config.report_file)
@@ -1,65 +1,288 @@
+import time
+from collections import Counter
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
 from logging import Logger
+from threading import Event, Thread
 
-from rss import RssReader, FeedItem
+from rss import RssReader, Feed, FeedItem
+from http_client import HostLimiter
+from cache import LruCache
 from database import Database
-from telegram import Notifier
+from feed_diff import FeedDiff, calculate_difference
+from keyword_filter import KeywordMatcher, is_accepted
+from metrics import Metrics
 
 
 class UpdateManager:
     """Implement the feed update."""
 
-    def __init__(self, database: Database, notifier: Notifier, rss_reader: RssReader, logger: Logger) -> None:
+    # Amount of feeds whose compiled keyword matchers are kept between the updates
+    MATCHER_CACHE_SIZE: int = 10000
+
+    def __init__(
+            self, database: Database, rss_reader: RssReader, logger: Logger,
+            workers: int = 8, per_host_limit: int = 2, notify_edited: bool = False,
+            items_retention: timedelta = timedelta(days=30), batch_size: int = 500, metrics: Metrics | None = None
+    ) -> None:
         self.log: Logger = logger
         self.log.debug(
-            'UpdateManager.__init__(database=%s, notifier=%s, rss_reader=%s, logger=%s)',
-            database, notifier, rss_reader, logger
+            'UpdateManager.__init__(database=%s, rss_reader=%s, logger=%s, workers=%d, per_host_limit=%d, '
+            'notify_edited=%s, items_retention=%s, batch_size=%d, metrics=%s)',
+            database, rss_reader, logger, workers, per_host_limit, notify_edited, items_retention, batch_size, metrics
         )
+        self.metrics: Metrics = metrics if metrics is not None else Metrics()
         self.database: Database = database
-        self.notifier: Notifier = notifier
         self.rss_reader: RssReader = rss_reader
+        self.workers: int = workers
+        self.per_host_limit: int = per_host_limit
+        self.notify_edited: bool = notify_edited
+        self.items_retention: timedelta = items_retention
+        self.batch_size: int = batch_size
+        self.__hosts: HostLimiter = HostLimiter(per_host_limit, self.__observe_host_wait)
+        self.__matchers: LruCache = LruCache(self.MATCHER_CACHE_SIZE)
 
     def update(self):
-        """Send new feed items to the user."""
+        """Queue new feed items for delivery to the users."""
         self.log.info('Running update')
-        feeds = self.database.find_feeds()
-        self.log.info('Feeds to update: %d', len(feeds))
+        self.update_feeds(self.database.find_feeds())
 
-        for feed in feeds:
-            self.log.info('Processing [%d] %s', feed['id'], feed['url'])
-            feed_obj = self.rss_reader.get_feed(feed['url'])
-            new_items = feed_obj.items
-            old_items = self.database.find_feed_items(feed['id'])
+    def update_leased(self, owner: str, lease_time: timedelta, min_interval: timedelta) -> None:
+        """Update the feeds in leased batches, sharing the work with other updaters running at the same time.
 
-            diff = self.__calculate_difference(new_items, old_items)
+        The lease of a batch is renewed while it is being updated, so a slow batch is not taken over by others.
+        """
+        self.log.info('Running update as %s', owner)
+        while feeds := self.database.lease_feeds(owner, self.batch_size, lease_time, min_interval):
+            feed_ids = [feed['id'] for feed in feeds]
+            updated = Event()
+            renewal = Thread(
+                target=self.__renew_lease, args=(owner, feed_ids, lease_time, updated), name='LeaseRenewal', daemon=True
+            )
+            renewal.start()
+            try:
+                self.update_feeds(feeds)
+            finally:
+                updated.set()
+                renewal.join()
+                self.database.release_feeds(owner, feed_ids)
 
-            if not diff:
+    def __renew_lease(self, owner: str, feed_ids: list[int], lease_time: timedelta, updated: Event) -> None:
+        """Renew the lease of the feeds every third of the lease time until the update is finished."""
+        while not updated.wait(lease_time.total_seconds() / 3):
+            try:
+                renewed = self.database.renew_feeds(owner, feed_ids, lease_time)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('Unable to renew the lease of %d feeds', len(feed_ids))
                 continue
+            if renewed < len(feed_ids):
+                self.log.warning('Lease of %d feeds expired before it was renewed', len(feed_ids) - renewed)
 
-            chat_ids = self.database.find_feed_subscribers(feed['id'])
-            self.notifier.send_updates(chat_ids, diff, feed_obj.title)
-            self.database.update_feed_items(feed['id'], new_items)
+    def update_feeds(self, feeds: list[dict]) -> dict[int, int | None]:
+        """Update given feeds and return the amount of new items per feed ID (None if the feed failed)."""
+        self.log.info('Feeds to update: %d', len(feeds))
+        started = time.perf_counter()
+        results: dict[int, int | None] = {}
+        counts: Counter = Counter()
 
-    def __calculate_difference(self, new_items: list[FeedItem], old_items: list[dict]) -> list[FeedItem]:
-        """Calculate new feed items."""
-        self.log.debug(
-            '__calculate_difference(new_items=list(%d), old_items=list(%d))', len(new_items), len(old_items)
+        # Feeds are downloaded in parallel, but the results are processed in batches in the original order
+        # in the current thread, so the database is never used concurrently. Items of the batch are loaded
+        # before the download, so the reader could stop at the items which are already known.
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='FeedFetcher') as executor:
+            feeds_iterator = iter(feeds)
+            for batch in iter(lambda: list(islice(feeds_iterator, self.batch_size)), []):
+                old_items, known_keys = self.load_batch(batch)
+                with self.metrics.timer('update_phase_duration_seconds', phase='fetch'):
+                    downloads = [self.submit_fetch(executor, feed, keys) for feed, keys in zip(batch, known_keys)]
+                    fetched = [(feed, download.result()) for feed, download in zip(batch, downloads)]
+                results.update(self.process_batch(fetched, old_items, counts))
+
+        self.finish_update(len(feeds), counts, started)
+        return results
+
+    def load_batch(self, batch: list[dict]) -> tuple[dict[int, list[dict]], list[set[str]]]:
+        """Load the known items of the feeds and return them together with the sets of their keys for every feed."""
+        with self.metrics.timer('update_phase_duration_seconds', phase='load'):
+            old_items = self.database.find_feeds_items([feed['id'] for feed in batch])
+        return old_items, [{item['item_key'] for item in old_items.get(feed['id'], [])} for feed in batch]
+
+    def process_batch(
+            self, fetched: list[tuple[dict, Feed | None]], old_items: dict[int, list[dict]], counts: Counter
+    ) -> dict[int, int | None]:
+        """Save the fetched batch, queue its updates and return the amount of new items per feed ID.
+
+        Feeds are counted by their results in counts.
+        """
+        with self.metrics.timer('update_phase_duration_seconds', phase='move'):
+            merges = self.__move_feeds(fetched)
+        counts['merged'] += len(merges)
+
+        results: dict[int, int | None] = {}
+        modified = []
+        for feed, feed_obj in fetched:
+            if feed['id'] in merges:
+                # The feed is deleted, its items are processed with the feed it was merged into
+                results[feed['id']] = 0
+            elif feed_obj is None:
+                counts['failed'] += 1
+                results[feed['id']] = None
+            elif feed_obj.not_modified:
+                self.log.debug('[%d] %s is not modified', feed['id'], feed['url'])
+                counts['not_modified'] += 1
+                results[feed['id']] = 0
+            else:
+                counts['modified'] += 1
+                modified.append((feed, feed_obj))
+
+        if modified:
+            results.update(self.__process_feeds(modified, old_items))
+        return results
+
+    def finish_update(self, feeds: int, counts: Counter, started: float) -> None:
+        """Record the metrics of the finished update."""
+        for result in ('not_modified', 'modified', 'failed', 'merged'):
+            self.metrics.inc('feeds_total', counts[result], result=result)
+        self.metrics.observe('update_duration_seconds', time.perf_counter() - started)
+        self.log.info(
+            'Update finished. Feeds: %d, cache hits: %d, cache misses: %d, failed: %d, merged: %d',
+            feeds, counts['not_modified'], counts['modified'], counts['failed'], counts['merged']
         )
-        if not old_items:
-            self.log.debug('Old items are empty, returning new')
-            return new_items
-
-        diff = []
-        guids = [item['guid'] for item in old_items if item['guid']]
-        urls = [item['url'] for item in old_items]
-
-        self.log.debug('Comparing %d new items with %d old', len(new_items), len(old_items))
-        for item in new_items:
-            if not guids and item.url not in urls:
-                diff.append(item)
+
+    def __process_feeds(self, feeds: list[tuple[dict, Feed]], old_items: dict[int, list[dict]]) -> dict[int, int]:
+        """Queue the updates for subscribers, save the state of the feeds and return the amount of new items per feed ID."""
+        self.log.debug('__process_feeds(feeds=list(%d), old_items=dict(%d))', len(feeds), len(old_items))
+
+        diffs: dict[int, FeedDiff] = {}
+        with self.metrics.timer('update_phase_duration_seconds', phase='diff'):
+            for feed, feed_obj in feeds:
+                self.log.info('Processing [%d] %s', feed['id'], feed['url'])
+                diff = calculate_difference(feed_obj.items, old_items.get(feed['id'], []))
+                self.log.debug('%d new and %d edited items found', len(diff.new), len(diff.edited))
+                self.metrics.update_feed_record(feed['id'], new_items=len(diff.new), edited_items=len(diff.edited))
+                self.metrics.inc('items_total', len(diff.new), kind='new')
+                self.metrics.inc('items_total', len(diff.edited), kind='edited')
+                if diff:
+                    diffs[feed['id']] = diff
+
+        updates: dict[int, tuple[str, list[FeedItem]]] = {}
+        for feed, feed_obj in feeds:
+            if feed['id'] not in diffs:
                 continue
-            if item.guid not in guids:
-                diff.append(item)
+            diff = diffs[feed['id']]
+            feed_updates = diff.new + diff.edited if self.notify_edited else diff.new
+            if feed_updates:
+                updates[feed['id']] = (feed_obj.title, feed_updates)
+
+        with self.metrics.timer('update_phase_duration_seconds', phase='filter'):
+            filtered = self.__filter_updates(updates)
+
+        # The updates are queued in the same transaction with the feed state, so they are neither lost nor repeated.
+        # Items which left the feed are only known for the feeds read to the end.
+        current_keys = {
+            feed['id']: [item.key for item in feed_obj.items]
+            for feed, feed_obj in feeds if feed['id'] in diffs and feed_obj.complete
+        }
+        cache_headers = {
+            feed['id']: (feed_obj.etag, feed_obj.last_modified)
+            for feed, feed_obj in feeds
+            if (feed_obj.etag, feed_obj.last_modified) != (feed['etag'], feed['last_modified'])
+        }
+        with self.metrics.timer('update_phase_duration_seconds', phase='save'):
+            self.database.update_feeds_state(diffs, current_keys, cache_headers, self.items_retention, updates, filtered)
+
+        for feed, _ in feeds:
+            if feed['id'] in cache_headers:
+                feed['etag'], feed['last_modified'] = cache_headers[feed['id']]
 
-        self.log.debug('%d updates found', len(diff))
+        return {feed['id']: len(diffs[feed['id']].new) if feed['id'] in diffs else 0 for feed, _ in feeds}
 
-        return diff
+    def __filter_updates(self, updates: dict[int, tuple[str, list[FeedItem]]]) -> dict[tuple[int, int], list[str]]:
+        """Return the keys of the updates accepted by the keyword filters of the subscribers by (chat ID, feed ID).
+
+        Every item is scanned once for the keywords of all filters of its feed, not once per subscriber.
+        """
+        if not updates:
+            return {}
+
+        filtered: dict[tuple[int, int], list[str]] = {}
+        rejected = 0
+        for feed_id, subscriptions in self.database.find_feeds_filters(list(updates)).items():
+            matcher = self.__get_matcher(feed_id, subscriptions)
+            found_keywords = [(item.key, matcher.find_in_item(item)) for item in updates[feed_id][1]]
+            for subscription in subscriptions:
+                accepted = [
+                    key for key, found in found_keywords
+                    if is_accepted(found, subscription['include_keywords'], subscription['exclude_keywords'])
+                ]
+                filtered[(subscription['telegram_id'], feed_id)] = accepted
+                rejected += len(found_keywords) - len(accepted)
+
+        self.metrics.inc('deliveries_filtered_total', rejected)
+        return filtered
+
+    def __get_matcher(self, feed_id: int, subscriptions: list[dict]) -> KeywordMatcher:
+        """Return the matcher of the keywords of all filters of the feed, compiled again only when they change."""
+        keywords = frozenset(
+            keyword.lower()
+            for subscription in subscriptions
+            for keyword in subscription['include_keywords'] + subscription['exclude_keywords']
+        )
+        matcher = self.__matchers.get(feed_id)
+        if matcher is not None and matcher.keywords == keywords:
+            self.metrics.inc('keyword_matcher_cache_total', result='hit')
+            return matcher
+
+        self.metrics.inc('keyword_matcher_cache_total', result='miss')
+        matcher = KeywordMatcher(keywords)
+        self.__matchers.put(feed_id, matcher)
+        return matcher
+
+    def __move_feeds(self, fetched: list[tuple[dict, Feed | None]]) -> dict[int, int]:
+        """Save the new URLs of the feeds which moved permanently and return the feeds merged into other feeds."""
+        moved = {feed['id']: feed_obj.moved_to for feed, feed_obj in fetched if feed_obj is not None and feed_obj.moved_to}
+        if not moved:
+            return {}
+
+        merges = self.database.move_feeds(moved)
+        for feed_id, target_id in merges.items():
+            self.log.info('[%d] is merged into [%d]', feed_id, target_id)
+
+        return merges
+
+    def submit_fetch(self, executor: Executor, feed: dict, known_keys: set[str]) -> Future:
+        """Schedule the download of the feed respecting the per-host concurrency limit and return its future.
+
+        No more than `per_host_limit` downloads of a host are passed to the executors at once, see HostLimiter.
+        """
+        return self.__hosts.submit(executor, feed['url'], self.fetch_feed, feed, known_keys)
+
+    def __observe_host_wait(self, wait_time: float) -> None:
+        # Time spent waiting for the other downloads from the same host is not a part of the feed fetch time
+        self.metrics.observe('feed_host_wait_seconds', wait_time)
+
+    def fetch_feed(self, feed: dict, known_keys: set[str]) -> Feed | None:
+        """Download and parse the feed, use submit_fetch() to respect the per-host concurrency limit."""
+        self.log.debug('fetch_feed(feed=[%d] %s, known_keys=set(%d))', feed['id'], feed['url'], len(known_keys))
+        error = ''
+        fetch_started = time.perf_counter()
+        try:
+            feed_obj = self.rss_reader.get_feed(feed['url'], feed['etag'], feed['last_modified'], known_keys)
+        except Exception as exception:  # pylint: disable=broad-except
+            self.log.warning('Unable to fetch [%d] %s: %s', feed['id'], feed['url'], exception)
+            feed_obj = None
+            error = str(exception)
+        fetch_time = time.perf_counter() - fetch_started
+
+        if feed_obj is None:
+            self.metrics.observe('feed_fetch_duration_seconds', fetch_time, result='failed')
+            self.metrics.record_feed(feed['id'], feed['url'], status='error', error=error, fetch_seconds=round(fetch_time, 6))
+            return None
+
+        status = 'not_modified' if feed_obj.not_modified else 'modified'
+        self.metrics.observe('feed_fetch_duration_seconds', fetch_time, result=status)
+        self.metrics.record_feed(
+            feed['id'], feed['url'], status=status, fetch_seconds=round(fetch_time, 6),
+            parse_seconds=round(feed_obj.parse_time, 6), bytes=feed_obj.size, items=len(feed_obj.items)
+        )
+        return feed_obj
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from logging import Logger
+from typing import Any
+
+from async_delivery import AsyncDeliveryWorker
+from update_manager import UpdateManager
+
+
+class UpdatePipeline:
+    """Runs the update of UpdateManager as asyncio stages connected by bounded queues.
+
+    The fetching stage loads the known items of a batch and starts downloading it, the saving stage waits for
+    the downloads of the batches in order, saves them and wakes the delivery worker, which sends the queued updates.
+    So the next batches are being downloaded while the previous ones are saved and sent. Downloads are made by
+    the threads of the UpdateManager session and the queries are made from a single database thread, the event
+    loop only moves the batches between the stages.
+    """
+
+    # Amount of batches downloaded ahead of the one being saved
+    QUEUE_SIZE: int = 2
+
+    def __init__(
+            self, manager: UpdateManager, logger: Logger, delivery_worker: AsyncDeliveryWorker | None = None,
+            queue_size: int = QUEUE_SIZE
+    ) -> None:
+        self.log: Logger = logger
+        self.log.debug(
+            'UpdatePipeline.__init__(manager=%s, logger=%s, delivery_worker=%s, queue_size=%d)',
+            manager, logger, delivery_worker, queue_size
+        )
+        self.manager: UpdateManager = manager
+        self.delivery_worker: AsyncDeliveryWorker | None = delivery_worker
+        self.queue_size: int = queue_size
+        self.__database_executor: ThreadPoolExecutor | None = None
+        self.__fetch_executor: ThreadPoolExecutor | None = None
+
+    def run(self) -> dict[int, int | None]:
+        """Update all feeds and send the updates, return the amount of new items per feed ID."""
+        return asyncio.run(self.update())
+
+    async def update(self) -> dict[int, int | None]:
+        self.log.info('Running async update')
+        feeds = await asyncio.to_thread(self.manager.database.find_feeds)
+        return await self.update_feeds(feeds)
+
+    async def update_feeds(self, feeds: list[dict]) -> dict[int, int | None]:
+        """Update given feeds and return the amount of new items per feed ID (None if the feed failed)."""
+        self.log.info('Feeds to update: %d', len(feeds))
+        started = time.perf_counter()
+        results: dict[int, int | None] = {}
+        counts: Counter = Counter()
+        batches: asyncio.Queue[tuple[list[dict], dict[int, list[dict]], list[asyncio.Future]] | None] = asyncio.Queue(
+            self.queue_size
+        )
+
+        sending = asyncio.create_task(self.delivery_worker.run()) if self.delivery_worker is not None else None
+        database_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='UpdateDatabase')
+        fetch_executor = ThreadPoolExecutor(max_workers=self.manager.workers, thread_name_prefix='FeedFetcher')
+        with database_executor, fetch_executor:
+            self.__database_executor, self.__fetch_executor = database_executor, fetch_executor
+            fetching = asyncio.create_task(self.__fetch(feeds, batches))
+            try:
+                while (batch := await batches.get()) is not None:
+                    results.update(await self.__save(*batch, counts))
+                await fetching
+            finally:
+                fetching.cancel()
+                await asyncio.gather(fetching, return_exceptions=True)
+                if sending is not None:
+                    self.delivery_worker.finish()
+                    await sending
+
+        self.manager.finish_update(len(feeds), counts, started)
+        return results
+
+    async def __fetch(self, feeds: list[dict], batches: asyncio.Queue) -> None:
+        """Load the known items of every batch, start downloading it and pass it to the saving stage."""
+        try:
+            feeds_iterator = iter(feeds)
+            for batch in iter(lambda: list(islice(feeds_iterator, self.manager.batch_size)), []):
+                old_items, known_keys = await self.__run_in_database_thread(self.manager.load_batch, batch)
+                downloads = [
+                    asyncio.wrap_future(self.manager.submit_fetch(self.__fetch_executor, feed, feed_known_keys))
+                    for feed, feed_known_keys in zip(batch, known_keys)
+                ]
+                # Waits while the saving stage is behind by the queue size
+                await batches.put((batch, old_items, downloads))
+        except Exception:
+            # The saving stage stops and raises the exception of this task
+            await batches.put(None)
+            raise
+        await batches.put(None)
+
+    async def __save(
+            self, batch: list[dict], old_items: dict[int, list[dict]], downloads: list[asyncio.Future], counts: Counter
+    ) -> dict[int, int | None]:
+        """Save the downloaded batch and let the delivery worker send its updates."""
+        with self.manager.metrics.timer('update_phase_duration_seconds', phase='fetch'):
+            fetched = list(zip(batch, await asyncio.gather(*downloads)))
+        results = await self.__run_in_database_thread(self.manager.process_batch, fetched, old_items, counts)
+        if self.delivery_worker is not None:
+            self.delivery_worker.wake()
+        return results
+
+    async def __run_in_database_thread(self, function: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.__database_executor, function, *args)
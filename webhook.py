@@ -0,0 +1,119 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from queue import Full, Queue
+from threading import Event, Thread
+from telebot.types import Update
+
+from metrics import Metrics
+from telegram import CommandProcessor
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        webhook: WebhookServer = self.server.webhook
+        if self.path != webhook.path:
+            self.send_error(404)
+            return
+
+        status = webhook.accept(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.send_response(status)
+        if status == 503:
+            self.send_header('Retry-After', str(webhook.RETRY_AFTER))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+class WebhookServer:
+    """Receives the updates from Telegram over HTTP and handles them in a pool of worker threads.
+
+    Updates are acknowledged as soon as they are queued. When the queue is full, Telegram is answered with
+    503 and delivers the update again later, so a burst does not pile up in memory. On stop the server stops
+    accepting updates and the workers finish the queued ones.
+    """
+
+    # Seconds after which Telegram is asked to repeat an update which did not fit into the queue
+    RETRY_AFTER: int = 1
+
+    def __init__(
+            self, processor: CommandProcessor, logger: Logger, path: str, host: str = '', port: int = 8443,
+            workers: int = 8, queue_size: int = 1000, metrics: Metrics | None = None
+    ) -> None:
+        self.log: Logger = logger
+        self.log.debug(
+            'WebhookServer.__init__(processor=%s, logger=%s, host=\'%s\', port=%d, workers=%d, queue_size=%d, metrics=%s)',
+            processor, logger, host, port, workers, queue_size, metrics
+        )
+        self.processor: CommandProcessor = processor
+        self.path: str = path
+        self.host: str = host
+        self.port: int = port
+        self.workers: int = workers
+        self.metrics: Metrics = metrics if metrics is not None else Metrics()
+        self.__queue: Queue[tuple[float, Update] | None] = Queue(queue_size)
+        self.__stop_event: Event = Event()
+
+    def run(self) -> None:
+        """Serve the webhook until stop() is called, then handle the updates which are already queued."""
+        workers = [Thread(target=self.__work, name=f'WebhookWorker-{index}') for index in range(self.workers)]
+        for worker in workers:
+            worker.start()
+
+        server = ThreadingHTTPServer((self.host, self.port), WebhookRequestHandler)
+        server.webhook = self
+        # Request threads are joined on close, so the updates being received are not lost
+        server.daemon_threads = False
+        Thread(target=server.serve_forever, name='WebhookServer', daemon=True).start()
+        self.log.info('Listening for updates on port %d', server.server_port)
+
+        self.__stop_event.wait()
+        self.log.info('Stopping, %d queued updates left', self.__queue.qsize())
+        server.shutdown()
+        # Waits for the requests being received
+        server.server_close()
+        for _ in workers:
+            self.__queue.put(None)
+        for worker in workers:
+            worker.join()
+        self.log.info('Webhook server stopped')
+
+    def stop(self) -> None:
+        """Request the server to stop. Could be called from a signal handler."""
+        self.__stop_event.set()
+
+    def accept(self, body: bytes) -> int:
+        """Queue the update and return the HTTP status for Telegram."""
+        try:
+            update = Update.de_json(body.decode())
+        except (ValueError, KeyError, TypeError) as exception:
+            self.log.warning('Invalid update received: %s', exception)
+            self.metrics.inc('webhook_updates_total', result='invalid')
+            return 400
+
+        try:
+            self.__queue.put_nowait((time.perf_counter(), update))
+        except Full:
+            self.log.warning('Update queue is full, update %s is rejected', update.update_id)
+            self.metrics.inc('webhook_updates_total', result='rejected')
+            return 503
+
+        self.metrics.inc('webhook_updates_total', result='accepted')
+        self.metrics.set('webhook_queue_size', self.__queue.qsize())
+        return 200
+
+    def __work(self) -> None:
+        while (task := self.__queue.get()) is not None:
+            received, update = task
+            started = time.perf_counter()
+            self.metrics.set('webhook_queue_size', self.__queue.qsize())
+            try:
+                self.processor.process_updates([update])
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('Unable to handle update %s', update.update_id)
+            finished = time.perf_counter()
+            self.metrics.observe('webhook_queue_wait_seconds', started - received)
+            self.metrics.observe('webhook_handler_duration_seconds', finished - started)
+            self.metrics.observe('webhook_update_latency_seconds', finished - received)